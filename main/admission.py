@@ -0,0 +1,205 @@
+# admission.py
+# Ограничение одновременных тяжелых запросов (загрузка и обработка DICOM,
+# реконструкции), чтобы всплеск загрузок не занял все воркеры и не
+# заблокировал вход, обновление токена и списки.
+# Бюджеты общие для всех процессов узла: место - это файл в
+# ADMISSION_LOCK_DIR под flock. Блокировка снимается и при падении процесса.
+# Для каждого класса запросов: concurrency мест всего, per_user мест на
+# пользователя и queue мест ожидания. Запрос сверх лимита пользователя
+# получает 429, при полной очереди или по истечении timeout секунд
+# ожидания - 503; оба ответа с Retry-After. Легкие запросы не ограничиваются.
+# Запрос, который передает работу в фон (загрузка с X-Upload-Id), отдает свои
+# места задаче (detach_slots), и они заняты до конца обработки.
+# Ожидание в очереди - опрос неблокирующим flock с паузой от POLL_MIN до
+# POLL_MAX: блокирующий flock не ждет сразу несколько мест и не прерывается
+# по timeout. Ждущий запрос занимает поток воркера, поэтому очередь мала.
+# Middleware работает до аутентификации DRF: access-токен декодируется
+# только для выбора бюджета пользователя (подпись и срок проверяются, но
+# не существование и активность пользователя). Запрос с негодным токеном
+# считается по адресу клиента, а отклоняет его потом сама аутентификация.
+import os
+import random
+import re
+import time
+
+from django.conf import settings
+from django.http import JsonResponse
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+try:
+    import fcntl
+except ImportError:
+    # Без flock (Windows) ограничение отключается
+    fcntl = None
+
+# (класс, метод, путь)
+ENDPOINT_CLASSES = (
+    ('processing', 'POST', re.compile(r'^/api/cases/\d+/upload-dicom/$')),
+    ('processing', 'POST', re.compile(r'^/api/cases/batch-upload-dicom/$')),
+    ('rendering', 'GET', re.compile(r'^/api/cases/\d+/(panoramic|mesh)/$')),
+)
+DEFAULT_BUDGETS = {
+    'processing': {'concurrency': 4, 'per_user': 2, 'queue': 8, 'timeout': 10, 'retry_after': 5},
+    'rendering': {'concurrency': 4, 'per_user': 2, 'queue': 8, 'timeout': 10, 'retry_after': 2},
+}
+# Пауза между попытками занять место в очереди ожидания (сек)
+POLL_MIN, POLL_MAX = 0.02, 0.25
+
+
+def endpoint_class(request):
+    for name, method, pattern in ENDPOINT_CLASSES:
+        if request.method == method and pattern.match(request.path):
+            return name
+    return None
+
+
+def budget(name):
+    budgets = getattr(settings, 'ADMISSION_BUDGETS', None) or DEFAULT_BUDGETS
+    return dict(DEFAULT_BUDGETS.get(name, {}), **budgets.get(name, {}))
+
+
+def lock_dir():
+    return getattr(settings, 'ADMISSION_LOCK_DIR', None) or os.path.join(settings.DICOM_CACHE_ROOT, 'admission')
+
+
+def _try_lock(path):
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        try:
+            if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                return fd
+        except FileNotFoundError:
+            pass
+        # Файл удалили (release_slot), пока мы ждали блокировку - берем новый
+        os.close(fd)
+
+
+def acquire_slot(prefix, count, temporary=False):
+    """
+    Занимает любое свободное из count мест prefix.0 ... prefix.<count-1>.
+    Возвращает место (освобождать через release_slot) или None.
+    Файл временного места удаляется при освобождении, чтобы не копились
+    файлы мест пользователей.
+    """
+    slots = list(range(count))
+    # Случайный порядок: параллельные запросы не толкаются за первое место
+    random.shuffle(slots)
+    for slot in slots:
+        path = f"{prefix}.{slot}"
+        fd = _try_lock(path)
+        if fd is not None:
+            return fd, path if temporary else None
+    return None
+
+
+def release_slot(slot):
+    if slot is None:
+        return
+    fd, path = slot
+    if path is not None:
+        # Удаляется под блокировкой: ждущие этот файл возьмут новый
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+
+def detach_slots(request):
+    """
+    Забирает места запроса у middleware для фоновой задачи, которая
+    освобождает их сама (release_slots) по завершении.
+    """
+    request = getattr(request, '_request', request)
+    slots = getattr(request, '_admission_slots', None) or []
+    request._admission_slots = []
+    return slots
+
+
+def release_slots(slots):
+    for slot in slots:
+        release_slot(slot)
+
+
+def user_key(request):
+    # Пользователь из access-токена (без запроса к базе), иначе адрес клиента
+    header = request.META.get('HTTP_AUTHORIZATION', '').split()
+    if len(header) == 2 and header[0] in api_settings.AUTH_HEADER_TYPES:
+        raw = header[1]
+    else:
+        raw = request.COOKIES.get(settings.SIMPLE_JWT['AUTH_COOKIE'])
+    if raw:
+        try:
+            return f"user-{AccessToken(raw).get(api_settings.USER_ID_CLAIM)}"
+        except TokenError:
+            pass
+    return f"ip-{request.META.get('REMOTE_ADDR', '')}"
+
+
+def _rejected(status, message, retry_after):
+    response = JsonResponse({"error": message}, status=status, json_dumps_params={'ensure_ascii': False})
+    response['Retry-After'] = str(retry_after)
+    return response
+
+
+class AdmissionControlMiddleware:
+    """
+    Пропускает тяжелые запросы не больше бюджета класса на узел и на
+    пользователя, остальные ждут в ограниченной очереди или получают отказ.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        name = endpoint_class(request) if fcntl is not None else None
+        if name is None:
+            return self.get_response(request)
+        limits = budget(name)
+        directory = lock_dir()
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, name)
+        key = re.sub(r'[^A-Za-z0-9_.:-]', '_', user_key(request))
+
+        user_slot = acquire_slot(f"{base}.{key}", limits['per_user'], temporary=True)
+        if user_slot is None:
+            return _rejected(429, "Слишком много одновременных запросов, повторите позже", limits['retry_after'])
+        request._admission_slots = [user_slot]
+        try:
+            slot = acquire_slot(base, limits['concurrency'])
+            if slot is None:
+                slot = self._wait(base, limits)
+            if slot is None:
+                return _rejected(503, "Сервер перегружен, повторите позже", limits['retry_after'])
+            request._admission_slots.append(slot)
+            return self.get_response(request)
+        finally:
+            # Места, отданные фоновой задаче (detach_slots), уже не здесь
+            release_slots(request._admission_slots)
+
+    @staticmethod
+    def _wait(base, limits):
+        # Ожидание места в очереди из limits['queue'] мест, не дольше timeout
+        queue_slot = acquire_slot(f"{base}.queue", limits['queue'])
+        if queue_slot is None:
+            return None
+        try:
+            deadline = time.monotonic() + limits['timeout']
+            pause = POLL_MIN
+            while time.monotonic() < deadline:
+                time.sleep(pause)
+                slot = acquire_slot(base, limits['concurrency'])
+                if slot is not None:
+                    return slot
+                pause = min(pause * 2, POLL_MAX)
+            return None
+        finally:
+            release_slot(queue_slot)
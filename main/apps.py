@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class MainConfig(AppConfig):
     name = 'main'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        from .slices import check_codec
+        check_codec()
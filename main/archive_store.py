@@ -0,0 +1,247 @@
+# archive_store.py
+# Режим хранения DICOM_STORAGE_MODE = "archive": архив-блоб - единственная
+# копия снимков. Папка серии содержит только манифест (кодек CODEC_ARCHIVE)
+# с путем к архиву, а срезы читаются из zip по центральному каталогу.
+# Серии, которые активно просматривают, распаковываются в фоне в кэш
+# DICOM_CACHE_ROOT/extracted; при превышении квоты DICOM_EXTRACT_CACHE_QUOTA
+# удаляются давно не открывавшиеся.
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+import zipfile
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from .extraction import extract_archive, extraction_limits, plan_extraction
+from .slices import CODEC_ARCHIVE, CODEC_NONE, MANIFEST_NAME, read_manifest
+
+STORAGE_EXTRACTED = 'extracted'
+STORAGE_ARCHIVE = 'archive'
+COMPLETE_MARKER = '.complete'
+MAX_OPEN_ARCHIVES = 32
+# Незавершенные распаковки старше этого срока считаются брошенными
+STALE_TMP_SECONDS = 24 * 3600
+
+_lock = threading.Lock()
+_archives = OrderedDict()
+_manifests = OrderedDict()
+_hits = defaultdict(int)
+_pending = set()
+_executor = None
+
+
+def storage_mode():
+    mode = getattr(settings, 'DICOM_STORAGE_MODE', STORAGE_EXTRACTED) or STORAGE_EXTRACTED
+    if mode not in (STORAGE_EXTRACTED, STORAGE_ARCHIVE):
+        raise ValueError(f"Неизвестный режим хранения DICOM: {mode}")
+    return mode
+
+
+def cache_quota():
+    # 0 - кэш распаковки отключен, срезы всегда читаются из архива
+    return int(getattr(settings, 'DICOM_EXTRACT_CACHE_QUOTA', 0) or 0)
+
+
+def hot_hits():
+    return int(getattr(settings, 'DICOM_EXTRACT_CACHE_HITS', 20))
+
+
+def extracted_root():
+    return os.path.join(settings.DICOM_CACHE_ROOT, 'extracted')
+
+
+def extracted_dir(sha256):
+    return os.path.join(extracted_root(), sha256[:2], sha256)
+
+
+def write_archive_manifest(series_dir, sha256, archive_path, on_member=None):
+    """
+    Проверяет оглавление архива теми же лимитами, что и распаковка, и пишет
+    манифест серии без распаковки. Размер на диске у срезов нулевой -
+    байты лежат в архиве.
+    """
+    with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+        members = plan_extraction(zip_ref.infolist(), extraction_limits())
+    manifest = {
+        "codec": CODEC_ARCHIVE,
+        "files": {name: [info.file_size, 0] for info, name in members},
+        "sha256": sha256,
+        "archive": os.path.relpath(archive_path, settings.MEDIA_ROOT),
+        # Имена в архиве, если они отличаются от нормализованных
+        "members": {name: info.filename for info, name in members if info.filename != name},
+    }
+    with open(os.path.join(series_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f)
+    if on_member is not None:
+        on_member(len(members), len(members))
+
+
+def _cached_manifest(series_dir):
+    # Манифест серии не меняется после создания - держим последние в памяти
+    with _lock:
+        manifest = _manifests.get(series_dir)
+        if manifest is not None:
+            _manifests.move_to_end(series_dir)
+            return manifest
+    manifest = read_manifest(series_dir)
+    if manifest is None:
+        raise FileNotFoundError(os.path.join(series_dir, MANIFEST_NAME))
+    with _lock:
+        _manifests[series_dir] = manifest
+        while len(_manifests) > MAX_OPEN_ARCHIVES * 4:
+            _manifests.popitem(last=False)
+    return manifest
+
+
+def _open_archive(archive_path):
+    # Открытые ZipFile переиспользуются: центральный каталог читается один раз
+    with _lock:
+        archive = _archives.get(archive_path)
+        if archive is not None:
+            _archives.move_to_end(archive_path)
+            return archive
+    archive = zipfile.ZipFile(archive_path, 'r')
+    with _lock:
+        if archive_path in _archives:
+            archive.close()
+            return _archives[archive_path]
+        _archives[archive_path] = archive
+        while len(_archives) > MAX_OPEN_ARCHIVES:
+            # Уже открытые из архива срезы дочитаются: файл закроется после них
+            _archives.popitem(last=False)[1].close()
+    return archive
+
+
+def open_archive_slice(series_dir, relpath):
+    """
+    Срез из распакованного кэша, если серия там есть, иначе - из архива.
+    Частые обращения к серии ставят ее распаковку в очередь.
+    """
+    manifest = _cached_manifest(series_dir)
+    sha256 = manifest["sha256"]
+    archive_path = os.path.join(settings.MEDIA_ROOT, manifest["archive"])
+    cached = extracted_dir(sha256)
+    if cache_quota() and os.path.exists(os.path.join(cached, COMPLETE_MARKER)):
+        try:
+            f = open(os.path.join(cached, relpath), 'rb')
+        except FileNotFoundError:
+            # Серию только что вытеснили из кэша
+            pass
+        else:
+            _touch(cached)
+            return f
+    _note_hit(sha256, archive_path)
+    member = manifest.get("members", {}).get(relpath, relpath)
+    return _open_archive(archive_path).open(member)
+
+
+def _touch(path):
+    # Время последнего обращения - mtime маркера (atime часто отключен)
+    try:
+        os.utime(os.path.join(path, COMPLETE_MARKER))
+    except OSError:
+        pass
+
+
+def _note_hit(sha256, archive_path):
+    global _executor
+    if not cache_quota():
+        return
+    with _lock:
+        _hits[sha256] += 1
+        if _hits[sha256] < hot_hits() or sha256 in _pending:
+            return
+        _pending.add(sha256)
+        _hits.pop(sha256, None)
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='dicom-extract-cache')
+    _executor.submit(extract_to_cache, sha256, archive_path)
+
+
+def extract_to_cache(sha256, archive_path):
+    """
+    Распаковывает архив в кэш (без сжатия, чтобы отдавать срезы как есть)
+    и освобождает место по квоте. Возвращает путь к распакованной серии.
+    """
+    dest = extracted_dir(sha256)
+    try:
+        if os.path.exists(os.path.join(dest, COMPLETE_MARKER)):
+            return dest
+        tmp_path = f"{dest}.{uuid.uuid4().hex}.tmp"
+        os.makedirs(tmp_path)
+        try:
+            entries = extract_archive(archive_path, tmp_path, CODEC_NONE, 0)
+            with open(os.path.join(tmp_path, COMPLETE_MARKER), 'w') as f:
+                f.write(str(sum(size for size, _ in entries.values())))
+            os.rename(tmp_path, dest)
+        except OSError:
+            # Серию уже распаковал другой процесс
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        except Exception:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        evict(keep=sha256)
+        return dest
+    finally:
+        with _lock:
+            _pending.discard(sha256)
+
+
+def _cache_entries():
+    # (время обращения, размер, sha256) распакованных серий
+    entries = []
+    root = extracted_root()
+    if not os.path.isdir(root):
+        return entries
+    now = time.time()
+    for shard in os.listdir(root):
+        shard_path = os.path.join(root, shard)
+        for name in os.listdir(shard_path):
+            path = os.path.join(shard_path, name)
+            if name.endswith('.tmp'):
+                if now - os.path.getmtime(path) > STALE_TMP_SECONDS:
+                    shutil.rmtree(path, ignore_errors=True)
+                continue
+            marker = os.path.join(path, COMPLETE_MARKER)
+            try:
+                with open(marker) as f:
+                    size = int(f.read() or 0)
+                entries.append((os.path.getmtime(marker), size, name))
+            except (OSError, ValueError):
+                continue
+    return entries
+
+
+def evict(keep=None):
+    """
+    Удаляет давно не открывавшиеся серии, пока кэш не уложится в квоту.
+    Возвращает список удаленных sha256.
+    """
+    quota = cache_quota()
+    entries = sorted(_cache_entries())
+    total = sum(size for _, size, _ in entries)
+    removed = []
+    for _, size, sha256 in entries:
+        if total <= quota:
+            break
+        if sha256 == keep:
+            continue
+        drop_cached(sha256)
+        total -= size
+        removed.append(sha256)
+    return removed
+
+
+def drop_cached(sha256):
+    # Маркер удаляется первым, чтобы читатели сразу перешли на архив
+    path = extracted_dir(sha256)
+    try:
+        os.remove(os.path.join(path, COMPLETE_MARKER))
+    except OSError:
+        pass
+    shutil.rmtree(path, ignore_errors=True)
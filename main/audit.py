@@ -0,0 +1,312 @@
+# audit.py
+# Журнал доступа к данным пациентов: кто, когда и что сделал с пациентом
+# или приемом. AuditMiddleware сопоставляет запрос с AUDIT_RULES, а
+# представления без id в адресе вызывают record_request сами; событие при
+# этом только добавляется в буфер процесса, запрос в базу не ждет.
+# Фоновый поток пишет буфер в AuditEvent через bulk_create - при
+# AUDIT_BATCH_SIZE событиях или раз в AUDIT_FLUSH_INTERVAL секунд.
+# Если база недоступна и при остановке процесса события сбрасываются на
+# диск (AUDIT_SPILL_DIR, jsonl с fsync) и дописываются в базу потоком
+# записи при следующем удачном сбросе в любом процессе.
+import atexit
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DatabaseError, connections
+
+from .models import AuditEvent, MedicalCase
+
+VIEW, LIST, CREATE, UPDATE, UPLOAD = (
+    AuditEvent.Action.VIEW.value, AuditEvent.Action.LIST.value, AuditEvent.Action.CREATE.value,
+    AuditEvent.Action.UPDATE.value, AuditEvent.Action.UPLOAD.value,
+)
+
+# (методы, путь, действие, объект); id объекта - группа id пути,
+# а для создания - поле id ответа
+AUDIT_RULES = tuple((methods, re.compile(path), action, kind) for methods, path, action, kind in (
+    (('GET',), r'^/api/patients/$', LIST, None),
+    (('POST',), r'^/api/patients/create/$', CREATE, 'patient'),
+    (('PUT', 'PATCH'), r'^/api/patients/update/(?P<id>\d+)/$', UPDATE, 'patient'),
+    (('GET',), r'^/api/patients/(?P<id>\d+)/cases/$', VIEW, 'patient'),
+    (('GET',), r'^/api/cases/$', LIST, None),
+    (('POST',), r'^/api/cases/create/$', CREATE, 'case'),
+    (('PUT', 'PATCH'), r'^/api/cases/update/(?P<id>\d+)/$', UPDATE, 'case'),
+    (('POST',), r'^/api/cases/(?P<id>\d+)/upload-dicom/$', UPLOAD, 'case'),
+    (('GET',), r'^/api/cases/(?P<id>\d+)/(slices|bundle|dicom-index|panoramic|mesh)/', VIEW, 'case'),
+    (('GET',), r'^/api/sync/$', LIST, None),
+))
+_RULES_BY_METHOD = {
+    method: [(pattern, action, kind) for methods, pattern, action, kind in AUDIT_RULES if method in methods]
+    for method in {method for methods, _, _, _ in AUDIT_RULES for method in methods}
+}
+# Быстрая проверка до разбора правил: остальные запросы не журналируются
+AUDIT_PREFIXES = ('/api/patients/', '/api/cases/', '/api/sync/')
+# Сколько последних просмотров помнить для отбрасывания повторов
+# (например, запросов каждого среза серии)
+MAX_RECENT = 10000
+# Файл, захваченный на дозапись процессом, который затем упал
+STALE_CLAIM_SECONDS = 3600
+# Сколько ждать текущую запись в базу при остановке процесса (сек)
+SHUTDOWN_WAIT = 5
+
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_wake = threading.Event()
+_buffer = []
+_recent = {}
+_thread = None
+_pid = None
+# (AUDIT_ENABLED, AUDIT_BATCH_SIZE, AUDIT_DEDUP_SECONDS) читаются один раз
+# на процесс: обращение к settings заметно дороже остальной работы record
+_config = (False, 500, 0)
+
+
+def enabled():
+    return getattr(settings, 'AUDIT_ENABLED', True)
+
+
+def batch_size():
+    return getattr(settings, 'AUDIT_BATCH_SIZE', 500)
+
+
+def flush_interval():
+    return getattr(settings, 'AUDIT_FLUSH_INTERVAL', 2.0)
+
+
+def dedup_seconds():
+    return getattr(settings, 'AUDIT_DEDUP_SECONDS', 0)
+
+
+def spill_dir():
+    return getattr(settings, 'AUDIT_SPILL_DIR', None) or os.path.join(settings.BASE_DIR, 'audit_spill')
+
+
+def match_rule(request):
+    # (действие, объект, id из пути) или None
+    if not request.path.startswith(AUDIT_PREFIXES):
+        return None
+    for pattern, action, kind in _RULES_BY_METHOD.get(request.method, ()):
+        match = pattern.match(request.path)
+        if match is not None:
+            object_id = match.groupdict().get('id')
+            return action, kind, int(object_id) if object_id is not None else None
+    return None
+
+
+def record(action, user_id=None, user_email='', patient_id=None, case_id=None, method='', path='',
+           status_code=None, ip=None):
+    """
+    Добавляет событие в буфер процесса. Если задан AUDIT_DEDUP_SECONDS,
+    повторные просмотры того же объекта тем же пользователем в пределах
+    этого срока отбрасываются; по умолчанию пишется каждый просмотр.
+    """
+    if _pid != os.getpid():
+        _start()
+    if not _config[0]:
+        return
+    now = time.time()
+    if action == VIEW and _config[2] > 0:
+        key = (user_id, patient_id, case_id)
+        with _lock:
+            if now - _recent.get(key, 0) < _config[2]:
+                return
+            if len(_recent) >= MAX_RECENT:
+                _recent.clear()
+            _recent[key] = now
+    event = (now, user_id, user_email, action, patient_id, case_id, method, path[:255], status_code, ip)
+    with _lock:
+        _buffer.append(event)
+        full = len(_buffer) >= _config[1]
+    if full:
+        _wake.set()
+
+
+def record_request(request, action, patient_id=None, case_id=None, status_code=None):
+    # Событие от имени пользователя запроса; анонимные запросы не пишутся
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        return
+    record(
+        action, user.pk, getattr(user, 'email', '') or '', patient_id, case_id, request.method,
+        request.path, status_code, request.META.get('REMOTE_ADDR') or None,
+    )
+
+
+class AuditMiddleware:
+    """
+    Отмечает обращения к пациентам и приемам по AUDIT_RULES. Пользователь
+    берется после ответа: аутентификация по токену выполняется в DRF.
+    """
+
+    def __init__(self, get_response):
+        if not enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        rule = match_rule(request)
+        if rule is not None:
+            action, kind, object_id = rule
+            if object_id is None and kind is not None:
+                data = getattr(response, 'data', None)
+                object_id = data.get('id') if isinstance(data, dict) else None
+            ids = {f"{kind}_id": object_id} if kind is not None else {}
+            record_request(request, action, status_code=response.status_code, **ids)
+        return response
+
+
+def _start():
+    global _thread, _pid, _config
+    with _lock:
+        if _pid == os.getpid():
+            return
+        _config = (enabled(), batch_size(), dedup_seconds())
+        _pid = os.getpid()
+        if not _config[0]:
+            return
+        _thread = threading.Thread(target=_run, name='audit-flush', daemon=True)
+        _thread.start()
+
+
+def _run():
+    replay_spilled()
+    while True:
+        _wake.wait(flush_interval())
+        _wake.clear()
+        try:
+            if flush():
+                replay_spilled()
+        finally:
+            # Соединения потока не закрываются сигналами запроса
+            connections.close_all()
+
+
+def _write(events):
+    # У событий по приему пациент определяется здесь, а не в запросе
+    case_ids = {e[5] for e in events if e[5] is not None and e[4] is None}
+    patients = dict(MedicalCase.objects.filter(id__in=case_ids).values_list('id', 'patient_id')) if case_ids else {}
+    AuditEvent.objects.bulk_create([
+        AuditEvent(
+            created_at=datetime.fromtimestamp(ts, dt_timezone.utc), user_id=user_id, user_email=user_email,
+            action=action, patient_id=patient_id if patient_id is not None else patients.get(case_id),
+            case_id=case_id, method=method, path=path, status_code=status_code, ip=ip,
+        )
+        for ts, user_id, user_email, action, patient_id, case_id, method, path, status_code, ip in events
+    ], batch_size=batch_size())
+
+
+def _take():
+    with _lock:
+        events = _buffer[:]
+        del _buffer[:]
+    return events
+
+
+def flush():
+    """
+    Пишет буфер в базу. Если база недоступна, события уходят на диск.
+    Возвращает количество записанных в базу событий.
+    """
+    with _flush_lock:
+        events = _take()
+        if not events:
+            return 0
+        try:
+            _write(events)
+        except DatabaseError:
+            spill(events)
+            return 0
+        return len(events)
+
+
+def spill(events):
+    # Файл появляется под итоговым именем только целиком и после fsync
+    directory = spill_dir()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"audit-{os.getpid()}-{uuid.uuid4().hex}.jsonl")
+    with open(f"{path}.tmp", 'w') as f:
+        for event in events:
+            f.write(json.dumps(event) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(f"{path}.tmp", path)
+    return path
+
+
+def _claimable(directory):
+    now = time.time()
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if name.endswith('.jsonl'):
+            yield path
+        elif name.endswith('.claimed'):
+            try:
+                if now - os.path.getmtime(path) > STALE_CLAIM_SECONDS:
+                    yield path
+            except OSError:
+                continue
+
+
+def replay_spilled():
+    """
+    Дописывает в базу события, сброшенные на диск. Файл сначала
+    переименовывается, поэтому его дописывает только один процесс.
+    Возвращает количество записанных событий.
+    """
+    directory = spill_dir()
+    if not os.path.isdir(directory):
+        return 0
+    written = 0
+    for path in _claimable(directory):
+        base = path[:path.index('.jsonl') + len('.jsonl')]
+        claimed = f"{base}.{os.getpid()}.{uuid.uuid4().hex[:8]}.claimed"
+        try:
+            os.rename(path, claimed)
+            os.utime(claimed)
+            with open(claimed) as f:
+                events = [tuple(json.loads(line)) for line in f if line.strip()]
+        except OSError:
+            continue
+        try:
+            _write(events)
+        except DatabaseError:
+            os.rename(claimed, base)
+            break
+        os.remove(claimed)
+        written += len(events)
+    return written
+
+
+def shutdown():
+    # При остановке процесса база может быть уже недоступна - буфер на диск.
+    # Поток записи - демон: ждем, пока он допишет уже взятую пачку
+    acquired = _flush_lock.acquire(timeout=SHUTDOWN_WAIT)
+    try:
+        events = _take()
+        if events:
+            spill(events)
+    finally:
+        if acquired:
+            _flush_lock.release()
+
+
+def _after_fork():
+    # Дочерний процесс (пул обработки) не наследует чужие события и поток записи
+    global _lock, _flush_lock, _thread, _pid
+    _lock, _flush_lock = threading.Lock(), threading.Lock()
+    _thread, _pid = None, None
+    del _buffer[:]
+    _recent.clear()
+
+
+atexit.register(shutdown)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
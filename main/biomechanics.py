@@ -0,0 +1,66 @@
+# biomechanics.py
+# Оценка напряжения на границе кость-имплант и запаса прочности сразу для
+# всей библиотеки. Параметры вариантов собираются в массивы один раз,
+# расчет и ранжирование - несколько векторных операций NumPy.
+#
+# Модель: нагрузка F (кгс) передается на кость через поверхность резьбы,
+# из которой в контакте с костью только доля BIC (bone-implant contact),
+# зависящая от плотности кости. Напряжение sigma = F / (S * BIC) (кг/мм2),
+# запас прочности n = limit_stress / sigma.
+import numpy as np
+
+# Плотность (HU), при которой контакт считается полным (кость D1 по Мишу)
+FULL_CONTACT_HU = 1250.0
+MIN_CONTACT = 0.2
+# Вклад геометрии резьбы: глубокая резьба с малым шагом лучше передает нагрузку
+THREAD_GAIN = 0.5
+
+
+def _to_float(value):
+    try:
+        return float(str(value).replace(',', '.'))
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def library_arrays(rows):
+    # Столбцы библиотеки как массивы float64 (thread_depth хранится строкой)
+    columns = ('diameter', 'length', 'thread_pitch', 'thread_depth', 'hu_density',
+               'chewing_load', 'limit_stress', 'surface_area')
+    arrays = {name: np.array([_to_float(row[name]) for row in rows]) for name in columns}
+    arrays['id'] = np.array([row['id'] for row in rows])
+    return arrays
+
+
+def bone_contact(bone_hu):
+    return np.clip(np.asarray(bone_hu, dtype=np.float64) / FULL_CONTACT_HU, MIN_CONTACT, 1.0)
+
+
+def evaluate(arrays, load, bone_hu):
+    """
+    Напряжение и запас прочности для каждого варианта.
+    load и bone_hu - число или массив по вариантам.
+    """
+    pitch, depth = arrays['thread_pitch'], arrays['thread_depth']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        thread = 1.0 + THREAD_GAIN * np.nan_to_num(depth / pitch, nan=0.0, posinf=0.0)
+        contact = bone_contact(bone_hu)
+        area = arrays['surface_area'] * contact * thread
+        stress = np.asarray(load, dtype=np.float64) / area
+        safety = arrays['limit_stress'] / stress
+    return {"contact": contact * np.ones_like(stress), "stress": stress, "safety_factor": safety}
+
+
+def rank(safety_factor, min_safety, density_error=None, valid=None):
+    """
+    Индексы вариантов от лучшего к худшему: сначала прошедшие порог
+    запаса прочности, затем по близости расчетной плотности к измеренной,
+    затем по запасу прочности.
+    """
+    safety = np.nan_to_num(safety_factor, nan=-np.inf)
+    passed = safety >= min_safety
+    if valid is not None:
+        passed &= valid
+    error = np.zeros_like(safety) if density_error is None else np.nan_to_num(density_error, nan=np.inf)
+    # lexsort: последний ключ - главный
+    return np.lexsort((-safety, error, ~passed))
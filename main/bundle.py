@@ -0,0 +1,449 @@
+# bundle.py
+# Серия приема (или диапазон ее срезов) одним ответом tar или zip вместо
+# отдельного запроса на каждый срез. Архив собирается на лету из хранимых
+# файлов серии, без временных копий. Раскладка байтов детерминирована: имена
+# и порядок срезов, размеры из манифеста и фиксированное время файлов, поэтому
+# длина известна до начала отдачи, а докачка по Range читает только те
+# срезы, которые попали в запрошенный диапазон.
+# zip бывает без сжатия (stored) или с deflate. У серий со сжатием zlib поток
+# deflate берется из файла среза как есть (без двух байт заголовка и adler32
+# в конце), так что сжатие ничего не стоит и длина тоже известна. Для других
+# серий deflate считается при отдаче: длина заранее неизвестна, Range нет.
+# CRC32 срезов для дескрипторов и каталога zip считаются при отдаче и
+# кэшируются (FRAGMENT_CACHE_ALIAS), чтобы докачка хвоста не перечитывала
+# всю серию.
+# Под ASGI ответ отдается асинхронным итератором: синхронный Django 4.2
+# вычитал бы в память весь архив до отправки первого байта.
+import hashlib
+import re
+import struct
+import tarfile
+import time
+import zlib
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, StreamingHttpResponse
+
+from .dicom_storage import case_codec, case_dicom_dir, case_slices
+from .fragments import fragment_cache, fragment_timeout
+from .slices import CHUNK_SIZE, CODEC_ZLIB, open_slice, open_stored, read_manifest
+
+FORMAT_TAR = 'tar'
+FORMAT_ZIP = 'zip'
+COMPRESSION_NONE = 'none'
+COMPRESSION_DEFLATE = 'deflate'
+CONTENT_TYPES = {
+    FORMAT_TAR: 'application/x-tar',
+    FORMAT_ZIP: 'application/zip',
+}
+# Меняется вместе с раскладкой байтов: входит в ETag
+LAYOUT_VERSION = 1
+# Сжатие на лету - ради скорости отдачи, а не степени сжатия
+STREAM_DEFLATE_LEVEL = 1
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_MAX_ENTRIES = 0xFFFF
+# Заголовок и adler32 потока zlib вокруг данных deflate
+ZLIB_HEADER, ZLIB_TRAILER = 2, 4
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+_PART_BYTES, _PART_SLICE, _PART_LAZY = 0, 1, 2
+
+
+def bundle_params(data):
+    # Канонические параметры: формат, сжатие (None - по серии) и диапазон срезов
+    params = {
+        "fmt": data.get('bundle_format') or FORMAT_TAR,
+        "compression": data.get('compression') or None,
+        "start": 0,
+        "stop": None,
+    }
+    if params["fmt"] not in CONTENT_TYPES:
+        raise ValueError("bundle_format: допустимо tar или zip")
+    if params["compression"] not in (None, COMPRESSION_NONE, COMPRESSION_DEFLATE):
+        raise ValueError("compression: допустимо none или deflate")
+    if params["fmt"] == FORMAT_TAR and params["compression"] == COMPRESSION_DEFLATE:
+        raise ValueError("compression=deflate поддерживается только для zip")
+    try:
+        if data.get('start'):
+            params["start"] = int(data['start'])
+        if data.get('stop'):
+            params["stop"] = int(data['stop'])
+    except ValueError:
+        raise ValueError("start и stop: ожидаются целые числа")
+    if params["start"] < 0 or (params["stop"] is not None and params["stop"] <= params["start"]):
+        raise ValueError("start и stop: ожидается 0 <= start < stop")
+    return params
+
+
+def _dos_datetime(mtime):
+    # (время, дата) в формате MS-DOS; zip не хранит даты раньше 1980 года
+    t = time.gmtime(max(mtime, 315532800))
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+
+class _Member:
+    __slots__ = ('name', 'encoded', 'size', 'data_size', 'deflated', 'offset')
+
+    def __init__(self, name, size, data_size, deflated):
+        self.name = name
+        self.encoded = name.encode('utf-8')
+        # Исходный размер среза и размер его данных в архиве
+        self.size = size
+        self.data_size = data_size
+        self.deflated = deflated
+        self.offset = 0
+
+
+class Bundle:
+    """
+    Раскладка архива - список частей (длина, вид, содержимое): готовые байты,
+    данные среза или функция, которая строит байты, когда до них дошла
+    отдача (дескрипторы и каталог zip, которым нужны CRC срезов).
+    length и etag - None, если длина заранее неизвестна (deflate на лету).
+    """
+
+    def __init__(self, fmt, compression, series_dir, codec, slices, mtime, stored_sizes=None, crc_key=None):
+        self.fmt = fmt
+        self.compression = compression
+        self.series_dir = series_dir
+        self.codec = codec
+        self.mtime = int(mtime)
+        self.crc_key = crc_key
+        self.crcs = {}
+        self._new_crcs = False
+        self.parts = []
+        self.length = None
+        self.etag = None
+        stored_sizes = stored_sizes or {}
+        # deflate без пересжатия - только из срезов zlib
+        reuse = compression == COMPRESSION_DEFLATE and codec == CODEC_ZLIB
+        self.streamed = compression == COMPRESSION_DEFLATE and not reuse
+        self.members = [
+            _Member(name, size, stored_sizes[name] - ZLIB_HEADER - ZLIB_TRAILER if reuse else size, reuse)
+            for name, size in slices
+        ]
+        # Размеры в записях zip - 32-битные: такой срез отклоняется до отдачи
+        # заголовков, а не посреди ответа. Размер deflate на лету известен
+        # только после сжатия, поэтому берется его верхняя граница
+        if fmt == FORMAT_ZIP and any(
+            max(m.size, _deflate_bound(m.size) if self.streamed else m.data_size) >= ZIP64_LIMIT
+            for m in self.members
+        ):
+            raise ValueError("Срез больше 4 ГБ: используйте bundle_format=tar")
+        if self.streamed:
+            return
+        if fmt == FORMAT_TAR:
+            self._layout_tar()
+        else:
+            self._layout_zip()
+        self.length = sum(part[0] for part in self.parts)
+        layout = hashlib.sha256(f"{LAYOUT_VERSION}|{fmt}|{compression}|{series_dir}|{codec}|{self.mtime}".encode())
+        for m in self.members:
+            layout.update(f"|{m.name}:{m.size}:{m.data_size}".encode())
+        self.etag = f'"{layout.hexdigest()[:32]}"'
+
+    # Раскладка
+
+    def _layout_tar(self):
+        for m in self.members:
+            info = tarfile.TarInfo(m.name)
+            info.size, info.mtime, info.mode = m.size, self.mtime, 0o644
+            header = info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+            self.parts.append((len(header), _PART_BYTES, header))
+            self.parts.append((m.size, _PART_SLICE, m))
+            if m.size % tarfile.BLOCKSIZE:
+                padding = tarfile.BLOCKSIZE - m.size % tarfile.BLOCKSIZE
+                self.parts.append((padding, _PART_BYTES, bytes(padding)))
+        end = bytes(2 * tarfile.BLOCKSIZE)
+        self.parts.append((len(end), _PART_BYTES, end))
+
+    def _layout_zip(self):
+        offset = 0
+        for m in self.members:
+            m.offset = offset
+            header = self._local_header(m)
+            self.parts.append((len(header), _PART_BYTES, header))
+            self.parts.append((m.data_size, _PART_SLICE, m))
+            self.parts.append((16, _PART_LAZY, lambda m=m: self._descriptor(m, self.crc(m), m.data_size)))
+            offset += len(header) + m.data_size + 16
+        directory_size = sum(46 + len(m.encoded) + (12 if m.offset >= ZIP64_LIMIT else 0) for m in self.members)
+        tail = directory_size + self._end_size(offset, directory_size, len(self.members))
+        self.parts.append((tail, _PART_LAZY, lambda: self._directory(
+            [(m, self.crc(m), m.data_size) for m in self.members], offset
+        )))
+
+    # Записи zip
+
+    def _flags(self, m):
+        # 0x08 - CRC и размеры в дескрипторе после данных, 0x800 - имя в UTF-8
+        return 0x08 | (0 if m.name.isascii() else 0x800)
+
+    def _local_header(self, m):
+        dos_time, dos_date = _dos_datetime(self.mtime)
+        return struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, 20, self._flags(m), 8 if m.deflated else 0, dos_time, dos_date,
+            0, 0, 0, len(m.encoded), 0,
+        ) + m.encoded
+
+    @staticmethod
+    def _descriptor(m, crc, data_size):
+        return struct.pack('<IIII', 0x08074b50, crc, data_size, m.size)
+
+    @staticmethod
+    def _zip64_end(directory_offset, directory_size, count):
+        # Запись zip64 в конце архива нужна, если поля обычной переполнены
+        return directory_offset >= ZIP64_LIMIT or directory_size >= ZIP64_LIMIT or count >= ZIP_MAX_ENTRIES
+
+    @classmethod
+    def _end_size(cls, directory_offset, directory_size, count):
+        return 22 + (56 + 20 if cls._zip64_end(directory_offset, directory_size, count) else 0)
+
+    def _directory(self, entries, directory_offset):
+        # Центральный каталог и конец архива; entries - (срез, CRC, размер данных)
+        dos_time, dos_date = _dos_datetime(self.mtime)
+        records = []
+        for m, crc, data_size in entries:
+            zip64 = m.offset >= ZIP64_LIMIT
+            extra = struct.pack('<HHQ', 0x0001, 8, m.offset) if zip64 else b''
+            records.append(struct.pack(
+                '<IHHHHHHIIIHHHHHII', 0x02014b50, 45 if zip64 else 20, 45 if zip64 else 20, self._flags(m),
+                8 if m.deflated else 0, dos_time, dos_date, crc, data_size, m.size, len(m.encoded),
+                len(extra), 0, 0, 0, 0o100644 << 16, ZIP64_LIMIT if zip64 else m.offset,
+            ) + m.encoded + extra)
+        directory = b''.join(records)
+        count = len(entries)
+        tail = []
+        if self._zip64_end(directory_offset, len(directory), count):
+            end64_offset = directory_offset + len(directory)
+            tail.append(struct.pack(
+                '<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count, len(directory), directory_offset
+            ))
+            tail.append(struct.pack('<IIQI', 0x07064b50, 0, end64_offset, 1))
+        tail.append(struct.pack(
+            '<IHHHHIIH', 0x06054b50, 0, 0, min(count, ZIP_MAX_ENTRIES), min(count, ZIP_MAX_ENTRIES),
+            min(len(directory), ZIP64_LIMIT), min(directory_offset, ZIP64_LIMIT), 0,
+        ))
+        return directory + b''.join(tail)
+
+    # Чтение срезов
+
+    def _open(self, m):
+        if m.deflated:
+            f = open_stored(self.series_dir, m.name, self.codec)
+            _skip(f, ZLIB_HEADER)
+            return f
+        return open_slice(self.series_dir, m.name, self.codec)
+
+    def _slice_chunks(self, m, skip, length):
+        # Данные среза [skip, skip + length); CRC считается, если срез читается целиком
+        whole = skip == 0 and length == m.data_size and self.fmt == FORMAT_ZIP and m.name not in self.crcs
+        crc = 0
+        inflater = zlib.decompressobj(-zlib.MAX_WBITS) if whole and m.deflated else None
+        with self._open(m) as f:
+            if skip:
+                _skip(f, skip)
+            remaining = length
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise OSError(f"Срез короче, чем в манифесте: {m.name}")
+                remaining -= len(chunk)
+                if whole:
+                    crc = zlib.crc32(inflater.decompress(chunk) if inflater else chunk, crc)
+                yield chunk
+        if whole:
+            self._remember(m, crc)
+
+    def _remember(self, m, crc):
+        self.crcs[m.name] = crc
+        self._new_crcs = True
+
+    def crc(self, m):
+        if m.name not in self.crcs:
+            crc = 0
+            with open_slice(self.series_dir, m.name, self.codec) as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    crc = zlib.crc32(chunk, crc)
+            self._remember(m, crc)
+        return self.crcs[m.name]
+
+    def _load_crcs(self):
+        if self.fmt == FORMAT_ZIP and self.crc_key is not None:
+            self.crcs = dict(fragment_cache().get(self.crc_key) or {})
+
+    def _save_crcs(self):
+        if self._new_crcs and self.crc_key is not None:
+            cache = fragment_cache()
+            crcs = dict(cache.get(self.crc_key) or {}, **self.crcs)
+            cache.set(self.crc_key, crcs, fragment_timeout())
+            self._new_crcs = False
+
+    # Отдача
+
+    def iter_bytes(self, start=0, end=None):
+        """Байты архива [start, end); для архива с deflate на лету - только целиком."""
+        self._load_crcs()
+        try:
+            if self.streamed:
+                yield from self._iter_deflating()
+                return
+            end = self.length if end is None else end
+            offset = 0
+            for length, kind, payload in self.parts:
+                part_end = offset + length
+                if part_end > start and offset < end:
+                    lo, hi = max(start, offset) - offset, min(end, part_end) - offset
+                    if kind == _PART_SLICE:
+                        yield from self._slice_chunks(payload, lo, hi - lo)
+                    else:
+                        data = payload if kind == _PART_BYTES else payload()
+                        yield data[lo:hi]
+                offset = part_end
+                if offset >= end:
+                    break
+        finally:
+            self._save_crcs()
+
+    def _iter_deflating(self):
+        offset = 0
+        entries = []
+        for m in self.members:
+            m.deflated, m.offset = True, offset
+            header = self._local_header(m)
+            yield header
+            compressor = zlib.compressobj(STREAM_DEFLATE_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+            crc, written = 0, 0
+            with open_slice(self.series_dir, m.name, self.codec) as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    crc = zlib.crc32(chunk, crc)
+                    data = compressor.compress(chunk)
+                    if data:
+                        written += len(data)
+                        yield data
+            data = compressor.flush()
+            written += len(data)
+            yield data
+            yield self._descriptor(m, crc, written)
+            self._remember(m, crc)
+            entries.append((m, crc, written))
+            offset += len(header) + written + 16
+        yield self._directory(entries, offset)
+
+
+def _deflate_bound(size):
+    # Наибольший размер данных deflate для size байт (deflateBound из zlib)
+    return size + (size >> 12) + (size >> 14) + (size >> 25) + 13
+
+
+def _skip(f, count):
+    seekable = getattr(f, 'seekable', None)
+    if seekable is not None and seekable():
+        f.seek(count, 1)
+        return
+    while count > 0:
+        chunk = f.read(min(CHUNK_SIZE, count))
+        if not chunk:
+            break
+        count -= len(chunk)
+
+
+def case_bundle(case, fmt=FORMAT_TAR, compression=None, start=0, stop=None):
+    """
+    Архив срезов приема в порядке просмотра, срезы [start, stop).
+    compression=None: deflate для серий zlib (бесплатно), иначе без сжатия.
+    """
+    series = case.dicom_series if case.dicom_series_id else None
+    codec = case_codec(case)
+    series_dir = case_dicom_dir(case)
+    slices = case_slices(case)[start:stop]
+    if not slices:
+        raise ValueError("В выбранном диапазоне нет срезов")
+    if compression is None:
+        compression = COMPRESSION_DEFLATE if fmt == FORMAT_ZIP and codec == CODEC_ZLIB else COMPRESSION_NONE
+    stored_sizes = None
+    if compression == COMPRESSION_DEFLATE and codec == CODEC_ZLIB:
+        stored_sizes = {name: sizes[1] for name, sizes in read_manifest(series_dir)["files"].items()}
+    created = series.extracted_at if series is not None else case.created_at
+    return Bundle(
+        fmt, compression, series_dir, codec, slices, created.timestamp(), stored_sizes,
+        crc_key=f"bundle:crc:{series.pk}:{series.path}" if series is not None else None,
+    )
+
+
+def parse_range(header, length):
+    """
+    (начало, конец) из заголовка Range или None - отдать целиком.
+    Несколько диапазонов не поддерживаются и тоже дают ответ целиком.
+    Для недостижимого диапазона - ValueError.
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        start, end = max(length - int(last), 0), length
+    else:
+        start = int(first)
+        end = min(int(last) + 1, length) if last else length
+    if start >= length or start >= end:
+        raise ValueError("Диапазон за пределами архива")
+    return start, end
+
+
+async def _async_chunks(chunks):
+    # Каждый кусок читается в потоке запроса (файлы срезов, кэш CRC)
+    next_chunk = sync_to_async(next)
+    try:
+        while True:
+            chunk = await next_chunk(chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        await sync_to_async(chunks.close)()
+
+
+def _streaming_response(request, chunks, **kwargs):
+    if isinstance(getattr(request, '_request', request), ASGIRequest):
+        chunks = _async_chunks(chunks)
+    return StreamingHttpResponse(chunks, **kwargs)
+
+
+def bundle_response(request, bundle, filename):
+    # Ответ 200, 206, 304 или 416; у архива с deflate на лету - только 200
+    if bundle.streamed:
+        response = _streaming_response(request, bundle.iter_bytes(), content_type=CONTENT_TYPES[bundle.fmt])
+        response['Accept-Ranges'] = 'none'
+    else:
+        if request.META.get('HTTP_IF_NONE_MATCH') == bundle.etag:
+            response = HttpResponse(status=304)
+            response['ETag'] = bundle.etag
+            return response
+        byte_range = None
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if if_range is None or if_range == bundle.etag:
+            try:
+                byte_range = parse_range(request.META.get('HTTP_RANGE'), bundle.length)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = f"bytes */{bundle.length}"
+                return response
+        if byte_range is None:
+            response = _streaming_response(request, bundle.iter_bytes(), content_type=CONTENT_TYPES[bundle.fmt])
+            response['Content-Length'] = bundle.length
+        else:
+            start, end = byte_range
+            response = _streaming_response(
+                request, bundle.iter_bytes(start, end), status=206, content_type=CONTENT_TYPES[bundle.fmt]
+            )
+            response['Content-Range'] = f"bytes {start}-{end - 1}/{bundle.length}"
+            response['Content-Length'] = end - start
+        response['Accept-Ranges'] = 'bytes'
+        response['ETag'] = bundle.etag
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
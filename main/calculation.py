@@ -0,0 +1,191 @@
+# calculation.py
+# Подбор импланта по серии DICOM с мемоизацией результата.
+# Ключ кэша - хеш архива, параметры анализа и версия библиотеки имплантов,
+# поэтому повторный расчет того же архива отдается сразу из CalculationResult.
+import hashlib
+import json
+
+import numpy as np
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from .biomechanics import evaluate, library_arrays, rank
+from .density import sample_cylinders
+from .models import CalculationResult, ImplantLibrary
+from .volume import load_volume
+
+# Параметры анализа, которые клиент может передать вместе с архивом:
+# точка входа импланта (x, y, z) в вокселях и направление оси (x, y, z)
+VECTOR_PARAMS = ('implant_position', 'implant_axis')
+# Нагрузка на имплант (кгс) и плотность кости (HU), если известны заранее
+SCALAR_PARAMS = ('chewing_load', 'bone_hu')
+DEFAULT_AXIS = [0.0, 0.0, 1.0]
+# Доля точек цилиндра, которая должна попасть в объем
+MIN_COVERAGE = 0.9
+
+LIBRARY_FIELDS = (
+    'id', 'name', 'diameter', 'length', 'thread_shape', 'thread_pitch', 'thread_depth',
+    'bone_type', 'hu_density', 'chewing_load', 'limit_stress', 'surface_area',
+)
+
+
+def _vector(value, name):
+    if isinstance(value, str):
+        value = value.split(',')
+    try:
+        vector = [float(x) for x in value]
+    except (TypeError, ValueError):
+        vector = []
+    if len(vector) != 3:
+        raise ValueError(f"{name}: ожидается три числа через запятую")
+    return vector
+
+
+def analysis_params(data):
+    # Приводим параметры к каноническому виду, чтобы ключ кэша не зависел от записи
+    params = {}
+    for name in VECTOR_PARAMS:
+        value = data.get(name)
+        if value not in (None, ''):
+            params[name] = _vector(value, name)
+    for name in SCALAR_PARAMS:
+        value = data.get(name)
+        if value not in (None, ''):
+            try:
+                params[name] = float(str(value).replace(',', '.'))
+            except ValueError:
+                raise ValueError(f"{name}: ожидается число")
+            if not np.isfinite(params[name]):
+                raise ValueError(f"{name}: ожидается конечное число")
+    if params.get('chewing_load', 1) <= 0:
+        raise ValueError("chewing_load: ожидается положительное число")
+    if 'implant_axis' in params and 'implant_position' not in params:
+        raise ValueError("implant_axis задается только вместе с implant_position")
+    return params
+
+
+def library_rows():
+    # Библиотека в виде простых словарей, их можно передать в дочерний процесс
+    return list(ImplantLibrary.objects.order_by('id').values(*LIBRARY_FIELDS))
+
+
+def library_version(rows=None):
+    # Хеш содержимого библиотеки: любое изменение варианта дает новую версию
+    rows = library_rows() if rows is None else rows
+    return hashlib.sha256(json.dumps(rows, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def min_safety_factor():
+    return float(getattr(settings, 'IMPLANT_MIN_SAFETY_FACTOR', 1.5))
+
+
+def cache_key(archive_sha256, params, version):
+    # Порог запаса прочности влияет на выбор, поэтому тоже входит в ключ
+    payload = json.dumps([archive_sha256, params, version, min_safety_factor()], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _json_float(value):
+    # NaN и бесконечность (нулевая нагрузка или площадь) не допускаются в JSON
+    return round(float(value), 4) if np.isfinite(value) else None
+
+
+def _json_floats(values):
+    return [_json_float(v) for v in values]
+
+
+def density_outputs(sha256, series_dir, codec, rows, params, index=None):
+    # Плотность кости вдоль оси для всех вариантов одним проходом
+    volume, spacing = load_volume(sha256, series_dir, codec, index)
+    sampled = sample_cylinders(
+        volume, spacing,
+        params['implant_position'], params.get('implant_axis', DEFAULT_AXIS),
+        [row['diameter'] for row in rows], [row['length'] for row in rows],
+    )
+    summary = sampled["summary"]
+    density = {}
+    for i, row in enumerate(rows):
+        density[str(row['id'])] = {
+            **{key: _json_float(values[i]) for key, values in summary.items()},
+            "depths": _json_floats(sampled["depths"][i]),
+            "profile": _json_floats(sampled["profile"][i]),
+        }
+    return density
+
+
+def run_calculation(sha256, series_dir, codec, rows, params, index=None):
+    """
+    Собственно расчет, без обращений к базе. Возвращает (id варианта, результаты).
+
+    Плотность кости берется из выборки вдоль оси (если задана точка установки),
+    из параметра bone_hu или, без данных о кости, из hu_density самого варианта.
+    Для всей библиотеки считается напряжение на границе кость-имплант и запас
+    прочности, затем варианты ранжируются: прошедшие порог запаса, близость
+    hu_density к плотности кости, величина запаса. index - строки индекса
+    заголовков серии для сборки объема, если уже прочитаны.
+    """
+    arrays = library_arrays(rows)
+    outputs = {}
+    valid = None
+    if 'implant_position' in params:
+        density = density_outputs(sha256, series_dir, codec, rows, params, index)
+        outputs["density"] = density
+        bone_hu = np.array([density[str(i)]["mean"] for i in arrays['id']], dtype=np.float64)
+        coverage = np.array([density[str(i)]["coverage"] or 0 for i in arrays['id']], dtype=np.float64)
+        valid = (coverage >= MIN_COVERAGE) & ~np.isnan(bone_hu)
+        if not valid.any():
+            raise ValueError("Цилиндр импланта выходит за пределы объема")
+    elif 'bone_hu' in params:
+        bone_hu = np.full(len(rows), params['bone_hu'])
+    else:
+        bone_hu = arrays['hu_density']
+
+    load = np.broadcast_to(np.asarray(params.get('chewing_load', arrays['chewing_load']), dtype=np.float64),
+                           bone_hu.shape)
+    evaluation = evaluate(arrays, load, bone_hu)
+    order = rank(
+        evaluation["safety_factor"],
+        min_safety_factor(),
+        density_error=np.abs(bone_hu - arrays['hu_density']),
+        valid=valid,
+    )
+
+    columns = dict(evaluation, bone_hu=bone_hu, load=load)
+    outputs["biomechanics"] = {
+        str(variant_id): {key: _json_float(values[i]) for key, values in columns.items()}
+        for i, variant_id in enumerate(arrays['id'])
+    }
+    outputs["ranking"] = [int(arrays['id'][i]) for i in order]
+    return int(arrays['id'][order[0]]), outputs
+
+
+def cached_result(archive_sha256, params, version):
+    key = cache_key(archive_sha256, params, version)
+    return CalculationResult.objects.select_related('implant_variant').filter(key=key).first()
+
+
+def save_result(archive_sha256, params, version, variant_id, outputs):
+    key = cache_key(archive_sha256, params, version)
+    inputs = {"archive_sha256": archive_sha256, "params": params, "library_version": version}
+    try:
+        with transaction.atomic():
+            CalculationResult.objects.create(
+                key=key,
+                archive_sha256=archive_sha256,
+                library_version=version,
+                implant_variant_id=variant_id,
+                inputs=inputs,
+                outputs=outputs,
+            )
+    except IntegrityError:
+        # Тот же расчет параллельно завершил другой запрос; любая другая
+        # ошибка записи не должна превращаться в DoesNotExist
+        if not CalculationResult.objects.filter(key=key).exists():
+            raise
+    return CalculationResult.objects.select_related('implant_variant').get(key=key)
+
+
+def invalidate_stale(version=None):
+    # Удаляет результаты, посчитанные на прошлых версиях библиотеки
+    version = version or library_version()
+    return CalculationResult.objects.exclude(library_version=version).delete()[0]
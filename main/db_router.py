@@ -0,0 +1,133 @@
+# db_router.py
+# Чтение с реплик, запись - в основную базу.
+# На реплику уходят только запросы безопасных методов (GET, HEAD, OPTIONS),
+# пропущенные ReplicaRoutingMiddleware. Все остальное - записи, транзакции,
+# фоновые задачи, команды manage.py - работает с default.
+# После записи клиент закрепляется за основной базой на DATABASE_REPLICA_LAG
+# секунд (cookie), чтобы сразу увидеть свои изменения, пока реплика догоняет.
+import random
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+PIN_COOKIE = 'db_primary_until'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Разрешено ли текущему запросу читать с реплики
+_replica_allowed = ContextVar('replica_allowed', default=False)
+# Была ли запись в текущем запросе
+_wrote = ContextVar('db_wrote', default=False)
+
+# Кэш проверки отставания реплик: {alias: (время проверки, отставание)}
+_lag_checked = {}
+
+
+def replica_aliases():
+    return list(getattr(settings, 'DATABASE_REPLICAS', ()) or ())
+
+
+def lag_tolerance():
+    return float(getattr(settings, 'DATABASE_REPLICA_LAG', 2.0))
+
+
+def replica_lag(alias):
+    """
+    Отставание реплики в секундах (для PostgreSQL), не чаще раза в
+    DATABASE_REPLICA_LAG_CHECK секунд на процесс. Для других СУБД - 0.
+    """
+    interval = float(getattr(settings, 'DATABASE_REPLICA_LAG_CHECK', 5.0))
+    checked_at, lag = _lag_checked.get(alias, (0.0, 0.0))
+    if time.monotonic() - checked_at < interval:
+        return lag
+    connection = connections[alias]
+    if connection.vendor != 'postgresql':
+        lag = 0.0
+    else:
+        try:
+            with connection.cursor() as cursor:
+                # На основной базе (или без записей) функция возвращает NULL
+                cursor.execute(
+                    "SELECT COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)"
+                    " WHERE pg_is_in_recovery()"
+                )
+                row = cursor.fetchone()
+            lag = float(row[0]) if row else 0.0
+        except Exception:
+            # Недоступная реплика выпадает из ротации до следующей проверки
+            lag = float('inf')
+    _lag_checked[alias] = (time.monotonic(), lag)
+    return lag
+
+
+def pin_to_primary():
+    # Остаток запроса читает с основной базы
+    _replica_allowed.set(False)
+    _wrote.set(True)
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if not _replica_allowed.get() or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return instance._state.db
+        tolerance = lag_tolerance()
+        fresh = [alias for alias in replica_aliases() if replica_lag(alias) <= tolerance]
+        return random.choice(fresh) if fresh else DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        pin_to_primary()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реплики содержат те же данные, что и основная база
+        databases = {DEFAULT_DB_ALIAS, *replica_aliases()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Разрешает чтение с реплик для безопасных запросов, если клиент
+    не закреплен за основной базой после недавней записи.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        allowed = (
+            bool(replica_aliases())
+            and request.method in SAFE_METHODS
+            and not self._pinned(request)
+        )
+        replica_token = _replica_allowed.set(allowed)
+        wrote_token = _wrote.set(False)
+        try:
+            response = self.get_response(request)
+            if replica_aliases() and (_wrote.get() or request.method not in SAFE_METHODS):
+                until = time.time() + lag_tolerance()
+                response.set_cookie(
+                    PIN_COOKIE, f"{until:.3f}", max_age=max(int(lag_tolerance()) + 1, 1),
+                    httponly=True, secure=settings.SESSION_COOKIE_SECURE,
+                    samesite=settings.SESSION_COOKIE_SAMESITE,
+                )
+            return response
+        finally:
+            _replica_allowed.reset(replica_token)
+            _wrote.reset(wrote_token)
+
+    @staticmethod
+    def _pinned(request):
+        try:
+            return float(request.COOKIES.get(PIN_COOKIE, 0)) > time.time()
+        except ValueError:
+            return False
+
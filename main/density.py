@@ -0,0 +1,107 @@
+# density.py
+# Выборка плотности кости (HU) вдоль планируемой оси импланта.
+# Для всех вариантов библиотеки сразу строится сетка точек внутри цилиндра
+# diameter x length, значения берутся трилинейной интерполяцией по объему.
+# Вся выборка - несколько операций NumPy над массивом (варианты, глубина, точки).
+import warnings
+
+import numpy as np
+
+
+def _basis(axis):
+    # Единичная ось импланта и два перпендикулярных к ней вектора
+    axis = np.asarray(axis, dtype=np.float64)
+    norm = np.linalg.norm(axis)
+    if norm == 0:
+        raise ValueError("Ось импланта не может быть нулевой")
+    axis = axis / norm
+    helper = np.array([1.0, 0.0, 0.0]) if abs(axis[0]) < 0.9 else np.array([0.0, 1.0, 0.0])
+    u = np.cross(axis, helper)
+    u /= np.linalg.norm(u)
+    v = np.cross(axis, u)
+    return axis, u, v
+
+
+def trilinear(volume, points):
+    """
+    Трилинейная интерполяция объема (z, y, x) в точках points[..., 3]
+    (координаты в вокселях, тот же порядок осей). Точки вне объема дают NaN.
+    """
+    shape = np.array(volume.shape)
+    inside = np.all((points >= 0) & (points <= shape - 1), axis=-1)
+    p = np.clip(points, 0, shape - 1)
+    p0 = np.floor(p).astype(np.intp)
+    p0 = np.minimum(p0, shape - 2).clip(0)
+    # Дальний сосед не выходит за объем: на оси из одного вокселя он
+    # совпадает с ближним (вес f там нулевой)
+    p1 = np.minimum(p0 + 1, shape - 1)
+    f = p - p0
+    fz, fy, fx = f[..., 0], f[..., 1], f[..., 2]
+
+    # Восемь соседей вокселя; memmap читает только нужные элементы
+    result = np.zeros(points.shape[:-1], dtype=np.float64)
+    for dz in (0, 1):
+        wz = fz if dz else 1 - fz
+        z = (p1 if dz else p0)[..., 0]
+        for dy in (0, 1):
+            wy = fy if dy else 1 - fy
+            y = (p1 if dy else p0)[..., 1]
+            for dx in (0, 1):
+                wx = fx if dx else 1 - fx
+                x = (p1 if dx else p0)[..., 2]
+                result += wz * wy * wx * volume[z, y, x]
+    result[~inside] = np.nan
+    return result
+
+
+def sample_cylinders(volume, spacing, position, axis, diameters, lengths,
+                     depth_steps=20, radial_steps=3, angle_steps=12):
+    """
+    Выборка HU внутри цилиндров всех вариантов.
+
+    volume - объем HU (z, y, x), spacing - шаг вокселя (dz, dy, dx) в мм,
+    position - точка входа импланта (x, y, z) в вокселях,
+    axis - направление импланта (x, y, z) в мм-пространстве,
+    diameters, lengths - размеры вариантов в мм.
+
+    Возвращает словарь с массивами: depths (варианты x глубина, мм),
+    profile (средняя HU на каждой глубине) и сводку по каждому варианту.
+    """
+    spacing_zyx = np.asarray(spacing, dtype=np.float64)
+    spacing_xyz = spacing_zyx[::-1]
+    diameters = np.asarray(diameters, dtype=np.float64)
+    lengths = np.asarray(lengths, dtype=np.float64)
+    axis, u, v = _basis(axis)
+    origin = np.asarray(position, dtype=np.float64) * spacing_xyz
+
+    # Доли глубины и радиуса, углы - общие для всех вариантов
+    t = (np.arange(depth_steps) + 0.5) / depth_steps
+    r = np.linspace(0.0, 1.0, radial_steps)
+    theta = np.linspace(0.0, 2 * np.pi, angle_steps, endpoint=False)
+    ring = (r[:, None, None] * (np.cos(theta)[None, :, None] * u + np.sin(theta)[None, :, None] * v))
+    ring = ring.reshape(-1, 3)
+
+    depths = t[None, :] * lengths[:, None]
+    radii = diameters / 2.0
+    # (варианты, глубина, точки кольца, xyz) в мм
+    points = (origin
+              + depths[:, :, None, None] * axis
+              + radii[:, None, None, None] * ring[None, None, :, :])
+    voxels = (points / spacing_xyz)[..., ::-1]
+    hu = trilinear(volume, voxels)
+
+    # Глубины целиком вне объема дают NaN; nanmean предупреждает о них через warnings
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        profile = np.nanmean(hu, axis=2)
+        flat = hu.reshape(len(diameters), -1)
+        summary = {
+            "mean": np.nanmean(flat, axis=1),
+            "min": np.nanmin(flat, axis=1),
+            "max": np.nanmax(flat, axis=1),
+            "std": np.nanstd(flat, axis=1),
+            "p10": np.nanpercentile(flat, 10, axis=1),
+            # Доля точек цилиндра, попавших в объем
+            "coverage": np.mean(~np.isnan(flat), axis=1),
+        }
+    return {"depths": depths, "profile": profile, "summary": summary}
@@ -0,0 +1,245 @@
+# dicom_index.py
+# Индекс заголовков DICOM: по строке DicomInstance на файл серии.
+# Заголовок читается без пикселей (обычно хватает первых HEADER_BYTES байт),
+# поэтому индексация дешевле полного разбора. По индексу упорядочиваются
+# срезы для просмотра и собирается объем HU (main/volume.py): несжатые
+# пиксели читаются напрямую по смещению, без повторного разбора заголовка.
+import io
+
+import numpy as np
+import pydicom
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from pydicom.errors import InvalidDicomError
+
+from .models import DicomInstance, DicomSeries
+from .slices import list_series, open_slice
+
+HEADER_BYTES = 64 * 1024
+PIXEL_DATA_TAG = b'\xe0\x7f\x10\x00'
+# Синтаксисы передачи, пиксели которых лежат в файле как есть
+RAW_SYNTAXES = ('1.2.840.10008.1.2', '1.2.840.10008.1.2.1')
+# VR с 12-байтовым заголовком элемента в явном синтаксисе
+LONG_VRS = (b'OB', b'OW', b'OF', b'OD', b'OL', b'OV', b'UN')
+
+INDEX_FIELDS = (
+    'relpath', 'study_uid', 'series_uid', 'sop_uid', 'modality', 'instance_number', 'slice_location',
+    'slice_position', 'image_position', 'pixel_spacing', 'slice_thickness', 'rows', 'columns',
+    'rescale_slope', 'rescale_intercept', 'transfer_syntax', 'pixel_offset', 'pixel_dtype',
+)
+
+
+def batch_size():
+    return getattr(settings, 'DICOM_INDEX_BATCH_SIZE', 500)
+
+
+def _parse(data):
+    # (заголовок, позиция элемента PixelData или None)
+    buf = io.BytesIO(data)
+    ds = pydicom.dcmread(buf, stop_before_pixels=True)
+    pos = buf.tell()
+    if data[pos:pos + 4] == PIXEL_DATA_TAG:
+        return ds, pos
+    return ds, None
+
+
+def _read_header(f):
+    prefix = f.read(HEADER_BYTES)
+    if len(prefix) == HEADER_BYTES:
+        try:
+            ds, pos = _parse(prefix)
+        except (EOFError, ValueError):
+            # Не DICOM (InvalidDicomError) выясняется по префиксу и дочитывать не нужно
+            ds, pos = None, None
+        # По обрезанному буферу pydicom молча читает обрывки элементов,
+        # поэтому префиксу верим, только если PixelData в нем целиком
+        if pos is not None and pos + 12 <= len(prefix):
+            return ds, pos, prefix
+        prefix += f.read()
+    ds, pos = _parse(prefix)
+    return ds, pos, prefix
+
+
+def _float(value, default=None):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _floats(value, count):
+    try:
+        values = [float(v) for v in value]
+    except (TypeError, ValueError):
+        return None
+    return values if len(values) == count else None
+
+
+def _slice_position(position, orientation):
+    # Проекция положения на нормаль к плоскости среза; без ориентации - z
+    if position is None:
+        return None
+    if orientation is None:
+        return position[2]
+    normal = np.cross(orientation[:3], orientation[3:])
+    return float(np.dot(position, normal))
+
+
+def _pixel_layout(ds, data, pos):
+    # (смещение значений PixelData, тип numpy для чтения без декодера)
+    if pos is None:
+        return None, ''
+    if ds.is_implicit_VR:
+        offset, length = pos + 8, int.from_bytes(data[pos + 4:pos + 8], 'little')
+    elif data[pos + 4:pos + 6] in LONG_VRS:
+        offset, length = pos + 12, int.from_bytes(data[pos + 8:pos + 12], 'little')
+    else:
+        offset, length = pos + 8, int.from_bytes(data[pos + 6:pos + 8], 'little')
+
+    syntax = str(getattr(getattr(ds, 'file_meta', None), 'TransferSyntaxUID', '') or '')
+    bits = _int(getattr(ds, 'BitsAllocated', None))
+    signed = _int(getattr(ds, 'PixelRepresentation', 0)) == 1
+    pixels = (_int(getattr(ds, 'Rows', None)) or 0) * (_int(getattr(ds, 'Columns', None)) or 0)
+    if (
+        syntax not in RAW_SYNTAXES
+        or bits not in (8, 16)
+        or (_int(getattr(ds, 'SamplesPerPixel', 1)) or 1) != 1
+        or (_int(getattr(ds, 'NumberOfFrames', 1)) or 1) != 1
+        # Знаковые значения с неполной разрядностью требуют расширения знака
+        or (signed and _int(getattr(ds, 'BitsStored', bits)) != bits)
+        or length == 0xFFFFFFFF
+        or length < pixels * bits // 8
+    ):
+        return offset, ''
+    return offset, f"<{'i' if signed else 'u'}{bits // 8}"
+
+
+def read_instance(series_dir, relpath, codec):
+    """
+    Строка индекса для одного файла серии (словарь полей INDEX_FIELDS)
+    или None, если файл не DICOM.
+    """
+    with open_slice(series_dir, relpath, codec) as f:
+        try:
+            ds, pos, data = _read_header(f)
+        except (InvalidDicomError, EOFError, ValueError):
+            return None
+    position = _floats(getattr(ds, 'ImagePositionPatient', None), 3)
+    orientation = _floats(getattr(ds, 'ImageOrientationPatient', None), 6)
+    pixel_offset, pixel_dtype = _pixel_layout(ds, data, pos)
+    return {
+        "relpath": relpath,
+        "study_uid": str(getattr(ds, 'StudyInstanceUID', '') or ''),
+        "series_uid": str(getattr(ds, 'SeriesInstanceUID', '') or ''),
+        "sop_uid": str(getattr(ds, 'SOPInstanceUID', '') or ''),
+        "modality": str(getattr(ds, 'Modality', '') or ''),
+        "instance_number": _int(getattr(ds, 'InstanceNumber', None)),
+        "slice_location": _float(getattr(ds, 'SliceLocation', None)),
+        "slice_position": _slice_position(position, orientation),
+        "image_position": position,
+        "pixel_spacing": _floats(getattr(ds, 'PixelSpacing', None), 2),
+        "slice_thickness": _float(getattr(ds, 'SliceThickness', None)),
+        "rows": _int(getattr(ds, 'Rows', None)),
+        "columns": _int(getattr(ds, 'Columns', None)),
+        "rescale_slope": _float(getattr(ds, 'RescaleSlope', None), 1.0) or 1.0,
+        "rescale_intercept": _float(getattr(ds, 'RescaleIntercept', None), 0.0),
+        "transfer_syntax": str(getattr(getattr(ds, 'file_meta', None), 'TransferSyntaxUID', '') or ''),
+        "pixel_offset": pixel_offset,
+        "pixel_dtype": pixel_dtype,
+    }
+
+
+def read_index(series_dir, codec):
+    # Индекс всех файлов серии по манифесту, в порядке sort_key
+    rows = []
+    for relpath, _ in list_series(series_dir):
+        row = read_instance(series_dir, relpath, codec)
+        if row is not None:
+            rows.append(row)
+    return sorted(rows, key=sort_key)
+
+
+def sort_key(row):
+    """
+    Порядок снимков: по серии, затем по положению среза (нормаль к плоскости,
+    SliceLocation или номер снимка), затем по номеру и имени файла.
+    """
+    position = row["slice_position"]
+    if position is None:
+        position = row["slice_location"]
+    if position is None:
+        position = row["instance_number"] or 0
+    return row["series_uid"], position, row["instance_number"] or 0, row["relpath"]
+
+
+def store_index(series, rows, force=False):
+    """
+    Сохраняет индекс серии пакетами по DICOM_INDEX_BATCH_SIZE строк.
+    Серия блокируется на время записи, поэтому параллельная обработка того
+    же архива не продублирует строки. Возвращает количество записанных строк.
+    """
+    with transaction.atomic():
+        series = DicomSeries.objects.select_for_update().get(pk=series.pk)
+        if series.indexed_at is not None and not force:
+            return 0
+        series.instances.all().delete()
+        DicomInstance.objects.bulk_create(
+            (DicomInstance(series=series, **row) for row in rows), batch_size=batch_size()
+        )
+        series.indexed_at = timezone.now()
+        series.save(update_fields=['indexed_at'])
+    return len(rows)
+
+
+def index_series(series, series_dir, force=False):
+    # Индексация уже сохраненной серии (для серий, загруженных до индекса)
+    return store_index(series, read_index(series_dir, series.codec), force=force)
+
+
+def series_index(series):
+    # Строки индекса серии из базы в порядке sort_key
+    return sorted(series.instances.values(*INDEX_FIELDS), key=sort_key)
+
+
+def order_slices(slices, series):
+    """
+    Упорядочивает (путь, размер) срезов по индексу серии: снимки в порядке
+    sort_key, остальные файлы - следом по имени.
+    """
+    ranks = {row["relpath"]: i for i, row in enumerate(series_index(series))}
+    return sorted(slices, key=lambda item: (0, ranks[item[0]], '') if item[0] in ranks else (1, 0, item[0]))
+
+
+def series_summary(rows):
+    """
+    Сводка по сериям индекса: UID, модальность, число снимков, матрица,
+    шаг пикселя и шаг между срезами (медиана).
+    """
+    groups = {}
+    for row in rows:
+        groups.setdefault((row["study_uid"], row["series_uid"]), []).append(row)
+    summary = []
+    for (study_uid, series_uid), group in groups.items():
+        first = group[0]
+        positions = [row["slice_position"] for row in group if row["slice_position"] is not None]
+        steps = np.abs(np.diff(sorted(positions)))
+        summary.append({
+            "study_uid": study_uid,
+            "series_uid": series_uid,
+            "modality": first["modality"],
+            "count": len(group),
+            "rows": first["rows"],
+            "columns": first["columns"],
+            "pixel_spacing": first["pixel_spacing"],
+            "slice_thickness": first["slice_thickness"],
+            "slice_spacing": float(np.median(steps)) if len(steps) else None,
+        })
+    return summary
@@ -0,0 +1,298 @@
+# dicom_storage.py
+# Контентно-адресуемое хранилище архивов DICOM и распакованных серий.
+# Архив сохраняется один раз по SHA-256, серия распаковывается один раз и
+# разделяется всеми приемами, которые ссылаются на тот же архив.
+# Папки серий лежат в хранилище серий (main/storage.py), архивы - в MEDIA_ROOT.
+import hashlib
+import os
+import re
+import shutil
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from .archive_store import STORAGE_ARCHIVE, drop_cached, storage_mode, write_archive_manifest
+from .dicom_index import order_slices
+from .extraction import extract_archive
+from .mesh import drop_meshes
+from .models import DicomBlob, DicomSeries
+from .panoramic import drop_reconstructions
+from .slices import CODEC_NONE, configured_codec, configured_level, list_series, read_manifest, write_manifest
+from .storage import STORAGE_LOCAL, get_storage, series_location
+
+BLOBS_DIR = 'dicom_blobs'
+SERIES_DIR = os.path.join('dicoms', 'series')
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def _sharded(sha256):
+    # Два уровня по два символа хеша, чтобы каталоги не разрастались
+    return os.path.join(sha256[:2], sha256[2:4], sha256)
+
+
+def blob_relpath(sha256):
+    return os.path.join(BLOBS_DIR, _sharded(sha256) + '.zip')
+
+
+def series_relpath(sha256):
+    return os.path.join(SERIES_DIR, _sharded(sha256))
+
+
+def legacy_case_relpath(case_id):
+    return os.path.join('dicoms', f'case_{case_id}')
+
+
+def case_dicom_dir(case):
+    # Расположение снимков приема (см. series_location): общая серия или старая папка case_<id>
+    series = case.dicom_series if case.dicom_series_id else None
+    if series is not None:
+        return series_dir(series)
+    return os.path.join(settings.MEDIA_ROOT, legacy_case_relpath(case.id))
+
+
+def series_dir(series):
+    return series_location(series.path, series.storage)
+
+
+def case_codec(case):
+    series = case.dicom_series if case.dicom_series_id else None
+    return series.codec if series is not None else CODEC_NONE
+
+
+def case_slices(case):
+    # Упорядоченный список (относительный путь, исходный размер) срезов приема:
+    # по индексу заголовков, а для непроиндексированных серий - по имени файла
+    slices = list_series(case_dicom_dir(case))
+    series = case.dicom_series if case.dicom_series_id else None
+    if series is None or series.indexed_at is None:
+        return slices
+    return order_slices(slices, series)
+
+
+def slices_base_url(request, case):
+    """
+    Абсолютная ссылка на папку срезов (с "/" в конце). Несжатые срезы
+    отдаются как обычная медиа, сжатые - через DicomSliceView с распаковкой на лету.
+    """
+    path = None
+    if case_codec(case) == CODEC_NONE:
+        series = case.dicom_series if case.dicom_series_id else None
+        if series is not None:
+            # У объектного хранилища без публичного адреса прямых ссылок нет
+            path = get_storage(series.storage).url(series.path)
+        else:
+            path = get_storage(STORAGE_LOCAL).url(legacy_case_relpath(case.id))
+    if path is None:
+        path = f"/api/cases/{case.id}/slices/"
+    return request.build_absolute_uri(path)
+
+
+def slice_url(request, case, relpath):
+    return slices_base_url(request, case) + relpath
+
+
+_NUMBERED = re.compile(r'^(.*?)(\d+)(\D*)$')
+
+
+def _name_pattern(names):
+    # Шаблон вида "series/IMG%04d.dcm", если имена идут подряд с одинаковой шириной номера
+    match = _NUMBERED.match(names[0])
+    if match is None:
+        return None
+    prefix, digits, suffix = match.groups()
+    width, start = len(digits), int(digits)
+    for i, name in enumerate(names):
+        if name != f"{prefix}{start + i:0{width}d}{suffix}":
+            return None
+    return {"pattern": f"{prefix.replace('%', '%%')}%0{width}d{suffix.replace('%', '%%')}", "start": start}
+
+
+def compact_descriptor(request, case):
+    """
+    Компактное описание серии вместо списка полных ссылок:
+    базовый адрес, шаблон имен (или список имен), количество и объем.
+    """
+    slices = case_slices(case)
+    names = [name for name, _ in slices]
+    descriptor = {
+        "base_url": slices_base_url(request, case),
+        "count": len(names),
+        "total_size": sum(size for _, size in slices),
+        # Вся серия одним архивом (main/bundle.py)
+        "bundle_url": request.build_absolute_uri(f"/api/cases/{case.id}/bundle/"),
+    }
+    pattern = _name_pattern(names) if names else None
+    if pattern is not None:
+        descriptor.update(pattern)
+    else:
+        descriptor["files"] = names
+    return descriptor
+
+
+def hash_file(file_obj):
+    # Хеш для файлов, пришедших не через HashingFileUploadHandler
+    sha256 = getattr(file_obj, 'sha256', None)
+    if sha256:
+        return sha256
+    hasher = hashlib.sha256()
+    file_obj.seek(0)
+    for chunk in iter(lambda: file_obj.read(HASH_CHUNK_SIZE), b''):
+        hasher.update(chunk)
+    file_obj.seek(0)
+    return hasher.hexdigest()
+
+
+def store_blob(file_obj):
+    """
+    Сохраняет архив в хранилище блобов. Возвращает (blob, created).
+    Повторная загрузка того же архива ничего не пишет на диск.
+    """
+    sha256 = hash_file(file_obj)
+    blob = DicomBlob.objects.filter(sha256=sha256).first()
+    if blob is not None:
+        DicomBlob.objects.filter(pk=blob.pk).update(last_used_at=timezone.now())
+        return blob, False
+
+    relpath = blob_relpath(sha256)
+    abspath = os.path.join(settings.MEDIA_ROOT, relpath)
+    os.makedirs(os.path.dirname(abspath), exist_ok=True)
+
+    tmp_path = f"{abspath}.{uuid.uuid4().hex}.tmp"
+    temporary_path = getattr(file_obj, 'temporary_file_path', None)
+    if temporary_path is not None:
+        shutil.move(temporary_path(), tmp_path)
+    else:
+        file_obj.seek(0)
+        with open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(file_obj, dst, HASH_CHUNK_SIZE)
+    size = os.path.getsize(tmp_path)
+    os.replace(tmp_path, abspath)
+
+    try:
+        with transaction.atomic():
+            blob = DicomBlob.objects.create(sha256=sha256, size=size, file=relpath)
+        return blob, True
+    except IntegrityError:
+        # Параллельная загрузка того же архива успела раньше, файл уже на месте
+        return DicomBlob.objects.get(sha256=sha256), False
+
+
+def extract_series(blob):
+    """
+    Возвращает распакованную серию для блоба, распаковывая архив только
+    при первом обращении.
+    """
+    series = DicomSeries.objects.filter(blob=blob).first()
+    if series is not None:
+        return series
+    return register_series(blob, materialize_series(blob.sha256, blob.file.path))
+
+
+def build_series_dir(sha256, archive_path, dest, on_member=None):
+    # Заполняет папку серии по текущему режиму хранения: распакованные срезы
+    # с манифестом или только манифест со ссылкой на архив
+    if storage_mode() == STORAGE_ARCHIVE:
+        write_archive_manifest(dest, sha256, archive_path, on_member=on_member)
+        return
+    codec = configured_codec()
+    entries = extract_archive(archive_path, dest, codec, configured_level(), on_member=on_member)
+    write_manifest(dest, codec, entries)
+
+
+def materialize_series(sha256, archive_path, on_member=None, storage=None):
+    """
+    Распаковывает архив в серию хранилища storage (по умолчанию
+    DICOM_SERIES_STORAGE), если ее еще нет, и возвращает путь серии.
+    Работает без базы, поэтому может выполняться в дочернем процессе.
+    Распаковка идет во временную папку и публикуется целиком, чтобы
+    параллельные запросы не видели половину серии. Срезы сжимаются кодеком
+    из настройки DICOM_SLICE_COMPRESSION, в режиме хранения "archive"
+    распаковки нет - пишется только манифест.
+    on_member - отчет о ходе распаковки (см. extract_archive).
+    """
+    relpath = series_relpath(sha256)
+    backend = get_storage(storage)
+    if not backend.exists(relpath):
+        tmp_path = backend.staging_dir(relpath)
+        try:
+            build_series_dir(sha256, archive_path, tmp_path, on_member=on_member)
+        except Exception:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        backend.publish(tmp_path, relpath)
+    return relpath
+
+
+def convert_series(series):
+    """
+    Пересобирает папку серии под текущий режим хранения (например, удаляет
+    распакованные срезы при переходе на "archive"). Возвращает объем серии
+    на диске (байт) до и после.
+    """
+    backend = get_storage(series.storage)
+    before = series.total_size
+    tmp_path = backend.staging_dir(series.path)
+    try:
+        build_series_dir(series.blob.sha256, series.blob.file.path, tmp_path)
+    except Exception:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    backend.publish(tmp_path, series.path, replace=True)
+
+    manifest = read_manifest(series_dir(series))
+    series.codec = manifest["codec"]
+    series.file_count = len(manifest["files"])
+    series.total_size = sum(stored for _, stored in manifest["files"].values())
+    series.save(update_fields=['codec', 'file_count', 'total_size'])
+    return before, series.total_size
+
+
+def register_series(blob, relpath, storage=None):
+    backend = get_storage(storage)
+    manifest = read_manifest(backend.location(relpath)) or {"codec": CODEC_NONE, "files": {}}
+    series, _ = DicomSeries.objects.get_or_create(
+        blob=blob,
+        defaults={
+            "path": relpath,
+            "storage": backend.name,
+            "codec": manifest["codec"],
+            "file_count": len(manifest["files"]),
+            "total_size": sum(stored for _, stored in manifest["files"].values()),
+        }
+    )
+    return series
+
+
+def orphaned_blobs(grace=timedelta(hours=24)):
+    # Блобы, на серии которых не ссылается ни один прием (счетчик ссылок = 0).
+    # Период ожидания защищает архивы, которые прямо сейчас привязываются к приему
+    return (
+        DicomBlob.objects
+        .annotate(ref_count=Count('series__cases'))
+        .filter(ref_count=0, last_used_at__lt=timezone.now() - grace)
+    )
+
+
+def collect_garbage(grace=timedelta(hours=24), dry_run=False):
+    """
+    Удаляет блобы без ссылок вместе с распакованными сериями.
+    Возвращает список (sha256, освобождено байт).
+    """
+    removed = []
+    for blob in orphaned_blobs(grace):
+        series = DicomSeries.objects.filter(blob=blob).first()
+        freed = blob.size + (series.total_size if series is not None else 0)
+        if not dry_run:
+            if series is not None:
+                get_storage(series.storage).delete(series.path)
+            drop_cached(blob.sha256)
+            drop_reconstructions(blob.sha256)
+            drop_meshes(blob.sha256)
+            # Файл архива удалит django_cleanup
+            blob.delete()
+        removed.append((blob.sha256, freed))
+    return removed
@@ -0,0 +1,231 @@
+# events.py
+# Поток событий (Server-Sent Events) о ходе обработки загрузки DICOM.
+# Обслуживается напрямую из asgi.py, минуя Django-представления: соединение
+# держит только корутину, которая раз в SSE_POLL_INTERVAL секунд читает
+# ProcessingJob и отправляет событие, если состояние изменилось.
+# Там же считаются байты тела запроса загрузки по мере их поступления.
+# Задача принадлежит загрузившему архив пользователю: чужие задачи поток не
+# показывает, а загрузка с чужим X-Upload-Id их не перезаписывает.
+import asyncio
+import json
+import re
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import close_old_connections
+from django.http.cookie import parse_cookie
+from django.utils import timezone
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .models import MedicalCase, ProcessingJob
+from .progress import UploadIdTaken, claim_job, is_stale, mark_stale_jobs, report_interval, valid_upload_id
+from .seriailizers import ProcessingJobSerializer
+
+EVENTS_PATH = re.compile(r'^/api/uploads/(?P<upload_id>[^/]+)/events/$')
+UPLOAD_PATH = re.compile(r'^/api/cases/(?P<case_id>\d+)/upload-dicom/$')
+HEARTBEAT = 15
+
+
+def _db(func):
+    # Запрос к базе из асинхронного кода с закрытием устаревших соединений
+    def wrapper(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return sync_to_async(wrapper, thread_sensitive=True)
+
+
+def _headers(scope):
+    return {name.decode('latin1').lower(): value.decode('latin1') for name, value in scope.get('headers', [])}
+
+
+def _raw_token(headers):
+    # Как CustomAuthentication: заголовок Authorization или cookie с access-токеном
+    header = headers.get('authorization', '').split()
+    if len(header) == 2 and header[0] in api_settings.AUTH_HEADER_TYPES:
+        return header[1]
+    return parse_cookie(headers.get('cookie', '')).get(settings.SIMPLE_JWT['AUTH_COOKIE'])
+
+
+@_db
+def _user_exists(user_id):
+    return get_user_model().objects.filter(**{api_settings.USER_ID_FIELD: user_id, 'is_active': True}).exists()
+
+
+@_db
+def _job_state(upload_id, user_id):
+    job = ProcessingJob.objects.filter(upload_id=upload_id, user_id=user_id).first()
+    if job and is_stale(job):
+        # Процесс, обрабатывавший задачу, завершился, и она уже не закончится
+        mark_stale_jobs(upload_id=upload_id)
+        job.refresh_from_db()
+    return ProcessingJobSerializer(job).data if job else None
+
+
+@_db
+def _start_receiving(upload_id, user_id, case_id, total):
+    # False - id занят задачей другого пользователя, ход загрузки не пишем
+    case_id = case_id if MedicalCase.objects.filter(pk=case_id).exists() else None
+    try:
+        claim_job(
+            upload_id, user_id, case_id=case_id, stage=ProcessingJob.Stage.RECEIVING,
+            bytes_total=total, bytes_received=0, error="", result=None,
+        )
+    except UploadIdTaken:
+        return False
+    return True
+
+
+@_db
+def _update_received(upload_id, user_id, received):
+    ProcessingJob.objects.filter(upload_id=upload_id, user_id=user_id).update(
+        bytes_received=received, updated_at=timezone.now()
+    )
+
+
+async def _authenticated(headers):
+    # id активного пользователя из токена или None
+    raw = _raw_token(headers)
+    if not raw:
+        return None
+    try:
+        token = AccessToken(raw)
+    except TokenError:
+        return None
+    user_id = token.get(api_settings.USER_ID_CLAIM)
+    return user_id if await _user_exists(user_id) else None
+
+
+def _event(name, data, event_id=None):
+    lines = [f"event: {name}"]
+    if event_id:
+        lines.append(f"id: {event_id}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return ("\n".join(lines) + "\n\n").encode()
+
+
+async def _json_response(send, status, data):
+    body = json.dumps(data, ensure_ascii=False).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def upload_events(scope, receive, send, upload_id):
+    """
+    SSE: событие progress при каждом изменении ProcessingJob, в конце done
+    или failed с итогом. Соединение закрывается после последнего события,
+    отключения клиента или через SSE_MAX_DURATION секунд.
+    """
+    if not valid_upload_id(upload_id):
+        return await _json_response(send, 404, {"error": "Загрузка не найдена"})
+    user_id = await _authenticated(_headers(scope))
+    if user_id is None:
+        return await _json_response(send, 401, {"detail": "Учетные данные не были предоставлены."})
+
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [
+            (b"content-type", b"text/event-stream; charset=utf-8"),
+            (b"cache-control", b"no-cache"),
+            # nginx не должен буферизовать поток
+            (b"x-accel-buffering", b"no"),
+        ],
+    })
+
+    disconnected = asyncio.Event()
+
+    async def watch_disconnect():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+        disconnected.set()
+
+    watcher = asyncio.ensure_future(watch_disconnect())
+    poll = getattr(settings, 'SSE_POLL_INTERVAL', 0.5)
+    # Клиент может подписаться раньше, чем начнется загрузка
+    wait_for_job = getattr(settings, 'SSE_WAIT_FOR_JOB', 60)
+    started = last_sent = time.monotonic()
+    deadline = started + getattr(settings, 'SSE_MAX_DURATION', 3600)
+    last_state = None
+    try:
+        while not disconnected.is_set() and time.monotonic() < deadline:
+            state = await _job_state(upload_id, user_id)
+            chunk, final = None, False
+            if state is None:
+                if time.monotonic() - started > wait_for_job:
+                    chunk, final = _event("failed", {"error": "Загрузка не найдена"}), True
+            elif state != last_state:
+                last_state = state
+                final = state["stage"] in (ProcessingJob.Stage.DONE, ProcessingJob.Stage.FAILED)
+                chunk = _event(state["stage"] if final else "progress", state, state["updated_at"])
+            elif time.monotonic() - last_sent >= HEARTBEAT:
+                chunk = b": ping\n\n"
+
+            if chunk is not None:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                last_sent = time.monotonic()
+            if final:
+                break
+            try:
+                await asyncio.wait_for(disconnected.wait(), timeout=poll)
+            except asyncio.TimeoutError:
+                pass
+        if not disconnected.is_set():
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+    finally:
+        watcher.cancel()
+
+
+def _tracking_receive(receive, upload_id, user_id, case_id, total):
+    # Считает байты тела запроса загрузки и пишет их в ProcessingJob
+    state = {"received": 0, "reported": 0.0, "started": False, "owned": False}
+    interval = report_interval()
+
+    async def wrapped():
+        if not state["started"]:
+            state["started"] = True
+            state["owned"] = await _start_receiving(upload_id, user_id, case_id, total)
+        message = await receive()
+        if message["type"] == "http.request" and state["owned"]:
+            state["received"] += len(message.get("body", b""))
+            finished = not message.get("more_body", False)
+            if finished or time.monotonic() - state["reported"] >= interval:
+                state["reported"] = time.monotonic()
+                await _update_received(upload_id, user_id, state["received"])
+        return message
+
+    return wrapped
+
+
+def with_upload_events(application):
+    """
+    Оборачивает ASGI-приложение Django: /api/uploads/<id>/events/ отдает
+    поток событий, а загрузки с X-Upload-Id отчитываются о принятых байтах.
+    """
+    async def router(scope, receive, send):
+        if scope["type"] == "http":
+            match = EVENTS_PATH.match(scope["path"])
+            if match and scope["method"] == "GET":
+                return await upload_events(scope, receive, send, match["upload_id"])
+            match = UPLOAD_PATH.match(scope["path"])
+            if match and scope["method"] == "POST":
+                headers = _headers(scope)
+                upload_id = headers.get("x-upload-id")
+                # Без действительного токена представление ответит 401 - задачу не создаем
+                user_id = await _authenticated(headers) if valid_upload_id(upload_id) else None
+                if user_id is not None:
+                    total = int(headers.get("content-length") or 0)
+                    receive = _tracking_receive(receive, upload_id, user_id, int(match["case_id"]), total)
+        return await application(scope, receive, send)
+
+    return router
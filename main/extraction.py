@@ -0,0 +1,136 @@
+# extraction.py
+# Многопоточная распаковка архивов DICOM с проверками против zip-бомб и
+# выхода за пределы папки. zlib отпускает GIL при распаковке, поэтому
+# члены архива распаковываются параллельно в пуле потоков; каждый поток
+# держит свой ZipFile, чтобы не делить позицию чтения в файле.
+import os
+import stat
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from .slices import stored_name, write_slice
+
+DEFAULT_LIMITS = {
+    "max_members": 20000,
+    "max_total_size": 8 * 1024 ** 3,
+    "max_member_size": 1024 ** 3,
+    # Коэффициент сжатия проверяется только для членов крупнее min_ratio_size
+    "max_ratio": 100,
+    "min_ratio_size": 1024 ** 2,
+}
+
+
+class UnsafeArchive(Exception):
+    pass
+
+
+def extraction_limits():
+    limits = dict(DEFAULT_LIMITS)
+    limits.update(getattr(settings, 'DICOM_EXTRACT_LIMITS', {}) or {})
+    return limits
+
+
+def extraction_threads():
+    return getattr(settings, 'DICOM_EXTRACT_THREADS', None) or min(8, os.cpu_count() or 1)
+
+
+def safe_member_path(name):
+    # Нормализованный относительный путь или None для служебных записей
+    parts = [p for p in name.replace('\\', '/').split('/') if p not in ('', '.')]
+    if not parts:
+        return None
+    if '..' in parts or name.startswith(('/', '\\')) or ':' in parts[0]:
+        raise UnsafeArchive(f"Недопустимый путь в архиве: {name}")
+    return '/'.join(parts)
+
+
+def plan_extraction(infos, limits):
+    """
+    Проверяет оглавление архива и возвращает список (info, путь) для распаковки.
+    Размеры берутся из центрального каталога; при распаковке zipfile не отдает
+    больше объявленного file_size, так что лимиты нельзя обойти подделкой заголовка.
+    """
+    members = []
+    seen = set()
+    total = 0
+    for info in infos:
+        if info.is_dir():
+            continue
+        if stat.S_ISLNK(info.external_attr >> 16):
+            raise UnsafeArchive(f"Символические ссылки не допускаются: {info.filename}")
+        name = safe_member_path(info.filename)
+        if name is None or os.path.basename(name).startswith('.'):
+            continue
+        # Два члена с одним путем (например, a/b и ./a//b) перезаписали бы
+        # друг друга в зависимости от порядка потоков
+        if name in seen:
+            raise UnsafeArchive(f"Повторяющийся путь в архиве: {info.filename}")
+        seen.add(name)
+
+        if info.file_size > limits["max_member_size"]:
+            raise UnsafeArchive(f"Слишком большой файл в архиве: {info.filename}")
+        if (info.file_size > limits["min_ratio_size"]
+                and info.file_size > limits["max_ratio"] * max(info.compress_size, 1)):
+            raise UnsafeArchive(f"Подозрительная степень сжатия: {info.filename}")
+        total += info.file_size
+        members.append((info, name))
+
+        if len(members) > limits["max_members"]:
+            raise UnsafeArchive("Слишком много файлов в архиве")
+        if total > limits["max_total_size"]:
+            raise UnsafeArchive("Слишком большой объем после распаковки")
+    return members
+
+
+def extract_archive(archive_path, dest, codec, level, threads=None, limits=None, on_member=None):
+    """
+    Распаковывает архив в dest, сжимая срезы кодеком codec.
+    on_member(готово, всего) вызывается в вызывающем потоке после каждого файла.
+    Возвращает {относительный путь: (исходный размер, размер на диске)}.
+    """
+    limits = limits or extraction_limits()
+    threads = threads or extraction_threads()
+    with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+        members = plan_extraction(zip_ref.infolist(), limits)
+
+    # Папки создаем заранее, чтобы потоки не гонялись за makedirs
+    for directory in {os.path.dirname(os.path.join(dest, name)) for _, name in members}:
+        os.makedirs(directory, exist_ok=True)
+    # Крупные файлы первыми - равномернее загрузка потоков
+    members.sort(key=lambda m: m[0].file_size, reverse=True)
+
+    local = threading.local()
+    handles = []
+    lock = threading.Lock()
+
+    def extract_one(member):
+        info, name = member
+        zip_ref = getattr(local, 'zip_ref', None)
+        if zip_ref is None:
+            zip_ref = local.zip_ref = zipfile.ZipFile(archive_path, 'r')
+            with lock:
+                handles.append(zip_ref)
+        with zip_ref.open(info) as src:
+            return name, write_slice(src, os.path.join(dest, stored_name(name, codec)), codec, level)
+
+    def collect(results):
+        entries = {}
+        for name, entry in results:
+            entries[name] = entry
+            if on_member is not None:
+                on_member(len(entries), len(members))
+        return entries
+
+    try:
+        if threads <= 1 or len(members) <= 1:
+            entries = collect(map(extract_one, members))
+        else:
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                entries = collect(pool.map(extract_one, members))
+    finally:
+        for zip_ref in handles:
+            zip_ref.close()
+    return entries
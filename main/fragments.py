@@ -0,0 +1,97 @@
+# fragments.py
+# Кэш готовых представлений приемов (фрагментов ответа).
+# Представление приема собирается из нескольких таблиц и манифеста серии на
+# диске, поэтому списки кэшируют его по одному приему. Ключ фрагмента:
+# id и updated_at приема, общая версия (меняется при правке библиотеки) и
+# параметры запроса, от которых зависит ответ. Сигналы на запись пациента,
+# расчета и загрузок обновляют updated_at приема (main/signals.py), так что
+# старые фрагменты просто перестают читаться и вытесняются кэшем.
+# Бэкенд задается алиасом FRAGMENT_CACHE_ALIAS в CACHES: локальная память,
+# файлы или общий Redis/Memcached.
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework import serializers
+
+# Параметры запроса, меняющие представление приема
+VARIANT_PARAMS = ('fields', 'expand', 'dicom', 'size', 'image_format')
+GLOBAL_VERSION_KEY = 'frag:version'
+
+
+def fragment_cache():
+    return caches[getattr(settings, 'FRAGMENT_CACHE_ALIAS', 'fragments')]
+
+
+def fragment_timeout():
+    return getattr(settings, 'FRAGMENT_CACHE_TIMEOUT', 24 * 3600)
+
+
+def _variant(serializer):
+    # Абсолютные ссылки зависят от схемы и хоста, остальное - от параметров запроса
+    request = serializer.context.get('request')
+    parts = [type(serializer).__name__]
+    if request is not None:
+        parts += [request.scheme, request.get_host()]
+        parts += [f"{name}={request.query_params.get(name, '')}" for name in VARIANT_PARAMS]
+    return hashlib.sha1('|'.join(parts).encode()).hexdigest()[:16]
+
+
+def global_version(cache):
+    # Если ключ вытеснен, заводим новую версию, а не возвращаемся к старой
+    version = cache.get(GLOBAL_VERSION_KEY)
+    if version is None:
+        cache.add(GLOBAL_VERSION_KEY, uuid.uuid4().hex[:12], None)
+        version = cache.get(GLOBAL_VERSION_KEY)
+    return version
+
+
+def fragment_key(variant, version, instance):
+    return f"frag:{variant}:{version}:{instance.pk}:{instance.updated_at.timestamp():.6f}"
+
+
+def render_cached(serializer, instances, render):
+    """
+    Представления instances в исходном порядке: готовые берутся из кэша,
+    недостающие строятся render(instance) и сохраняются.
+    """
+    instances = list(instances)
+    if not instances:
+        return []
+    if any(instance.pk is None or instance.updated_at is None for instance in instances):
+        return [render(instance) for instance in instances]
+    cache = fragment_cache()
+    variant, version = _variant(serializer), global_version(cache)
+    keys = [fragment_key(variant, version, instance) for instance in instances]
+    cached = cache.get_many(keys)
+    result, missing = [], {}
+    for key, instance in zip(keys, instances):
+        if key not in cached:
+            cached[key] = missing[key] = render(instance)
+        result.append(cached[key])
+    if missing:
+        cache.set_many(missing, fragment_timeout())
+    return result
+
+
+def invalidate_all():
+    # После коммита: иначе параллельный запрос успеет закэшировать старые данные
+    transaction.on_commit(lambda: fragment_cache().set(GLOBAL_VERSION_KEY, uuid.uuid4().hex[:12], None))
+
+
+class CachedFragmentListSerializer(serializers.ListSerializer):
+    # Список собирается из кэшированных представлений отдельных приемов
+    def to_representation(self, data):
+        iterable = data.all() if hasattr(data, 'all') else data
+        return render_cached(self.child, iterable, self.child.render_fragment)
+
+
+class CachedFragmentMixin:
+    # Одиночный прием тоже читается из кэша
+    def to_representation(self, instance):
+        return render_cached(self, [instance], self.render_fragment)[0]
+
+    def render_fragment(self, instance):
+        return super().to_representation(instance)
@@ -0,0 +1,110 @@
+# images.py
+# Уменьшенные копии изображений библиотеки имплантов (WebP и JPEG).
+# Имена файлов содержат хеш содержимого, поэтому их можно кэшировать
+# в браузере и на nginx бессрочно: новое изображение - новое имя.
+import hashlib
+import io
+import os
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image
+
+from .models import ImplantLibrary
+
+VARIANTS_DIR = 'image_variants'
+IMAGE_FIELDS = ('visualization_image', 'density_graph')
+DEFAULT_SIZES = {
+    'thumb': 160,
+    'card': 480,
+    'large': 1280,
+}
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 85, 'optimize': True, 'progressive': True}),
+}
+
+
+def variant_sizes():
+    return getattr(settings, 'IMAGE_VARIANT_SIZES', None) or DEFAULT_SIZES
+
+
+def _render(image, max_side, pil_format, options):
+    copy = image.copy()
+    copy.thumbnail((max_side, max_side), Image.LANCZOS)
+    if pil_format == 'JPEG' and copy.mode not in ('RGB', 'L'):
+        # У JPEG нет прозрачности - кладем на белый фон
+        background = Image.new('RGB', copy.size, (255, 255, 255))
+        background.paste(copy, mask=copy.convert('RGBA').split()[-1])
+        copy = background
+    buf = io.BytesIO()
+    copy.save(buf, pil_format, **options)
+    return buf.getvalue()
+
+
+def build_variants(field_file, field_name):
+    """
+    Строит все размеры и форматы для одного поля.
+    Возвращает {размер: {формат: путь в хранилище}}.
+    """
+    variants = {}
+    with field_file.open('rb') as f:
+        image = Image.open(f)
+        image.load()
+    for size, max_side in variant_sizes().items():
+        variants[size] = {}
+        for fmt, (pil_format, options) in FORMATS.items():
+            data = _render(image, max_side, pil_format, options)
+            digest = hashlib.sha256(data).hexdigest()[:20]
+            name = os.path.join(VARIANTS_DIR, field_name, digest[:2], f"{digest}_{size}.{fmt}")
+            if not default_storage.exists(name):
+                default_storage.save(name, ContentFile(data))
+            variants[size][fmt] = name
+    return variants
+
+
+def build_image_variants(item):
+    # Пересобирает копии для всех полей-изображений варианта библиотеки
+    old_names = set(variant_names(item))
+    item.image_variants = {
+        field: build_variants(getattr(item, field), field)
+        for field in IMAGE_FIELDS
+        if getattr(item, field)
+    }
+    item.save(update_fields=['image_variants'])
+    delete_variant_files(item, old_names - set(variant_names(item)))
+
+
+def variant_names(item):
+    for sizes in (item.image_variants or {}).values():
+        for formats in sizes.values():
+            yield from formats.values()
+
+
+def delete_variant_files(item, names):
+    # Одинаковые картинки дают одинаковые имена - не трогаем файлы других вариантов
+    if not names:
+        return
+    in_use = set()
+    for other in ImplantLibrary.objects.exclude(pk=item.pk).only('image_variants'):
+        in_use.update(variant_names(other))
+    for name in set(names) - in_use:
+        if default_storage.exists(name):
+            default_storage.delete(name)
+
+
+def image_url(request, item, field, size=None, fmt=None):
+    """
+    Ссылка на изображение нужного размера. Без size (или если копии еще
+    не построены) - ссылка на оригинал.
+    """
+    original = getattr(item, field)
+    if not original:
+        return None
+    name = None
+    if size:
+        formats = (item.image_variants or {}).get(field, {}).get(size, {})
+        name = formats.get(fmt or 'webp') or formats.get('jpeg')
+    url = default_storage.url(name) if name else original.url
+    return request.build_absolute_uri(url)
@@ -0,0 +1,216 @@
+import http.client
+import os
+import random
+import signal
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework_simplejwt.tokens import AccessToken
+
+from main.models import MedicalCase, Patient
+from smartdentist_backend.server import PROFILES, gunicorn_settings
+
+BENCH_EMAIL = 'bench@smartdentist.local'
+BENCH_SURNAME = 'Нагрузочный'
+BOOT_TIMEOUT = 120
+# (вес, адрес); {patient} - случайный пациент из засеянных
+LOAD_MIX = (
+    (4, '/api/patients/{patient}/cases/'),
+    (2, '/api/patients/'),
+    (2, '/api/cases/?dicom=compact'),
+    (1, '/api/sync/'),
+    (1, '/api/stats/dashboard/'),
+    (1, '/api/library/'),
+)
+
+
+def _memory_kb(pid):
+    # PSS учитывает общие страницы (preload_app) долями, RSS - целиком
+    for path, field in ((f'/proc/{pid}/smaps_rollup', 'Pss:'), (f'/proc/{pid}/status', 'VmRSS:')):
+        try:
+            with open(path) as f:
+                for line in f:
+                    if line.startswith(field):
+                        return int(line.split()[1])
+        except OSError:
+            continue
+    return 0
+
+
+def _children(pid):
+    result = []
+    for name in os.listdir('/proc'):
+        if name.isdigit():
+            try:
+                with open(f'/proc/{name}/stat') as f:
+                    if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                        result.append(int(name))
+            except (OSError, ValueError, IndexError):
+                continue
+    return result
+
+
+class Command(BaseCommand):
+    help = (
+        "Сравнивает профили gunicorn (smartdentist_backend/server.py) под воспроизводимой нагрузкой: "
+        "время запуска, запросов в секунду, задержки и память воркеров"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--configs', default='api,api:nopreload,all',
+                            help="Профили через запятую: роль[:nopreload][:workers=N][:threads=N]")
+        parser.add_argument('--requests', type=int, default=2000, help="Запросов на профиль")
+        parser.add_argument('--concurrency', type=int, default=16, help="Одновременных клиентов")
+        parser.add_argument('--seed', type=int, default=1, help="Зерно генератора данных и нагрузки")
+        parser.add_argument('--patients', type=int, default=200, help="Засеять пациентов (если их меньше)")
+        parser.add_argument('--cases-per-patient', type=int, default=3)
+        parser.add_argument('--port', type=int, default=8790)
+
+    def handle(self, *args, **options):
+        patient_ids, token = self.seed(options['patients'], options['cases_per_patient'], options['seed'])
+        rng = random.Random(options['seed'])
+        paths = rng.choices(
+            [path for _, path in LOAD_MIX], weights=[weight for weight, _ in LOAD_MIX], k=options['requests']
+        )
+        paths = [path.format(patient=rng.choice(patient_ids)) for path in paths]
+        self.stdout.write(
+            f"Пациентов: {len(patient_ids)}, запросов: {len(paths)}, клиентов: {options['concurrency']}"
+        )
+        self.stdout.write(
+            f"{'профиль':<22} {'воркеры':>8} {'запуск с':>9} {'запр/с':>8} {'p50 мс':>7} {'p95 мс':>7} "
+            f"{'p99 мс':>7} {'ошибки':>7} {'память МБ':>10}"
+        )
+        for config in options['configs'].split(','):
+            row = self.bench(config.strip(), paths, token, options['concurrency'], options['port'])
+            self.stdout.write(
+                f"{config:<22} {row['workers']:>8} {row['boot']:>9.2f} {row['rps']:>8.0f} {row['p50']:>7.1f} "
+                f"{row['p95']:>7.1f} {row['p99']:>7.1f} {row['errors']:>7} {row['memory'] / 1024:>10.0f}"
+            )
+
+    def seed(self, patients, cases_per_patient, seed):
+        # Детерминированные данные; уже засеянное не дублируется
+        Account = get_user_model()
+        user = Account.objects.filter(email=BENCH_EMAIL).first()
+        if user is None:
+            user = Account.objects.create_admin(email=BENCH_EMAIL, name='Нагрузка', surname='Тест')
+        rng = random.Random(seed)
+        existing = Patient.objects.filter(surname=BENCH_SURNAME).count()
+        for i in range(existing, patients):
+            patient = Patient.objects.create(
+                name=f"Пациент{i}", surname=BENCH_SURNAME, patronymic='',
+                birth_date=date(1950 + rng.randrange(60), rng.randrange(1, 13), rng.randrange(1, 29)),
+                gender=rng.randrange(2),
+            )
+            MedicalCase.objects.bulk_create(
+                MedicalCase(patient=patient, user=user, diagnosis=f"Диагноз {rng.randrange(1000)}")
+                for _ in range(cases_per_patient)
+            )
+        ids = list(Patient.objects.filter(surname=BENCH_SURNAME).order_by('id').values_list('id', flat=True))
+        return ids, str(AccessToken.for_user(user))
+
+    @staticmethod
+    def parse_config(config):
+        role, *flags = config.split(':')
+        if role not in PROFILES:
+            raise CommandError(f"Неизвестная роль: {role}")
+        env = {'SERVER_ROLE': role}
+        for flag in flags:
+            name, _, value = flag.partition('=')
+            if name == 'nopreload':
+                env['GUNICORN_PRELOAD'] = '0'
+            elif name in ('workers', 'threads') and value.isdigit():
+                env[f'GUNICORN_{name.upper()}'] = value
+            else:
+                raise CommandError(f"Неизвестный параметр профиля: {flag}")
+        return env
+
+    def bench(self, config, paths, token, concurrency, port):
+        env = dict(os.environ, GUNICORN_BIND=f'127.0.0.1:{port}', **self.parse_config(config))
+        options = gunicorn_settings(environ=env)
+        conf = os.path.join(settings.BASE_DIR, 'smartdentist_backend', 'gunicorn.conf.py')
+        started = time.monotonic()
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', conf, '--log-level', 'warning'],
+            cwd=settings.BASE_DIR, env=env,
+        )
+        try:
+            boot = self.wait_ready(port, started, server, token)
+            # Прогрев: первые запросы каждого воркера не учитываются
+            self.run_load(paths[:concurrency * 4], token, concurrency, port)
+            memory = sum(_memory_kb(pid) for pid in [server.pid] + _children(server.pid))
+            start = time.monotonic()
+            latencies, errors = self.run_load(paths, token, concurrency, port)
+            elapsed = time.monotonic() - start
+        finally:
+            server.send_signal(signal.SIGTERM)
+            try:
+                server.wait(timeout=60)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        latencies.sort()
+        quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+        return {
+            "workers": f"{options['workers']}x{options['threads']}",
+            "boot": boot,
+            "rps": len(paths) / elapsed,
+            "p50": quantiles[49] * 1000,
+            "p95": quantiles[94] * 1000,
+            "p99": quantiles[98] * 1000,
+            "errors": errors,
+            "memory": memory,
+        }
+
+    @staticmethod
+    def wait_ready(port, started, server, token):
+        # Время от запуска процесса до первого ответа
+        while time.monotonic() - started < BOOT_TIMEOUT:
+            if server.poll() is not None:
+                raise CommandError(f"gunicorn завершился с кодом {server.returncode}")
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+                conn.request('GET', '/api/library/', headers={'Authorization': f'Bearer {token}'})
+                conn.getresponse().read()
+                conn.close()
+                return time.monotonic() - started
+            except OSError:
+                time.sleep(0.05)
+        raise CommandError("Сервер не запустился")
+
+    @staticmethod
+    def run_load(paths, token, concurrency, port):
+        latencies, errors = [], [0]
+        lock = threading.Lock()
+        headers = {'Authorization': f'Bearer {token}'}
+
+        def client(part):
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+            local, failed = [], 0
+            for path in part:
+                start = time.monotonic()
+                try:
+                    conn.request('GET', path, headers=headers)
+                    response = conn.getresponse()
+                    response.read()
+                    if response.status >= 400:
+                        failed += 1
+                except (OSError, http.client.HTTPException):
+                    failed += 1
+                    conn.close()
+                    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+                local.append(time.monotonic() - start)
+            conn.close()
+            with lock:
+                latencies.extend(local)
+                errors[0] += failed
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(client, [paths[i::concurrency] for i in range(concurrency)]))
+        return latencies, errors[0]
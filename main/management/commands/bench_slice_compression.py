@@ -0,0 +1,106 @@
+import io
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main.models import MedicalCase
+from main.dicom_storage import case_dicom_dir, case_codec, case_slices
+from main.slices import CODEC_NONE, CHUNK_SIZE, open_slice, read_slice, stored_name, write_slice
+
+
+class Command(BaseCommand):
+    help = (
+        "Сравнивает режимы хранения срезов: объем на диске, время сжатия, "
+        "время чтения с диска и распаковки. Источник - архив или серия приема"
+    )
+
+    def add_arguments(self, parser):
+        source = parser.add_mutually_exclusive_group(required=True)
+        source.add_argument('--archive', help="ZIP-архив с серией DICOM")
+        source.add_argument('--case', type=int, help="ID приема с уже загруженной серией")
+        parser.add_argument('--codecs', default='none,zlib,zstd', help="Список кодеков через запятую")
+        parser.add_argument('--levels', default='1,3,6,9', help="Уровни сжатия через запятую")
+        parser.add_argument('--repeat', type=int, default=3, help="Число повторов чтения")
+
+    def handle(self, *args, **options):
+        slices = self._load_slices(options)
+        if not slices:
+            raise CommandError("Серия пуста")
+        raw_total = sum(len(data) for data in slices.values())
+        self.stdout.write(f"Срезов: {len(slices)}, исходный объем: {raw_total / 2 ** 20:.1f} МБ")
+        self.stdout.write(
+            f"{'кодек':<6} {'ур.':>3} {'МБ на диске':>11} {'коэф.':>6} {'сжатие МБ/с':>12} "
+            f"{'чтение МБ/с':>12} {'распаковка МБ/с':>16}"
+        )
+
+        for codec in options['codecs'].split(','):
+            codec = '' if codec == 'none' else codec
+            levels = [0] if codec == CODEC_NONE else [int(x) for x in options['levels'].split(',')]
+            for level in levels:
+                try:
+                    row = self._bench(slices, codec, level, options['repeat'])
+                except RuntimeError as e:
+                    self.stderr.write(f"{codec or 'none'}: {e}")
+                    break
+                stored, t_write, t_read, t_decode = row
+                mb = raw_total / 2 ** 20
+                self.stdout.write(
+                    f"{codec or 'none':<6} {level:>3} {stored / 2 ** 20:>11.1f} {raw_total / stored:>6.2f} "
+                    f"{mb / t_write:>12.0f} {mb / t_read:>12.0f} {mb / t_decode:>16.0f}"
+                )
+
+    def _load_slices(self, options):
+        slices = {}
+        if options['archive']:
+            with zipfile.ZipFile(options['archive']) as zf:
+                for info in zf.infolist():
+                    if not info.is_dir():
+                        slices[info.filename] = zf.read(info)
+            return slices
+
+        case = MedicalCase.objects.select_related('dicom_series').filter(id=options['case']).first()
+        if case is None:
+            raise CommandError("Прием не найден")
+        series_dir, codec = case_dicom_dir(case), case_codec(case)
+        for rel_path, _ in case_slices(case):
+            slices[rel_path] = read_slice(series_dir, rel_path, codec)
+        return slices
+
+    def _bench(self, slices, codec, level, repeat):
+        tmp = tempfile.mkdtemp(prefix='slice_bench_')
+        try:
+            names = [f"{i:06d}" for i in range(len(slices))]
+            stored_total = 0
+            start = time.perf_counter()
+            for name, data in zip(names, slices.values()):
+                path = os.path.join(tmp, stored_name(name, codec))
+                stored_total += write_slice(io.BytesIO(data), path, codec, level)[1]
+            t_write = time.perf_counter() - start
+
+            # Чтение сжатых байтов с диска (без распаковки)
+            t_read = float('inf')
+            for _ in range(repeat):
+                start = time.perf_counter()
+                for name in names:
+                    with open(os.path.join(tmp, stored_name(name, codec)), 'rb') as f:
+                        while f.read(CHUNK_SIZE):
+                            pass
+                t_read = min(t_read, time.perf_counter() - start)
+
+            # Полный путь отдачи: чтение + распаковка
+            t_decode = float('inf')
+            for _ in range(repeat):
+                start = time.perf_counter()
+                for name in names:
+                    with open_slice(tmp, name, codec) as f:
+                        while f.read(CHUNK_SIZE):
+                            pass
+                t_decode = min(t_decode, time.perf_counter() - start)
+            return stored_total, t_write, t_read, t_decode
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from main.images import build_image_variants
+from main.models import ImplantLibrary
+
+
+class Command(BaseCommand):
+    help = "Строит уменьшенные копии изображений для вариантов библиотеки"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help="Пересобрать и те, у которых копии уже есть")
+
+    def handle(self, *args, **options):
+        items = ImplantLibrary.objects.all()
+        count = 0
+        for item in items:
+            if item.image_variants and not options['all']:
+                continue
+            build_image_variants(item)
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f"Обработано вариантов: {count}"))
@@ -0,0 +1,51 @@
+import os
+import shutil
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from main.archive_store import STORAGE_ARCHIVE, evict, storage_mode
+from main.dicom_storage import convert_series, legacy_case_relpath
+from main.models import DicomSeries, MedicalCase
+from main.slices import CODEC_ARCHIVE
+
+
+class Command(BaseCommand):
+    help = "Приводит папки серий DICOM к режиму хранения DICOM_STORAGE_MODE и чистит кэш распаковки по квоте"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Только показать серии, которые будут пересобраны")
+        parser.add_argument('--legacy', action='store_true',
+                            help="Удалить старые папки dicoms/case_<id> у приемов, уже привязанных к серии")
+
+    def handle(self, *args, **options):
+        to_archive = storage_mode() == STORAGE_ARCHIVE
+        series_list = DicomSeries.objects.select_related('blob')
+        series_list = series_list.exclude(codec=CODEC_ARCHIVE) if to_archive else series_list.filter(codec=CODEC_ARCHIVE)
+
+        converted, before, after = 0, 0, 0
+        for series in series_list.iterator():
+            if not series.blob.file:
+                self.stdout.write(self.style.WARNING(f"Нет архива для серии {series.path}, пропускаем"))
+                continue
+            if options['dry_run']:
+                self.stdout.write(f"{series.path}: {series.total_size} байт")
+                continue
+            old_size, new_size = convert_series(series)
+            before += old_size
+            after += new_size
+            converted += 1
+
+        if options['legacy']:
+            for case_id in MedicalCase.objects.exclude(dicom_series=None).values_list('id', flat=True):
+                legacy_dir = os.path.join(settings.MEDIA_ROOT, legacy_case_relpath(case_id))
+                if os.path.isdir(legacy_dir):
+                    self.stdout.write(f"Старая папка: {legacy_dir}")
+                    if not options['dry_run']:
+                        shutil.rmtree(legacy_dir, ignore_errors=True)
+
+        evicted = evict() if not options['dry_run'] else []
+        self.stdout.write(self.style.SUCCESS(
+            f"Пересобрано серий: {converted}, объем на диске {before / 1024 ** 2:.1f} -> {after / 1024 ** 2:.1f} МБ, "
+            f"удалено из кэша распаковки: {len(evicted)}"
+        ))
@@ -0,0 +1,25 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from main.dicom_storage import collect_garbage
+
+
+class Command(BaseCommand):
+    help = "Удаляет архивы DICOM и распакованные серии, на которые не ссылается ни один прием"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace-hours', type=float, default=24,
+                            help="Не трогать блобы, использованные за последние N часов")
+        parser.add_argument('--dry-run', action='store_true', help="Только показать, что будет удалено")
+
+    def handle(self, *args, **options):
+        removed = collect_garbage(
+            grace=timedelta(hours=options['grace_hours']),
+            dry_run=options['dry_run']
+        )
+        for sha256, freed in removed:
+            self.stdout.write(f"{sha256} {freed}")
+        total = sum(freed for _, freed in removed)
+        verb = "Будет удалено" if options['dry_run'] else "Удалено"
+        self.stdout.write(self.style.SUCCESS(f"{verb} блобов: {len(removed)}, освобождено байт: {total}"))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from main.dicom_index import index_series
+from main.dicom_storage import series_dir
+from main.models import DicomSeries
+
+
+class Command(BaseCommand):
+    help = "Строит индекс заголовков DICOM для серий, загруженных до его появления"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help="Переиндексировать и уже проиндексированные серии")
+
+    def handle(self, *args, **options):
+        series_list = DicomSeries.objects.all()
+        if not options['force']:
+            series_list = series_list.filter(indexed_at=None)
+
+        indexed, instances = 0, 0
+        for series in series_list.iterator():
+            try:
+                count = index_series(series, series_dir(series), force=options['force'])
+            except OSError as e:
+                self.stdout.write(self.style.WARNING(f"{series.path}: {e}"))
+                continue
+            indexed += 1
+            instances += count
+        self.stdout.write(self.style.SUCCESS(f"Проиндексировано серий: {indexed}, снимков: {instances}"))
@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+import zipfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from main.dicom_index import index_series
+from main.dicom_storage import extract_series, legacy_case_relpath, series_dir, store_blob
+from main.models import DICOMUpload, DicomSeries, MedicalCase
+from main.storage import copy_series, get_storage
+
+
+class Command(BaseCommand):
+    help = (
+        "Переносит данные DICOM в текущую раскладку: старые архивы DICOMUpload.file - в блобы, "
+        "папки dicoms/case_<id> - в общие серии, серии - в хранилище DICOM_SERIES_STORAGE"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Только показать, что будет перенесено")
+        parser.add_argument('--keep-source', action='store_true',
+                            help="Не удалять серии из прежнего хранилища после копирования")
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        uploads = self.migrate_uploads(dry_run)
+        cases = self.migrate_case_dirs(dry_run)
+        moved, size = self.migrate_series(dry_run, options['keep_source'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Архивов перенесено в блобы: {uploads}, папок приемов - в серии: {cases}, "
+            f"серий перенесено в хранилище {get_storage().name}: {moved} ({size / 1024 ** 2:.1f} МБ)"
+        ))
+
+    def migrate_uploads(self, dry_run):
+        # Архивы, загруженные до хранилища блобов
+        count = 0
+        for upload in DICOMUpload.objects.exclude(file='').iterator():
+            self.stdout.write(f"Архив {upload.file.name}")
+            if dry_run:
+                count += 1
+                continue
+            try:
+                with upload.file.open('rb') as f:
+                    blob, _ = store_blob(f)
+            except OSError as e:
+                self.stdout.write(self.style.WARNING(f"{upload.file.name}: {e}"))
+                continue
+            upload.file.delete(save=False)
+            upload.blob = upload.blob or blob
+            upload.sha256 = upload.sha256 or blob.sha256
+            upload.size = upload.size or blob.size
+            upload.save(update_fields=['file', 'blob', 'sha256', 'size'])
+            count += 1
+        return count
+
+    def migrate_case_dirs(self, dry_run):
+        """
+        Старые папки dicoms/case_<id>: прием привязывается к общей серии из
+        своего архива, а если архива нет - из архива, собранного из папки.
+        """
+        count = 0
+        for case in MedicalCase.objects.select_related('dicom_series').iterator():
+            legacy_dir = os.path.join(settings.MEDIA_ROOT, legacy_case_relpath(case.id))
+            if not os.path.isdir(legacy_dir):
+                continue
+            self.stdout.write(f"Папка приема {case.id}: {legacy_dir}")
+            if dry_run:
+                count += 1
+                continue
+            if case.dicom_series_id is None:
+                upload = case.dicom_uploads.exclude(blob=None).select_related('blob').order_by('-uploaded_at').first()
+                blob = upload.blob if upload is not None else self.pack_dir(case, legacy_dir)
+                series = extract_series(blob)
+                if series.indexed_at is None:
+                    index_series(series, series_dir(series))
+                case.dicom_series = series
+                case.save(update_fields=['dicom_series', 'updated_at'])
+            shutil.rmtree(legacy_dir, ignore_errors=True)
+            count += 1
+        return count
+
+    @staticmethod
+    def pack_dir(case, legacy_dir):
+        # Архив из папки приема (имена - пути внутри папки), сохраняется как обычная загрузка
+        with tempfile.TemporaryFile() as tmp:
+            with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+                for root, dirs, files in os.walk(legacy_dir):
+                    dirs.sort()
+                    for name in sorted(files):
+                        path = os.path.join(root, name)
+                        zip_ref.write(path, os.path.relpath(path, legacy_dir).replace('\\', '/'))
+            blob, _ = store_blob(tmp)
+        DICOMUpload.objects.create(case=case, blob=blob, sha256=blob.sha256, size=blob.size)
+        return blob
+
+    def migrate_series(self, dry_run, keep_source):
+        target = get_storage()
+        moved, size = 0, 0
+        for series in DicomSeries.objects.exclude(storage=target.name).iterator():
+            self.stdout.write(f"{series.storage} -> {target.name}: {series.path}")
+            if dry_run:
+                moved += 1
+                continue
+            source = get_storage(series.storage)
+            try:
+                size += copy_series(series.path, source, target)
+            except OSError as e:
+                self.stdout.write(self.style.WARNING(f"{series.path}: {e}"))
+                continue
+            series.storage = target.name
+            series.save(update_fields=['storage'])
+            if not keep_source:
+                source.delete(series.path)
+            moved += 1
+        return moved, size
@@ -0,0 +1,50 @@
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main.models import ImplantLibrary
+from main.processing import default_workers, process_batch
+
+
+class Command(BaseCommand):
+    help = "Обрабатывает архивы DICOM пачкой на пуле процессов: process_dicom_batch 12=/path/a.zip 13=/path/b.zip"
+
+    def add_arguments(self, parser):
+        parser.add_argument('pairs', nargs='+', help="Пары <id приема>=<путь к архиву>")
+        parser.add_argument('--workers', type=int, default=None, help="Число процессов (по умолчанию - число ядер)")
+        parser.add_argument('--max-in-flight', type=int, default=None,
+                            help="Сколько архивов обрабатывать одновременно (по умолчанию 2 * workers)")
+
+    def handle(self, *args, **options):
+        if not ImplantLibrary.objects.exists():
+            raise CommandError("Библиотека пуста")
+
+        items = []
+        for pair in options['pairs']:
+            case_id, sep, path = pair.partition('=')
+            if not sep or not case_id.isdigit():
+                raise CommandError(f"Ожидается <id приема>=<путь>: {pair}")
+            items.append((int(case_id), path))
+
+        opened = []
+        try:
+            for case_id, path in items:
+                try:
+                    opened.append((case_id, open(path, 'rb')))
+                except OSError as e:
+                    raise CommandError(f"{path}: {e}")
+
+            workers = options['workers'] or default_workers()
+            self.stdout.write(f"Архивов: {len(opened)}, процессов: {workers}")
+            process_batch(
+                opened,
+                workers=workers,
+                max_in_flight=options['max_in_flight'],
+                on_result=lambda item: self.stdout.write(json.dumps(item, ensure_ascii=False)),
+                # Команда однопоточная: fork безопасен и быстрее запуска интерпретатора
+                start_method='fork' if os.name == 'posix' else None,
+            )
+        finally:
+            for _, f in opened:
+                f.close()
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from main.sync import purge_tombstones
+
+
+class Command(BaseCommand):
+    help = "Удаляет отметки об удалении старше SYNC_TOMBSTONE_DAYS"
+
+    def handle(self, *args, **options):
+        count = purge_tombstones()
+        self.stdout.write(self.style.SUCCESS(f"Удалено отметок: {count}"))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from main.stats import rollup
+
+
+class Command(BaseCommand):
+    help = "Пересчитывает счетчики статистики панели администратора по приемам и расчетам"
+
+    def handle(self, *args, **options):
+        count = rollup()
+        self.stdout.write(self.style.SUCCESS(f"Пересчитано корзин: {count}"))
@@ -0,0 +1,369 @@
+# memprofile.py
+# Профилирование памяти горячих путей: загрузка архива, распаковка серии и
+# сериализация списка приемов. Включается MEMPROFILE_ENABLED.
+# Для каждого обернутого запроса (memory_profiled) снимается RSS процесса до
+# и после; рост больше MEMPROFILE_RSS_WARN_MB попадает в журнал всегда.
+# Для доли MEMPROFILE_SAMPLE_RATE запросов на время запроса включается
+# tracemalloc: пик и оставшиеся после запроса аллокации Python и numpy,
+# крупнейшие места аллокаций, а у частей запроса (memory_section) - свой пик.
+# tracemalloc общий на процесс, поэтому профилируется не больше одного
+# запроса процесса за раз; аллокации соседних потоков (gthread, потоки
+# распаковки) попадают в него же.
+# Журнал - лог main.memprofile и файл процесса в MEMPROFILE_DIR, из которых
+# /api/stats/memory/ собирает профили всех воркеров узла.
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from .permissions import IsAdminOrSuperAdmin
+
+try:
+    import resource
+except ImportError:
+    # Windows: пиковый RSS процесса недоступен
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = 'HTTP_X_MEMORY_PROFILE'
+# Файлы процессов, которые давно ничего не писали (воркер перезапущен)
+RETENTION_SECONDS = 24 * 3600
+# Служебные аллокации, которые не относятся к запросу
+_IGNORED = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+_lock = threading.Lock()
+_store_lock = threading.Lock()
+_active = None
+_recent = deque()
+_written = 0
+_pid = None
+# (MEMPROFILE_ENABLED, SAMPLE_RATE, TOP, FRAMES, порог RSS в байтах, KEEP) -
+# читаются один раз на процесс, как в audit.py
+_config = (False, 0.0, 10, 1, 0, 200)
+
+
+def enabled():
+    return getattr(settings, 'MEMPROFILE_ENABLED', False)
+
+
+def sample_rate():
+    return getattr(settings, 'MEMPROFILE_SAMPLE_RATE', 0.01)
+
+
+def top_sites():
+    return getattr(settings, 'MEMPROFILE_TOP', 10)
+
+
+def trace_frames():
+    return getattr(settings, 'MEMPROFILE_FRAMES', 1)
+
+
+def rss_warn_bytes():
+    return int(getattr(settings, 'MEMPROFILE_RSS_WARN_MB', 64) * 1024 ** 2)
+
+
+def keep():
+    return getattr(settings, 'MEMPROFILE_KEEP', 200)
+
+
+def profile_dir():
+    return getattr(settings, 'MEMPROFILE_DIR', None) or os.path.join(settings.BASE_DIR, 'memprofile')
+
+
+@functools.lru_cache(maxsize=None)
+def page_size():
+    try:
+        return os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return 4096
+
+
+def rss_bytes():
+    # /proc есть только в Linux, в остальных системах RSS запроса не считается
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * page_size()
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def max_rss_bytes():
+    if resource is None:
+        return 0
+    # ru_maxrss в Linux - в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _Profile:
+    def __init__(self, name):
+        self.name = name
+        self.thread = threading.get_ident()
+        self.sections = []
+        # [имя, traced в начале, пик до последнего reset_peak, время начала];
+        # первый элемент - запрос целиком
+        self.stack = [[name, 0, 0, time.monotonic()]]
+        self.largest_live = None
+
+
+def _configure():
+    global _config, _pid
+    with _lock:
+        if _pid == os.getpid():
+            return
+        _config = (enabled(), sample_rate(), top_sites(), trace_frames(), rss_warn_bytes(), keep())
+        _recent.__init__(maxlen=_config[5])
+        _pid = os.getpid()
+
+
+def _forced(request):
+    # Администратор может запросить профиль конкретного запроса заголовком
+    return request.META.get(PROFILE_HEADER) == '1' and IsAdminOrSuperAdmin().has_permission(request, None)
+
+
+def _begin(name, forced):
+    global _active
+    if not forced and random.random() >= _config[1]:
+        return None
+    if not _lock.acquire(blocking=False):
+        return None
+    if tracemalloc.is_tracing():
+        # Уже профилируется другой запрос или трассировка включена снаружи
+        _lock.release()
+        return None
+    tracemalloc.start(_config[3])
+    _active = _Profile(name)
+    return _active
+
+
+def _short(filename):
+    base = str(settings.BASE_DIR)
+    if filename.startswith(base):
+        return os.path.relpath(filename, base)
+    _, marker, rest = filename.rpartition('site-packages/')
+    return rest if marker else filename
+
+
+def _top(snapshot):
+    return [
+        {"site": f"{_short(stat.traceback[0].filename)}:{stat.traceback[0].lineno}", "size": stat.size,
+         "count": stat.count}
+        for stat in snapshot.filter_traces(_IGNORED).statistics('lineno')[:_config[2]]
+    ]
+
+
+@contextmanager
+def memory_section(name):
+    """
+    Часть профилируемого запроса: пик и прирост аллокаций внутри нее.
+    Вне профилируемого запроса (и в других потоках) ничего не делает.
+    """
+    profile = _active
+    if profile is None or profile.thread != threading.get_ident():
+        yield
+        return
+    current, peak = tracemalloc.get_traced_memory()
+    parent = profile.stack[-1]
+    parent[2] = max(parent[2], peak)
+    tracemalloc.reset_peak()
+    frame = [name, current, 0, time.monotonic()]
+    profile.stack.append(frame)
+    try:
+        yield
+    finally:
+        current, peak = tracemalloc.get_traced_memory()
+        profile.stack.pop()
+        section_peak = max(frame[2], peak)
+        parent[2] = max(parent[2], section_peak)
+        profile.sections.append({
+            "name": '/'.join(f[0] for f in profile.stack[1:] + [frame]),
+            "peak": section_peak - frame[1],
+            "retained": current - frame[1],
+            "seconds": round(time.monotonic() - frame[3], 3),
+        })
+        # Самый большой объем живых аллокаций на границах частей - места,
+        # которые держат память в середине запроса, а не только после него
+        if profile.largest_live is None or current > profile.largest_live["traced"]:
+            profile.largest_live = {"after": name, "traced": current, "top": _top(tracemalloc.take_snapshot())}
+
+
+def _finish(profile, name, request, status, rss_before, seconds):
+    global _active
+    rss_after = rss_bytes()
+    record = {
+        "time": round(time.time(), 3), "pid": os.getpid(), "name": name, "method": request.method,
+        "path": request.path[:255], "status": status, "seconds": round(seconds, 3),
+        "rss_before": rss_before, "rss_after": rss_after, "rss_delta": rss_after - rss_before,
+        "max_rss": max_rss_bytes(),
+    }
+    if profile is not None:
+        try:
+            current, peak = tracemalloc.get_traced_memory()
+            top = _top(tracemalloc.take_snapshot())
+        finally:
+            _active = None
+            tracemalloc.stop()
+            _lock.release()
+        record.update({
+            "traced_peak": max(profile.stack[0][2], peak), "traced_retained": current, "top": top,
+            "sections": profile.sections, "largest_live": profile.largest_live,
+        })
+    elif record["rss_delta"] < _config[4]:
+        return None
+    _store(record)
+    _log(record)
+    return record
+
+
+def memory_profiled(name):
+    """
+    Декоратор метода представления (self, request, ...): RSS запроса и, по
+    выборке, профиль tracemalloc под именем name.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(view, request, *args, **kwargs):
+            if _pid != os.getpid():
+                _configure()
+            if not _config[0]:
+                return method(view, request, *args, **kwargs)
+            profile = _begin(name, _forced(request))
+            rss_before = rss_bytes()
+            started = time.monotonic()
+            status = None
+            try:
+                response = method(view, request, *args, **kwargs)
+                status = getattr(response, 'status_code', None)
+                return response
+            finally:
+                try:
+                    _finish(profile, name, request, status, rss_before, time.monotonic() - started)
+                except Exception:
+                    # Профилирование не должно ломать ответ
+                    logger.exception("Не удалось записать профиль памяти %s", name)
+        return wrapper
+    return decorator
+
+
+def _mb(value):
+    return f"{value / 1024 ** 2:.1f} МБ"
+
+
+def _log(record):
+    summary = (
+        f"{record['name']} {record['method']} {record['path']} {record['status']}: "
+        f"RSS {_mb(record['rss_after'])} ({'+' if record['rss_delta'] >= 0 else ''}{_mb(record['rss_delta'])}) "
+        f"за {record['seconds']} с"
+    )
+    if "traced_peak" in record:
+        summary += f", пик {_mb(record['traced_peak'])}, осталось {_mb(record['traced_retained'])}"
+        if record["top"]:
+            summary += "; " + ", ".join(f"{site['site']} {_mb(site['size'])}" for site in record["top"][:3])
+    level = logging.WARNING if record["rss_delta"] >= _config[4] else logging.INFO
+    logger.log(level, "Память: %s", summary)
+
+
+def _path(pid):
+    return os.path.join(profile_dir(), f"memprofile-{pid}.jsonl")
+
+
+def _store(record):
+    # Файл процесса дописывается построчно и переписывается из памяти,
+    # когда в нем накопилось вдвое больше MEMPROFILE_KEEP записей
+    global _written
+    with _store_lock:
+        _recent.append(record)
+        path = _path(os.getpid())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if _written >= 2 * _config[5]:
+            with open(f"{path}.tmp", 'w') as f:
+                f.writelines(json.dumps(r, ensure_ascii=False) + '\n' for r in _recent)
+            os.replace(f"{path}.tmp", path)
+            _written = len(_recent)
+        else:
+            with open(path, 'a') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            _written += 1
+
+
+def collect_profiles(name=None):
+    """
+    Профили всех процессов узла из MEMPROFILE_DIR, новые первыми.
+    Файлы процессов, не писавших дольше RETENTION_SECONDS, удаляются.
+    """
+    directory = profile_dir()
+    if not os.path.isdir(directory):
+        return []
+    now = time.time()
+    profiles = []
+    for filename in os.listdir(directory):
+        if not filename.endswith('.jsonl'):
+            continue
+        path = os.path.join(directory, filename)
+        try:
+            if now - os.path.getmtime(path) > RETENTION_SECONDS:
+                os.remove(path)
+                continue
+            with open(path) as f:
+                lines = f.readlines()
+        except OSError:
+            continue
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Строка, которую процесс дописывает прямо сейчас
+                continue
+            if name is None or record.get("name") == name:
+                profiles.append(record)
+    profiles.sort(key=lambda r: r.get("time", 0), reverse=True)
+    return profiles
+
+
+def summarize(profiles):
+    # Сводка по местам профилирования: где растет RSS и где пик аллокаций
+    groups = {}
+    for record in profiles:
+        groups.setdefault(record["name"], []).append(record)
+    summary = {}
+    for name, records in groups.items():
+        traced = [r for r in records if "traced_peak" in r]
+        summary[name] = {
+            "count": len(records),
+            "traced": len(traced),
+            "max_rss_delta": max(r["rss_delta"] for r in records),
+            "avg_rss_delta": sum(r["rss_delta"] for r in records) // len(records),
+            "max_traced_peak": max((r["traced_peak"] for r in traced), default=None),
+            "avg_traced_peak": sum(r["traced_peak"] for r in traced) // len(traced) if traced else None,
+            "avg_traced_retained": (
+                sum(r["traced_retained"] for r in traced) // len(traced) if traced else None
+            ),
+        }
+    return summary
+
+
+def _after_fork():
+    # Дочерний процесс (пул обработки) не продолжает профиль родителя
+    global _lock, _store_lock, _active, _pid, _written
+    if _active is not None and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _lock, _store_lock = threading.Lock(), threading.Lock()
+    _active, _pid, _written = None, None, 0
+    _recent.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
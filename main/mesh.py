@@ -0,0 +1,314 @@
+# mesh.py
+# Поверхность кости приема в STL/PLY.
+# Объем HU (main/volume.py) порогуется по MESH_BONE_HU, поверхность строится
+# марширующими тетраэдрами (каждый куб сетки делится на 6 тетраэдров по
+# общей диагонали - таблица случаев из трех вариантов вместо 256 у
+# марширующих кубов) и прореживается кластеризацией вершин по сетке до
+# MESH_TARGET_TRIANGLES треугольников. Объем обходится порциями по z, и
+# каждая порция прореживается сразу, поэтому память ограничена размером
+# порции и итоговой сетки. Файлы кэшируются по хешу серии и параметрам.
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+from django.conf import settings
+
+from .dicom_index import series_index
+from .storage import series_location
+from .volume import load_volume
+
+# Версия алгоритма входит в ключ кэша
+VERSION = 1
+FORMATS = ('stl', 'ply')
+CONTENT_TYPES = {'stl': 'model/stl', 'ply': 'application/octet-stream'}
+# Срезов сетки марширования в одной порции
+CHUNK_SLICES = 16
+# Шаг оценки площади поверхности и среднее число треугольников на куб
+# на границе (для выбора размера ячейки прореживания)
+ESTIMATE_STRIDE = 4
+TRIANGLES_PER_CUBE = 1.7
+
+# Вершины куба: бит 0 - x, бит 1 - y, бит 2 - z
+CORNERS = np.array([[(i >> 2) & 1, (i >> 1) & 1, i & 1] for i in range(8)])
+# Шесть тетраэдров вокруг диагонали 0-7: соседние кубы делят грани одинаково
+TETRAHEDRA = np.array([[0, 1, 3, 7], [0, 3, 2, 7], [0, 2, 6, 7], [0, 6, 4, 7], [0, 4, 5, 7], [0, 5, 1, 7]])
+# Для одной вершины тетраэдра - три остальные
+OTHERS = np.array([[1, 2, 3], [0, 2, 3], [0, 1, 3], [0, 1, 2]])
+# Для маски из двух вершин внутри - (внутри, внутри, снаружи, снаружи)
+PAIRS = np.zeros((16, 4), dtype=np.intp)
+for _mask in range(16):
+    _inside = [i for i in range(4) if _mask >> i & 1]
+    if len(_inside) == 2:
+        PAIRS[_mask] = _inside + [i for i in range(4) if not _mask >> i & 1]
+
+
+def bone_hu():
+    return float(getattr(settings, 'MESH_BONE_HU', 400))
+
+
+def target_triangles():
+    return int(getattr(settings, 'MESH_TARGET_TRIANGLES', 200000))
+
+
+def cache_root():
+    return os.path.join(settings.DICOM_CACHE_ROOT, 'meshes')
+
+
+def mesh_params(data):
+    # Канонические параметры: порог HU и целевое число треугольников
+    params = {"threshold": bone_hu(), "triangles": target_triangles()}
+    try:
+        if data.get('threshold'):
+            params["threshold"] = float(str(data['threshold']).replace(',', '.'))
+        if data.get('triangles'):
+            params["triangles"] = int(data['triangles'])
+    except ValueError:
+        raise ValueError("threshold и triangles: ожидаются числа")
+    if not 1000 <= params["triangles"] <= 5000000:
+        raise ValueError("triangles: допустимо от 1000 до 5000000")
+    return params
+
+
+def params_key(params):
+    payload = json.dumps([VERSION, params], sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()[:24]
+
+
+def mesh_path(sha256, key, fmt):
+    return os.path.join(cache_root(), sha256[:2], sha256, f"{key}.{fmt}")
+
+
+def _active(inside):
+    # Кубы, вершины которых по разные стороны порога: (z, y, x) левого нижнего угла
+    corners = [inside[dz:inside.shape[0] - 1 + dz, dy:inside.shape[1] - 1 + dy, dx:inside.shape[2] - 1 + dx]
+               for dz, dy, dx in CORNERS]
+    count = np.sum(corners, axis=0, dtype=np.int8)
+    return np.nonzero((count > 0) & (count < 8))
+
+
+def _downsample(block, stride):
+    # Среднее по блокам stride^3 (сглаживает, а не прореживает тонкую кость)
+    if stride == 1:
+        return np.asarray(block, dtype=np.float32)
+    z, y, x = (size // stride * stride for size in block.shape)
+    block = np.asarray(block[:z, :y, :x], dtype=np.float32)
+    return block.reshape(z // stride, stride, y // stride, stride, x // stride, stride).mean(axis=(1, 3, 5))
+
+
+def estimate_cell(volume, threshold, triangles):
+    """
+    Размер ячейки прореживания (в вокселях): по числу граничных кубов на
+    прореженной сетке оценивается площадь поверхности на полной.
+    """
+    coarse = np.asarray(volume[::ESTIMATE_STRIDE, ::ESTIMATE_STRIDE, ::ESTIMATE_STRIDE]) > threshold
+    cubes = len(_active(coarse)[0]) * ESTIMATE_STRIDE ** 2
+    return max(1.0, float(np.sqrt(TRIANGLES_PER_CUBE * cubes / triangles)))
+
+
+def _interpolate(points, values, a, b, threshold):
+    # Точка порога на ребре a-b тетраэдра; points (N, 4, 3), values (N, 4)
+    rows = np.arange(len(points))
+    va, vb = values[rows, a], values[rows, b]
+    t = ((threshold - va) / (vb - va))[:, None]
+    return points[rows, a] + t * (points[rows, b] - points[rows, a])
+
+
+def _orient(triangles, outward):
+    # Нормаль (по правилу правой руки) смотрит из кости наружу
+    normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    flip = np.einsum('ij,ij->i', normals, outward) < 0
+    triangles[flip] = triangles[flip][:, ::-1]
+    return triangles
+
+
+def march(values, threshold):
+    """
+    Марширующие тетраэдры по блоку values (z, y, x). Возвращает треугольники
+    (N, 3, 3) в координатах (z, y, x) сетки блока.
+    """
+    zs, ys, xs = _active(values > threshold)
+    if not len(zs):
+        return np.empty((0, 3, 3), dtype=np.float32)
+    base = np.stack([zs, ys, xs], axis=1)
+    corner_values = np.stack([values[zs + dz, ys + dy, xs + dx] for dz, dy, dx in CORNERS], axis=1)
+    corner_points = base[:, None, :] + CORNERS[None, :, :]
+
+    result = []
+    for tetrahedron in TETRAHEDRA:
+        tv = corner_values[:, tetrahedron]
+        tp = corner_points[:, tetrahedron].astype(np.float32)
+        inside = tv > threshold
+        mask = (inside * np.array([1, 2, 4, 8])).sum(axis=1)
+        count = inside.sum(axis=1)
+
+        # Одна вершина по свою сторону порога - один треугольник
+        single = (count == 1) | (count == 3)
+        if single.any():
+            v, p, ins = tv[single], tp[single], inside[single]
+            lone = np.where(count[single] == 1, np.argmax(ins, axis=1), np.argmin(ins, axis=1))
+            others = OTHERS[lone]
+            triangle = np.stack([_interpolate(p, v, lone, others[:, i], threshold) for i in range(3)], axis=1)
+            rows = np.arange(len(p))
+            outward = p[rows[:, None], others].mean(axis=1) - p[rows, lone]
+            outward[count[single] == 3] *= -1
+            result.append(_orient(triangle, outward))
+
+        # Две вершины внутри - четырехугольник из двух треугольников
+        double = count == 2
+        if double.any():
+            v, p = tv[double], tp[double]
+            i1, i2, o1, o2 = PAIRS[mask[double]].T
+            quad = [_interpolate(p, v, a, b, threshold) for a, b in ((i1, o1), (i1, o2), (i2, o2), (i2, o1))]
+            rows = np.arange(len(p))
+            outward = (p[rows, o1] + p[rows, o2] - p[rows, i1] - p[rows, i2]) / 2
+            result.append(_orient(np.stack([quad[0], quad[1], quad[2]], axis=1), outward))
+            result.append(_orient(np.stack([quad[0], quad[2], quad[3]], axis=1), outward))
+    return np.concatenate(result)
+
+
+class _Clusters:
+    # Прореживание кластеризацией: вершины в одной ячейке сетки сливаются
+    # в среднюю точку, вырожденные треугольники отбрасываются
+    def __init__(self, cell, shape):
+        self.cell = cell
+        self.dims = np.array([int(np.ceil(size / cell)) + 1 for size in shape], dtype=np.int64)
+        self.faces, self.keys, self.sums, self.counts = [], [], [], []
+
+    def add(self, triangles):
+        if not len(triangles):
+            return
+        cells = np.floor(triangles / self.cell).astype(np.int64)
+        keys = (cells[..., 0] * self.dims[1] + cells[..., 1]) * self.dims[2] + cells[..., 2]
+        keep = (keys[:, 0] != keys[:, 1]) & (keys[:, 1] != keys[:, 2]) & (keys[:, 0] != keys[:, 2])
+        self.faces.append(keys[keep])
+        # Суммы координат по ячейкам порции; между порциями сводятся в mesh()
+        unique, inverse = np.unique(keys.ravel(), return_inverse=True)
+        sums = np.zeros((len(unique), 3))
+        np.add.at(sums, inverse, triangles.reshape(-1, 3))
+        self.keys.append(unique)
+        self.sums.append(sums)
+        self.counts.append(np.bincount(inverse, minlength=len(unique)))
+
+    def mesh(self):
+        # (вершины (V, 3), треугольники (F, 3)) без повторов
+        if not self.faces:
+            return np.empty((0, 3)), np.empty((0, 3), dtype=np.int64)
+        faces = np.concatenate(self.faces)
+        # После слияния вершин разные треугольники могут совпасть. Пара с
+        # противоположным обходом - сплющенная складка поверхности: удаляем
+        # обе, иначе у оставшейся появятся незамкнутые ребра. Из совпавших
+        # с одним обходом оставляем один
+        order = np.argsort(faces, axis=1)
+        even = ((order[:, 0] < order[:, 1]).astype(np.int8) + (order[:, 1] < order[:, 2])
+                + (order[:, 0] < order[:, 2])) % 2 == 1
+        _, first, inverse = np.unique(np.sort(faces, axis=1), axis=0, return_index=True, return_inverse=True)
+        balance = np.bincount(inverse.ravel(), weights=np.where(even, 1, -1), minlength=len(first))
+        keep = np.zeros(len(faces), dtype=bool)
+        keep[first] = True
+        keep &= balance[inverse.ravel()] != 0
+        # Оставшийся треугольник должен иметь преобладающий обход
+        flip = keep & (np.where(even, 1, -1) * balance[inverse.ravel()] < 0)
+        faces[flip] = faces[flip][:, ::-1]
+        faces = faces[keep]
+
+        keys, inverse = np.unique(np.concatenate(self.keys), return_inverse=True)
+        sums = np.zeros((len(keys), 3))
+        np.add.at(sums, inverse, np.concatenate(self.sums))
+        counts = np.bincount(inverse, weights=np.concatenate(self.counts), minlength=len(keys))
+        used, face_index = np.unique(faces.ravel(), return_inverse=True)
+        position = np.searchsorted(keys, used)
+        vertices = sums[position] / counts[position, None]
+        return vertices, face_index.reshape(-1, 3)
+
+
+def extract_surface(volume, spacing, threshold, triangles):
+    """
+    Поверхность изоуровня threshold объема (z, y, x) с прореживанием примерно
+    до triangles треугольников. Возвращает (вершины (x, y, z) в мм, треугольники).
+    """
+    cell = estimate_cell(volume, threshold, triangles)
+    # Марширование по сетке с шагом не больше ячейки: мельче все равно сольется
+    stride = max(1, int(cell))
+    clusters = _Clusters(cell, volume.shape)
+    depth = volume.shape[0]
+    chunk = CHUNK_SLICES * stride
+    for z0 in range(0, depth - 1, chunk):
+        # Порции перекрываются на один срез сетки, чтобы не терять кубы на стыке
+        block = _downsample(volume[z0:min(depth, z0 + chunk + stride)], stride)
+        if block.shape[0] < 2:
+            continue
+        # Узел уменьшенной сетки - центр блока stride^3 исходных вокселей
+        shift = np.array([z0, 0, 0], dtype=np.float32) + (stride - 1) / 2
+        clusters.add(march(block, threshold) * stride + shift)
+    vertices, faces = clusters.mesh()
+    # (z, y, x) в вокселях -> (x, y, z) в мм; перестановка осей меняет
+    # ориентацию, поэтому обход треугольников тоже разворачивается
+    vertices = (vertices * np.asarray(spacing))[:, ::-1]
+    return vertices, faces[:, ::-1]
+
+
+def write_stl(path, vertices, faces):
+    triangles = vertices[faces].astype(np.float32)
+    normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    normals = np.divide(normals, lengths, out=np.zeros_like(normals), where=lengths > 0)
+    records = np.zeros(len(faces), dtype=[('normal', '<f4', 3), ('vertices', '<f4', (3, 3)), ('attr', '<u2')])
+    records['normal'] = normals
+    records['vertices'] = triangles
+    with open(path, 'wb') as f:
+        f.write(b'smartdentist bone surface'.ljust(80, b' '))
+        f.write(np.uint32(len(faces)).tobytes())
+        f.write(records.tobytes())
+
+
+def write_ply(path, vertices, faces):
+    header = (
+        "ply\nformat binary_little_endian 1.0\n"
+        f"element vertex {len(vertices)}\nproperty float x\nproperty float y\nproperty float z\n"
+        f"element face {len(faces)}\nproperty list uchar int vertex_indices\nend_header\n"
+    )
+    records = np.zeros(len(faces), dtype=[('count', 'u1'), ('indices', '<i4', 3)])
+    records['count'] = 3
+    records['indices'] = faces
+    with open(path, 'wb') as f:
+        f.write(header.encode('ascii'))
+        f.write(vertices.astype('<f4').tobytes())
+        f.write(records.tobytes())
+
+
+WRITERS = {'stl': write_stl, 'ply': write_ply}
+
+
+def load_mesh(series, params, fmt):
+    """
+    Путь к файлу поверхности серии в формате fmt; при первом обращении
+    с этими параметрами строит сетку и пишет все форматы сразу.
+    Возвращает (путь, из кэша ли).
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"mesh_format: допустимо {', '.join(FORMATS)}")
+    sha256 = series.blob.sha256
+    key = params_key(params)
+    path = mesh_path(sha256, key, fmt)
+    if os.path.exists(path):
+        return path, True
+
+    index = series_index(series) if series.indexed_at is not None else None
+    volume, spacing = load_volume(sha256, series_location(series.path, series.storage), series.codec, index)
+    vertices, faces = extract_surface(volume, spacing, params["threshold"], params["triangles"])
+    if not len(faces):
+        raise ValueError("В объеме нет кости выше порога threshold")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    for name, writer in WRITERS.items():
+        target = mesh_path(sha256, key, name)
+        tmp_path = f"{target}.{uuid.uuid4().hex}.tmp"
+        writer(tmp_path, vertices, faces)
+        os.replace(tmp_path, target)
+    return path, False
+
+
+def drop_meshes(sha256):
+    shutil.rmtree(os.path.join(cache_root(), sha256[:2], sha256), ignore_errors=True)
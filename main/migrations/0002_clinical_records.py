@@ -0,0 +1,87 @@
+# Generated by Django 4.2.25 on 2026-10-19 18:24
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImplantLibrary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, verbose_name='Название варианта (заглушки)')),
+                ('visualization_image', models.ImageField(upload_to='visualizations_images', verbose_name='3D Визуализация')),
+                ('density_graph', models.ImageField(upload_to='density_graphics', verbose_name='График плотности')),
+                ('diameter', models.FloatField(verbose_name='Диаметр (мм)')),
+                ('length', models.FloatField(verbose_name='Длина (мм)')),
+                ('thread_shape', models.CharField(max_length=50, verbose_name='Форма резьбы')),
+                ('thread_pitch', models.FloatField(verbose_name='Шаг резьбы (мм)')),
+                ('thread_depth', models.CharField(max_length=50, verbose_name='Глубина резьбы (мм)')),
+                ('bone_type', models.CharField(max_length=50, verbose_name='Тип кости')),
+                ('hu_density', models.IntegerField(verbose_name='Плотность HU')),
+                ('chewing_load', models.FloatField(verbose_name='Жевательная нагрузка (кгс)')),
+                ('limit_stress', models.FloatField(verbose_name='Предельное напряжение (кг/мм2)')),
+                ('surface_area', models.FloatField(verbose_name='Площадь поверхности резьбы (мм2)')),
+            ],
+            options={
+                'verbose_name': 'Вариант из библиотеки',
+                'verbose_name_plural': 'Библиотека имплантов',
+            },
+        ),
+        migrations.CreateModel(
+            name='Patient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, verbose_name='Имя')),
+                ('surname', models.CharField(max_length=255, verbose_name='Фамилия')),
+                ('patronymic', models.CharField(blank=True, max_length=255, verbose_name='Отчество')),
+                ('birth_date', models.DateField(verbose_name='Дата рождения')),
+                ('gender', models.IntegerField(choices=[(0, 'Мужской'), (1, 'Женский')], verbose_name='Пол')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MedicalCase',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('diagnosis', models.TextField(blank=True, verbose_name='Диагноз/Описание')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата приема')),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cases', to='main.patient', verbose_name='Пациент')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='Врач')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='IndividualImplant',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('is_calculated', models.BooleanField(default=False, verbose_name='Расчет выполнен')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('case', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='implant', to='main.medicalcase')),
+                ('implant_variant', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='main.implantlibrary', verbose_name='Выбранный вариант из библиотеки')),
+            ],
+            options={
+                'verbose_name': 'Результат расчета',
+                'verbose_name_plural': 'Результаты расчетов',
+            },
+        ),
+        migrations.CreateModel(
+            name='DICOMUpload',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', models.FileField(upload_to='dicom_archives/%d/%m/%Y/', verbose_name='Архив DICOM')),
+                ('uploaded_at', models.DateTimeField(auto_now_add=True)),
+                ('case', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dicom_uploads', to='main.medicalcase')),
+            ],
+            options={
+                'verbose_name': 'Загрузка DICOM',
+                'verbose_name_plural': 'Загрузки DICOM',
+            },
+        ),
+    ]
@@ -0,0 +1,70 @@
+# Generated by Django 4.2.25 on 2026-10-19 18:24
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0002_clinical_records'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DicomBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True, verbose_name='SHA-256 архива')),
+                ('size', models.BigIntegerField(verbose_name='Размер (байт)')),
+                ('file', models.FileField(max_length=255, upload_to='', verbose_name='Архив DICOM')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='Последнее использование')),
+            ],
+            options={
+                'verbose_name': 'Архив DICOM (блоб)',
+                'verbose_name_plural': 'Архивы DICOM (блобы)',
+            },
+        ),
+        migrations.AddField(
+            model_name='dicomupload',
+            name='sha256',
+            field=models.CharField(blank=True, db_index=True, max_length=64, verbose_name='SHA-256 архива'),
+        ),
+        migrations.AddField(
+            model_name='dicomupload',
+            name='size',
+            field=models.BigIntegerField(default=0, verbose_name='Размер (байт)'),
+        ),
+        migrations.AlterField(
+            model_name='dicomupload',
+            name='file',
+            field=models.FileField(blank=True, upload_to='dicom_archives/%d/%m/%Y/', verbose_name='Архив DICOM'),
+        ),
+        migrations.CreateModel(
+            name='DicomSeries',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=255, verbose_name='Папка серии (относительно MEDIA_ROOT)')),
+                ('file_count', models.PositiveIntegerField(default=0, verbose_name='Количество файлов')),
+                ('total_size', models.BigIntegerField(default=0, verbose_name='Объем файлов (байт)')),
+                ('extracted_at', models.DateTimeField(auto_now_add=True)),
+                ('blob', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='series', to='main.dicomblob')),
+            ],
+            options={
+                'verbose_name': 'Серия DICOM',
+                'verbose_name_plural': 'Серии DICOM',
+            },
+        ),
+        migrations.AddField(
+            model_name='dicomupload',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='uploads', to='main.dicomblob'),
+        ),
+        migrations.AddField(
+            model_name='medicalcase',
+            name='dicom_series',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='cases', to='main.dicomseries', verbose_name='Серия DICOM'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.25 on 2026-10-19 18:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0003_dicom_blobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dicomseries',
+            name='codec',
+            field=models.CharField(blank=True, default='', max_length=10, verbose_name='Сжатие срезов'),
+        ),
+        migrations.AlterField(
+            model_name='dicomseries',
+            name='total_size',
+            field=models.BigIntegerField(default=0, verbose_name='Объем на диске (байт)'),
+        ),
+    ]
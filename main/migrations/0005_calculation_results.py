@@ -0,0 +1,31 @@
+# Generated by Django 4.2.25 on 2026-10-19 18:24
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0004_dicomseries_codec'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CalculationResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('archive_sha256', models.CharField(db_index=True, max_length=64, verbose_name='SHA-256 архива')),
+                ('library_version', models.CharField(db_index=True, max_length=64, verbose_name='Версия библиотеки')),
+                ('inputs', models.JSONField(default=dict, verbose_name='Входные данные')),
+                ('outputs', models.JSONField(default=dict, verbose_name='Результаты')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('implant_variant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='calculations', to='main.implantlibrary', verbose_name='Выбранный вариант из библиотеки')),
+            ],
+            options={
+                'verbose_name': 'Кэш расчета',
+                'verbose_name_plural': 'Кэш расчетов',
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.25 on 2026-10-19 18:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0005_calculation_results'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='individualimplant',
+            name='density_profile',
+            field=models.JSONField(blank=True, null=True, verbose_name='Профиль плотности по глубине'),
+        ),
+        migrations.AddField(
+            model_name='individualimplant',
+            name='measured_hu',
+            field=models.FloatField(blank=True, null=True, verbose_name='Средняя плотность в зоне импланта (HU)'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.25 on 2026-10-19 18:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0006_implant_density'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='individualimplant',
+            name='bone_hu',
+            field=models.FloatField(blank=True, null=True, verbose_name='Плотность кости в расчете (HU)'),
+        ),
+        migrations.AddField(
+            model_name='individualimplant',
+            name='case_load',
+            field=models.FloatField(blank=True, null=True, verbose_name='Расчетная нагрузка (кгс)'),
+        ),
+        migrations.AddField(
+            model_name='individualimplant',
+            name='interface_stress',
+            field=models.FloatField(blank=True, null=True, verbose_name='Напряжение кость-имплант (кг/мм2)'),
+        ),
+        migrations.AddField(
+            model_name='individualimplant',
+            name='safety_factor',
+            field=models.FloatField(blank=True, null=True, verbose_name='Запас прочности'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.25 on 2026-10-19 18:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0007_implant_biomechanics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='implantlibrary',
+            name='image_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
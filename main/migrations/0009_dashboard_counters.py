@@ -0,0 +1,31 @@
+# Generated by Django 4.2.25 on 2026-10-19 18:24
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_image_variants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DashboardCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=100, unique=True)),
+                ('kind', models.CharField(choices=[('cases', 'Приемы врача за месяц'), ('calculated', 'Рассчитанные импланты'), ('variant', 'Использование варианта библиотеки')], db_index=True, max_length=20)),
+                ('month', models.DateField(blank=True, null=True, verbose_name='Месяц')),
+                ('value', models.BigIntegerField(default=0)),
+                ('implant_variant', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='main.implantlibrary', verbose_name='Вариант из библиотеки')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Врач')),
+            ],
+            options={
+                'verbose_name': 'Счетчик статистики',
+                'verbose_name_plural': 'Счетчики статистики',
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.25 on 2026-10-19 18:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0009_dashboard_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='medicalcase',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.CreateModel(
+            name='DeletedRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('patient', 'Пациент'), ('case', 'Прием')], max_length=20)),
+                ('object_id', models.BigIntegerField()),
+                ('deleted_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'verbose_name': 'Удаленная запись',
+                'verbose_name_plural': 'Удаленные записи',
+                'indexes': [models.Index(fields=['kind', 'deleted_at'], name='main_delete_kind_76c7de_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.25 on 2026-10-19 18:24
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0010_sync_tombstones'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessingJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('upload_id', models.CharField(max_length=64, unique=True, verbose_name='Идентификатор загрузки')),
+                ('stage', models.CharField(choices=[('receiving', 'Загрузка архива'), ('queued', 'В очереди'), ('extracting', 'Распаковка'), ('analyzing', 'Анализ'), ('done', 'Готово'), ('failed', 'Ошибка')], default='receiving', max_length=20)),
+                ('bytes_received', models.BigIntegerField(default=0)),
+                ('bytes_total', models.BigIntegerField(default=0)),
+                ('members_done', models.PositiveIntegerField(default=0)),
+                ('members_total', models.PositiveIntegerField(default=0)),
+                ('result', models.JSONField(blank=True, null=True, verbose_name='Результат')),
+                ('error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('case', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='processing_jobs', to='main.medicalcase', verbose_name='Прием')),
+            ],
+            options={
+                'verbose_name': 'Обработка загрузки',
+                'verbose_name_plural': 'Обработка загрузок',
+            },
+        ),
+    ]
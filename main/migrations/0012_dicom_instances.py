@@ -0,0 +1,57 @@
+# Generated by Django 4.2.25 on 2026-10-19 18:24
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_processing_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dicomseries',
+            name='indexed_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Индекс заголовков построен'),
+        ),
+        migrations.AlterField(
+            model_name='processingjob',
+            name='stage',
+            field=models.CharField(choices=[('receiving', 'Загрузка архива'), ('queued', 'В очереди'), ('extracting', 'Распаковка'), ('indexing', 'Индексация заголовков'), ('analyzing', 'Анализ'), ('done', 'Готово'), ('failed', 'Ошибка')], default='receiving', max_length=20),
+        ),
+        migrations.CreateModel(
+            name='DicomInstance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('relpath', models.CharField(max_length=255, verbose_name='Файл в серии')),
+                ('study_uid', models.CharField(blank=True, db_index=True, default='', max_length=64)),
+                ('series_uid', models.CharField(blank=True, db_index=True, default='', max_length=64)),
+                ('sop_uid', models.CharField(blank=True, default='', max_length=64)),
+                ('modality', models.CharField(blank=True, default='', max_length=16)),
+                ('instance_number', models.IntegerField(blank=True, null=True)),
+                ('slice_location', models.FloatField(blank=True, null=True)),
+                ('slice_position', models.FloatField(blank=True, null=True)),
+                ('image_position', models.JSONField(blank=True, null=True)),
+                ('pixel_spacing', models.JSONField(blank=True, null=True, verbose_name='Шаг пикселя (строка, столбец), мм')),
+                ('slice_thickness', models.FloatField(blank=True, null=True)),
+                ('rows', models.PositiveIntegerField(blank=True, null=True)),
+                ('columns', models.PositiveIntegerField(blank=True, null=True)),
+                ('rescale_slope', models.FloatField(default=1.0)),
+                ('rescale_intercept', models.FloatField(default=0.0)),
+                ('transfer_syntax', models.CharField(blank=True, default='', max_length=64)),
+                ('pixel_offset', models.BigIntegerField(blank=True, null=True)),
+                ('pixel_dtype', models.CharField(blank=True, default='', max_length=8)),
+                ('series', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='instances', to='main.dicomseries')),
+            ],
+            options={
+                'verbose_name': 'Снимок DICOM',
+                'verbose_name_plural': 'Снимки DICOM',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='dicominstance',
+            constraint=models.UniqueConstraint(fields=('series', 'relpath'), name='unique_instance_relpath'),
+        ),
+    ]
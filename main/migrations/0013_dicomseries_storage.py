@@ -0,0 +1,29 @@
+# Generated by Django 4.2.25 on 2026-10-19 18:24
+
+from django.db import migrations, models
+import main.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_dicom_instances'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dicomseries',
+            name='storage',
+            field=models.CharField(default='local', max_length=20, verbose_name='Хранилище'),
+        ),
+        migrations.AlterField(
+            model_name='dicomseries',
+            name='path',
+            field=models.CharField(max_length=255, verbose_name='Путь серии в хранилище'),
+        ),
+        migrations.AlterField(
+            model_name='dicomupload',
+            name='file',
+            field=models.FileField(blank=True, upload_to=main.models.dicom_upload_path, verbose_name='Архив DICOM'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.25 on 2026-10-19 18:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_dicomseries_storage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuditEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.BigIntegerField(blank=True, null=True, verbose_name='Пользователь')),
+                ('user_email', models.CharField(blank=True, default='', max_length=255)),
+                ('action', models.CharField(choices=[('view', 'Просмотр'), ('list', 'Просмотр списка'), ('create', 'Создание'), ('update', 'Изменение'), ('upload', 'Загрузка снимков')], max_length=20)),
+                ('patient_id', models.BigIntegerField(blank=True, null=True, verbose_name='Пациент')),
+                ('case_id', models.BigIntegerField(blank=True, null=True, verbose_name='Прием')),
+                ('method', models.CharField(blank=True, default='', max_length=10)),
+                ('path', models.CharField(blank=True, default='', max_length=255)),
+                ('status_code', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('ip', models.GenericIPAddressField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(db_index=True, verbose_name='Время обращения')),
+            ],
+            options={
+                'verbose_name': 'Событие журнала доступа',
+                'verbose_name_plural': 'Журнал доступа',
+                'indexes': [models.Index(fields=['patient_id', 'created_at'], name='main_audite_patient_69ae78_idx'), models.Index(fields=['case_id', 'created_at'], name='main_audite_case_id_25e87a_idx'), models.Index(fields=['user_id', 'created_at'], name='main_audite_user_id_700549_idx')],
+            },
+        ),
+    ]
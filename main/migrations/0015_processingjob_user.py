@@ -0,0 +1,20 @@
+# Generated by Django 4.2.25 on 2026-10-19 18:31
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0014_audit_events'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='processingjob',
+            name='user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь'),
+        ),
+    ]
@@ -1,7 +1,11 @@
+import os
+import uuid
+
 from django.conf import settings
 from django.db import models, transaction
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin, BaseUserManager
 from django.db.models import F
+from django.utils import timezone
 
 
 class AccountManager(BaseUserManager):
@@ -147,24 +151,115 @@ class Patient(models.Model):
     birth_date = models.DateField(verbose_name="Дата рождения")
     gender = models.IntegerField(choices=[(0, 'Мужской'), (1, 'Женский')], verbose_name="Пол")
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
         return f"{self.surname} {self.name} {self.patronymic}".strip()
 
 
+class DicomBlob(models.Model):
+    # Архив DICOM, хранящийся один раз по хешу содержимого
+    sha256 = models.CharField(max_length=64, unique=True, verbose_name="SHA-256 архива")
+    size = models.BigIntegerField(verbose_name="Размер (байт)")
+    file = models.FileField(max_length=255, verbose_name="Архив DICOM")
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(default=timezone.now, db_index=True, verbose_name="Последнее использование")
+
+    class Meta:
+        verbose_name = "Архив DICOM (блоб)"
+        verbose_name_plural = "Архивы DICOM (блобы)"
+
+    def __str__(self):
+        return f"{self.sha256[:12]} ({self.size} б)"
+
+
+class DicomSeries(models.Model):
+    # Распакованная серия снимков, общая для всех приемов с одинаковым архивом
+    blob = models.OneToOneField(DicomBlob, on_delete=models.CASCADE, related_name="series")
+    path = models.CharField(max_length=255, verbose_name="Путь серии в хранилище")
+    codec = models.CharField(max_length=10, blank=True, default="", verbose_name="Сжатие срезов")
+    # Бэкенд хранилища серии (main/storage.py)
+    storage = models.CharField(max_length=20, default="local", verbose_name="Хранилище")
+    file_count = models.PositiveIntegerField(default=0, verbose_name="Количество файлов")
+    total_size = models.BigIntegerField(default=0, verbose_name="Объем на диске (байт)")
+    extracted_at = models.DateTimeField(auto_now_add=True)
+    indexed_at = models.DateTimeField(null=True, blank=True, verbose_name="Индекс заголовков построен")
+
+    class Meta:
+        verbose_name = "Серия DICOM"
+        verbose_name_plural = "Серии DICOM"
+
+    def __str__(self):
+        return self.path
+
+
+class DicomInstance(models.Model):
+    # Заголовок одного файла серии без пикселей (см. main/dicom_index.py)
+    series = models.ForeignKey(DicomSeries, on_delete=models.CASCADE, related_name="instances")
+    relpath = models.CharField(max_length=255, verbose_name="Файл в серии")
+    study_uid = models.CharField(max_length=64, blank=True, default="", db_index=True)
+    series_uid = models.CharField(max_length=64, blank=True, default="", db_index=True)
+    sop_uid = models.CharField(max_length=64, blank=True, default="")
+    modality = models.CharField(max_length=16, blank=True, default="")
+    instance_number = models.IntegerField(null=True, blank=True)
+    slice_location = models.FloatField(null=True, blank=True)
+    # Положение среза вдоль нормали к его плоскости (мм)
+    slice_position = models.FloatField(null=True, blank=True)
+    image_position = models.JSONField(null=True, blank=True)
+    pixel_spacing = models.JSONField(null=True, blank=True, verbose_name="Шаг пикселя (строка, столбец), мм")
+    slice_thickness = models.FloatField(null=True, blank=True)
+    rows = models.PositiveIntegerField(null=True, blank=True)
+    columns = models.PositiveIntegerField(null=True, blank=True)
+    rescale_slope = models.FloatField(default=1.0)
+    rescale_intercept = models.FloatField(default=0.0)
+    transfer_syntax = models.CharField(max_length=64, blank=True, default="")
+    # Смещение значений PixelData в исходном файле и их тип numpy;
+    # пустой тип - пиксели сжаты и читаются через pydicom
+    pixel_offset = models.BigIntegerField(null=True, blank=True)
+    pixel_dtype = models.CharField(max_length=8, blank=True, default="")
+
+    class Meta:
+        verbose_name = "Снимок DICOM"
+        verbose_name_plural = "Снимки DICOM"
+        constraints = [models.UniqueConstraint(fields=['series', 'relpath'], name='unique_instance_relpath')]
+
+    def __str__(self):
+        return self.relpath
+
+
 class MedicalCase(models.Model):
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name="cases", verbose_name="Пациент")
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, verbose_name="Врач")
     diagnosis = models.TextField(blank=True, verbose_name="Диагноз/Описание")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата приема")
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    dicom_series = models.ForeignKey(
+        DicomSeries,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="cases",
+        verbose_name="Серия DICOM"
+    )
 
     def __str__(self):
         return f"Прием #{self.id} - {self.patient.surname} {self.patient.name} {self.patient.patronymic}".strip()
 
 
+def dicom_upload_path(instance, filename):
+    # Раскладка по двум уровням случайного префикса вместо папки на каждый день
+    key = uuid.uuid4().hex
+    return f"dicom_archives/{key[:2]}/{key[2:4]}/{key}_{os.path.basename(filename)}"
+
+
 class DICOMUpload(models.Model):
     case = models.ForeignKey(MedicalCase, on_delete=models.CASCADE, related_name="dicom_uploads")
-    file = models.FileField(upload_to='dicom_archives/%d/%m/%Y/', verbose_name="Архив DICOM")
+    # Старое поле: новые архивы хранятся в блобах, migrate_dicom_storage переносит оставшиеся
+    file = models.FileField(upload_to=dicom_upload_path, blank=True, verbose_name="Архив DICOM")
+    # Ссылка на общий блоб; после сборки мусора остаются только хеш и размер
+    blob = models.ForeignKey(DicomBlob, on_delete=models.SET_NULL, null=True, blank=True, related_name="uploads")
+    sha256 = models.CharField(max_length=64, blank=True, db_index=True, verbose_name="SHA-256 архива")
+    size = models.BigIntegerField(default=0, verbose_name="Размер (байт)")
     uploaded_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
@@ -191,6 +286,9 @@ class ImplantLibrary(models.Model):
     limit_stress = models.FloatField(verbose_name="Предельное напряжение (кг/мм2)")
     surface_area = models.FloatField(verbose_name="Площадь поверхности резьбы (мм2)")
 
+    # Уменьшенные копии изображений: {поле: {размер: {формат: путь}}}
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
+
     class Meta:
         verbose_name = "Вариант из библиотеки"
         verbose_name_plural = "Библиотека имплантов"
@@ -209,6 +307,14 @@ class IndividualImplant(models.Model):
     )
 
     is_calculated = models.BooleanField(default=False, verbose_name="Расчет выполнен")
+    # Плотность кости вдоль оси импланта (если при загрузке задана точка установки)
+    measured_hu = models.FloatField(null=True, blank=True, verbose_name="Средняя плотность в зоне импланта (HU)")
+    density_profile = models.JSONField(null=True, blank=True, verbose_name="Профиль плотности по глубине")
+    # Биомеханика выбранного варианта
+    case_load = models.FloatField(null=True, blank=True, verbose_name="Расчетная нагрузка (кгс)")
+    bone_hu = models.FloatField(null=True, blank=True, verbose_name="Плотность кости в расчете (HU)")
+    interface_stress = models.FloatField(null=True, blank=True, verbose_name="Напряжение кость-имплант (кг/мм2)")
+    safety_factor = models.FloatField(null=True, blank=True, verbose_name="Запас прочности")
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
@@ -217,3 +323,137 @@ class IndividualImplant(models.Model):
 
     def __str__(self):
         return f"Расчет САПР для приема #{self.case_id}"
+
+
+class CalculationResult(models.Model):
+    # Кэш расчета: ключ = хеш (архив, параметры анализа, версия библиотеки)
+    key = models.CharField(max_length=64, unique=True)
+    archive_sha256 = models.CharField(max_length=64, db_index=True, verbose_name="SHA-256 архива")
+    library_version = models.CharField(max_length=64, db_index=True, verbose_name="Версия библиотеки")
+    implant_variant = models.ForeignKey(
+        ImplantLibrary,
+        on_delete=models.CASCADE,
+        related_name="calculations",
+        verbose_name="Выбранный вариант из библиотеки"
+    )
+    inputs = models.JSONField(default=dict, verbose_name="Входные данные")
+    outputs = models.JSONField(default=dict, verbose_name="Результаты")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Кэш расчета"
+        verbose_name_plural = "Кэш расчетов"
+
+    def __str__(self):
+        return f"{self.archive_sha256[:12]} / {self.library_version[:12]}"
+
+
+class DashboardCounter(models.Model):
+    # Готовая корзина статистики для панели администратора (см. main/stats.py)
+    class Kind(models.TextChoices):
+        CASES = "cases", "Приемы врача за месяц"
+        CALCULATED = "calculated", "Рассчитанные импланты"
+        VARIANT = "variant", "Использование варианта библиотеки"
+
+    key = models.CharField(max_length=100, unique=True)
+    kind = models.CharField(max_length=20, choices=Kind.choices, db_index=True)
+    month = models.DateField(null=True, blank=True, verbose_name="Месяц")
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name="+", verbose_name="Врач"
+    )
+    implant_variant = models.ForeignKey(
+        ImplantLibrary, on_delete=models.CASCADE, null=True, blank=True, related_name="+",
+        verbose_name="Вариант из библиотеки"
+    )
+    value = models.BigIntegerField(default=0)
+
+    class Meta:
+        verbose_name = "Счетчик статистики"
+        verbose_name_plural = "Счетчики статистики"
+
+
+class DeletedRecord(models.Model):
+    # Отметка об удалении для синхронизации клиентов (см. main/sync.py)
+    class Kind(models.TextChoices):
+        PATIENT = "patient", "Пациент"
+        CASE = "case", "Прием"
+
+    kind = models.CharField(max_length=20, choices=Kind.choices)
+    object_id = models.BigIntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        verbose_name = "Удаленная запись"
+        verbose_name_plural = "Удаленные записи"
+        indexes = [models.Index(fields=['kind', 'deleted_at'])]
+
+
+class ProcessingJob(models.Model):
+    # Ход обработки загруженного архива для потока событий (см. main/progress.py)
+    class Stage(models.TextChoices):
+        RECEIVING = "receiving", "Загрузка архива"
+        QUEUED = "queued", "В очереди"
+        EXTRACTING = "extracting", "Распаковка"
+        INDEXING = "indexing", "Индексация заголовков"
+        ANALYZING = "analyzing", "Анализ"
+        DONE = "done", "Готово"
+        FAILED = "failed", "Ошибка"
+
+    upload_id = models.CharField(max_length=64, unique=True, verbose_name="Идентификатор загрузки")
+    # Задачу видит и может перезапустить только загрузивший архив пользователь
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True, blank=True, related_name="+",
+        verbose_name="Пользователь"
+    )
+    case = models.ForeignKey(
+        MedicalCase, on_delete=models.CASCADE, null=True, blank=True, related_name="processing_jobs",
+        verbose_name="Прием"
+    )
+    stage = models.CharField(max_length=20, choices=Stage.choices, default=Stage.RECEIVING)
+    bytes_received = models.BigIntegerField(default=0)
+    bytes_total = models.BigIntegerField(default=0)
+    members_done = models.PositiveIntegerField(default=0)
+    members_total = models.PositiveIntegerField(default=0)
+    result = models.JSONField(null=True, blank=True, verbose_name="Результат")
+    error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Обработка загрузки"
+        verbose_name_plural = "Обработка загрузок"
+
+    @property
+    def finished(self):
+        return self.stage in (self.Stage.DONE, self.Stage.FAILED)
+
+
+class AuditEvent(models.Model):
+    # Обращение к данным пациента или приема (см. main/audit.py).
+    # Без внешних ключей: запись журнала переживает удаление пользователя и пациента
+    class Action(models.TextChoices):
+        VIEW = "view", "Просмотр"
+        LIST = "list", "Просмотр списка"
+        CREATE = "create", "Создание"
+        UPDATE = "update", "Изменение"
+        UPLOAD = "upload", "Загрузка снимков"
+
+    user_id = models.BigIntegerField(null=True, blank=True, verbose_name="Пользователь")
+    user_email = models.CharField(max_length=255, blank=True, default="")
+    action = models.CharField(max_length=20, choices=Action.choices)
+    patient_id = models.BigIntegerField(null=True, blank=True, verbose_name="Пациент")
+    case_id = models.BigIntegerField(null=True, blank=True, verbose_name="Прием")
+    method = models.CharField(max_length=10, blank=True, default="")
+    path = models.CharField(max_length=255, blank=True, default="")
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    ip = models.GenericIPAddressField(null=True, blank=True)
+    created_at = models.DateTimeField(db_index=True, verbose_name="Время обращения")
+
+    class Meta:
+        verbose_name = "Событие журнала доступа"
+        verbose_name_plural = "Журнал доступа"
+        indexes = [
+            models.Index(fields=['patient_id', 'created_at']),
+            models.Index(fields=['case_id', 'created_at']),
+            models.Index(fields=['user_id', 'created_at']),
+        ]
@@ -0,0 +1,316 @@
+# panoramic.py
+# Панорамная реконструкция челюсти по объему КЛКТ.
+# Кривая зубной дуги задается клиентом (точки x, y в вокселях аксиального
+# среза) или находится автоматически по проекции максимальной плотности.
+# Кривая переразбивается с равным шагом по длине, объем интерполируется
+# вдоль нормалей к ней: панорама - среднее по толщине слоя, поперечные
+# срезы - плоскости нормаль x z в нескольких точках дуги. Интерполяция
+# билинейная в плоскости среза сразу для всех z, объем читается через memmap.
+# Готовые PNG и описание кэшируются в DICOM_CACHE_ROOT/panoramic по хешу
+# серии и параметрам, поэтому повторный запрос отдается без пересчета.
+import hashlib
+import json
+import os
+import re
+import shutil
+import uuid
+
+import numpy as np
+from django.conf import settings
+from PIL import Image
+
+from .dicom_index import series_index
+from .storage import series_location
+from .volume import HU_MIN, load_volume
+
+# Версия алгоритма входит в ключ кэша
+VERSION = 1
+CURVE_POINTS_MAX = 200
+FILE_NAME_RE = re.compile(r'^(panoramic|section_\d{2})\.png$')
+KEY_RE = re.compile(r'^[0-9a-f]{24}$')
+# Точек дуги за один проход интерполяции (ограничивает память)
+CHUNK_POINTS = 128
+# Толщина слоя для поиска дуги по проекции (мм) и степень полинома дуги
+ARCH_SLAB = 12.0
+ARCH_DEGREE = 4
+
+
+def default_params():
+    return {
+        "thickness": float(getattr(settings, 'PANORAMIC_THICKNESS', 10.0)),
+        "layers": int(getattr(settings, 'PANORAMIC_LAYERS', 16)),
+        "sections": int(getattr(settings, 'PANORAMIC_SECTIONS', 10)),
+        "section_width": float(getattr(settings, 'PANORAMIC_SECTION_WIDTH', 30.0)),
+        "window": list(getattr(settings, 'PANORAMIC_WINDOW', (1000.0, 4000.0))),
+    }
+
+
+def arch_hu():
+    return float(getattr(settings, 'PANORAMIC_ARCH_HU', 1200))
+
+
+def cache_root():
+    return os.path.join(settings.DICOM_CACHE_ROOT, 'panoramic')
+
+
+def _number(value, name, minimum, maximum):
+    try:
+        number = float(str(value).replace(',', '.'))
+    except ValueError:
+        raise ValueError(f"{name}: ожидается число")
+    if not minimum <= number <= maximum:
+        raise ValueError(f"{name}: допустимо от {minimum} до {maximum}")
+    return number
+
+
+def _curve(value):
+    # "x,y;x,y;..." в вокселях аксиального среза
+    try:
+        points = [[round(float(v), 2) for v in point.split(',')] for point in value.strip(';').split(';')]
+    except ValueError:
+        points = []
+    if len(points) < 2 or len(points) > CURVE_POINTS_MAX or any(len(p) != 2 for p in points):
+        raise ValueError(f"curve: ожидается от 2 до {CURVE_POINTS_MAX} точек вида x,y через ;")
+    return points
+
+
+def panoramic_params(data):
+    """
+    Канонический вид параметров реконструкции из запроса (ключ кэша не
+    зависит от записи). Без curve дуга ищется автоматически.
+    """
+    params = default_params()
+    params["curve"] = _curve(data['curve']) if data.get('curve') else None
+    if data.get('thickness'):
+        params["thickness"] = _number(data['thickness'], 'thickness', 0.5, 40)
+    if data.get('sections'):
+        params["sections"] = int(_number(data['sections'], 'sections', 0, 50))
+    if data.get('section_width'):
+        params["section_width"] = _number(data['section_width'], 'section_width', 5, 80)
+    if data.get('window'):
+        parts = str(data['window']).split(',')
+        if len(parts) != 2:
+            raise ValueError("window: ожидается центр,ширина в HU")
+        params["window"] = [_number(parts[0], 'window', -2000, 4000), _number(parts[1], 'window', 1, 8000)]
+    return params
+
+
+def params_key(params):
+    payload = json.dumps([VERSION, params], sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()[:24]
+
+
+def output_dir(sha256, key):
+    return os.path.join(cache_root(), sha256[:2], sha256, key)
+
+
+def detect_arch(volume, spacing, threshold=None):
+    """
+    Автоматическая дуга: слой ARCH_SLAB мм с наибольшим числом плотных
+    вокселей (зубы), проекция максимальной плотности по нему и полином
+    y(x) по плотным точкам. Возвращает точки (x, y) в вокселях.
+    """
+    threshold = arch_hu() if threshold is None else threshold
+    dz = spacing[0]
+    # Поиск слоя по прореженному объему
+    coarse = volume[:, ::4, ::4]
+    dense = (coarse > threshold).sum(axis=(1, 2))
+    if not dense.any():
+        raise ValueError("Не удалось найти зубную дугу: задайте кривую curve")
+    slab = max(1, int(round(ARCH_SLAB / dz)))
+    counts = np.convolve(dense, np.ones(slab), mode='same')
+    center = int(np.argmax(counts))
+    z0, z1 = max(0, center - slab // 2), min(volume.shape[0], center + slab // 2 + 1)
+    mip = np.asarray(volume[z0:z1]).max(axis=0)
+
+    ys, xs = np.nonzero(mip > threshold)
+    if len(xs) < 20 or np.ptp(xs) < 10:
+        raise ValueError("Не удалось найти зубную дугу: задайте кривую curve")
+    # Дуга растянута по x; крайние точки берем по перцентилям, чтобы не цеплять шум
+    x_from, x_to = np.percentile(xs, [1, 99])
+    degree = ARCH_DEGREE if len(xs) >= 100 else 2
+    coefficients = np.polyfit(xs.astype(np.float64), ys.astype(np.float64), degree)
+    x = np.linspace(x_from, x_to, CURVE_POINTS_MAX)
+    y = np.clip(np.polyval(coefficients, x), 0, volume.shape[1] - 1)
+    return np.stack([x, y], axis=1)
+
+
+def resample_curve(points, spacing, step):
+    """
+    Равномерная по длине (мм) разбивка ломаной points (x, y в вокселях).
+    Возвращает (точки, единичные нормали в вокселях, положение вдоль дуги в мм).
+    """
+    points = np.asarray(points, dtype=np.float64)
+    scale = np.array([spacing[2], spacing[1]])
+    mm = points * scale
+    segments = np.linalg.norm(np.diff(mm, axis=0), axis=1)
+    arc = np.concatenate([[0.0], np.cumsum(segments)])
+    if arc[-1] <= 0:
+        raise ValueError("curve: точки кривой совпадают")
+    keep = np.concatenate([[True], segments > 0])
+    arc, mm = arc[keep], mm[keep]
+    s = np.arange(0.0, arc[-1] + step / 2, step)
+    curve_mm = np.stack([np.interp(s, arc, mm[:, 0]), np.interp(s, arc, mm[:, 1])], axis=1)
+
+    tangents = np.gradient(curve_mm, axis=0)
+    tangents /= np.linalg.norm(tangents, axis=1, keepdims=True)
+    normals_mm = np.stack([-tangents[:, 1], tangents[:, 0]], axis=1)
+    return curve_mm / scale, normals_mm / scale, s
+
+
+def sample_columns(volume, xy):
+    """
+    Билинейная интерполяция по (x, y) для всех срезов сразу.
+    xy[..., 2] в вокселях; возвращает float32 (z, *xy.shape[:-1]),
+    точки вне объема дают NaN.
+    """
+    ny, nx = volume.shape[1:]
+    x, y = xy[..., 0].ravel(), xy[..., 1].ravel()
+    inside = (x >= 0) & (x <= nx - 1) & (y >= 0) & (y <= ny - 1)
+    x, y = np.clip(x, 0, nx - 1), np.clip(y, 0, ny - 1)
+    x0 = np.minimum(np.floor(x).astype(np.intp), max(nx - 2, 0))
+    y0 = np.minimum(np.floor(y).astype(np.intp), max(ny - 2, 0))
+    fx, fy = (x - x0).astype(np.float32), (y - y0).astype(np.float32)
+    x1, y1 = np.minimum(x0 + 1, nx - 1), np.minimum(y0 + 1, ny - 1)
+
+    result = volume[:, y0, x0] * ((1 - fx) * (1 - fy))
+    result += volume[:, y0, x1] * (fx * (1 - fy))
+    result += volume[:, y1, x0] * ((1 - fx) * fy)
+    result += volume[:, y1, x1] * (fx * fy)
+    result[:, ~inside] = np.nan
+    return result.reshape((volume.shape[0],) + xy.shape[:-1])
+
+
+def _offsets(width, count):
+    # Смещения вдоль нормали (мм), симметрично относительно дуги
+    if count <= 1:
+        return np.zeros(1)
+    return np.linspace(-width / 2, width / 2, count)
+
+
+def panoramic_image(volume, curve, normals, offsets):
+    """
+    Панорама (z, точки дуги): среднее HU по толщине слоя вдоль нормали.
+    Считается порциями по CHUNK_POINTS точек дуги.
+    """
+    image = np.empty((volume.shape[0], len(curve)), dtype=np.float32)
+    for start in range(0, len(curve), CHUNK_POINTS):
+        stop = start + CHUNK_POINTS
+        xy = curve[start:stop, None, :] + offsets[None, :, None] * normals[start:stop, None, :]
+        with np.errstate(invalid='ignore'):
+            layer = sample_columns(volume, xy)
+            image[:, start:stop] = np.nanmean(layer, axis=2) if len(offsets) > 1 else layer[:, :, 0]
+    return image
+
+
+def cross_sections(volume, curve, normals, indices, offsets):
+    # Поперечные срезы (срезы, z, смещение по нормали) в точках дуги indices
+    xy = curve[indices, None, :] + offsets[None, :, None] * normals[indices, None, :]
+    return np.moveaxis(sample_columns(volume, xy), 0, 1)
+
+
+def _write_png(image, window, row_scale, path):
+    # Окно HU в 8 бит; верх изображения - краниальный край (по убыванию z)
+    center, width = window
+    low = center - width / 2
+    image = np.nan_to_num(image, nan=HU_MIN)
+    pixels = np.clip((image[::-1] - low) * (255.0 / width), 0, 255).astype(np.uint8)
+    picture = Image.fromarray(pixels)
+    if abs(row_scale - 1) > 0.01:
+        # Пиксели квадратные: высота строки по z приводится к шагу по дуге
+        picture = picture.resize((picture.width, max(1, int(round(picture.height * row_scale)))), Image.BILINEAR)
+    picture.save(path, 'PNG')
+
+
+def reconstruct(volume, spacing, params, dest):
+    """
+    Реконструкция в папку dest: panoramic.png, section_NN.png и meta.json.
+    Возвращает описание (meta).
+    """
+    step = float(min(spacing[1], spacing[2]))
+    if params["curve"] is not None:
+        control = params["curve"]
+        auto = False
+    else:
+        control = detect_arch(volume, spacing)
+        auto = True
+    curve, normals, arc = resample_curve(control, spacing, step)
+
+    # Смещения в мм: нормали уже переведены в воксели на мм
+    offsets = _offsets(params["thickness"], params["layers"])
+    row_scale = spacing[0] / step
+
+    _write_png(panoramic_image(volume, curve, normals, offsets), params["window"], row_scale,
+               os.path.join(dest, 'panoramic.png'))
+
+    sections = []
+    if params["sections"]:
+        # Равномерно по дуге, без крайних точек
+        positions = np.linspace(0, arc[-1], params["sections"] + 2)[1:-1]
+        indices = np.searchsorted(arc, positions).clip(0, len(arc) - 1)
+        section_offsets = np.arange(-params["section_width"] / 2, params["section_width"] / 2 + step / 2, step)
+        images = cross_sections(volume, curve, normals, indices, section_offsets)
+        for i, (index, image) in enumerate(zip(indices, images)):
+            name = f"section_{i:02d}.png"
+            _write_png(image, params["window"], row_scale, os.path.join(dest, name))
+            sections.append({
+                "name": name,
+                "position": round(float(arc[index]), 2),
+                "point": [round(float(v), 2) for v in curve[index]],
+            })
+
+    meta = {
+        "params": params,
+        "auto_curve": auto,
+        "curve": [[round(float(x), 2), round(float(y), 2)] for x, y in np.asarray(control)[::max(1, len(control) // 50)]],
+        "length": round(float(arc[-1]), 2),
+        "pixel_spacing": [step, step],
+        "panoramic": "panoramic.png",
+        "sections": sections,
+    }
+    with open(os.path.join(dest, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+
+def load_reconstruction(series, params):
+    """
+    Готовая реконструкция серии из кэша или новая.
+    Возвращает (ключ, meta, из кэша ли).
+    """
+    sha256 = series.blob.sha256
+    key = params_key(params)
+    dest = output_dir(sha256, key)
+    meta_path = os.path.join(dest, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            return key, json.load(f), True
+
+    index = series_index(series) if series.indexed_at is not None else None
+    series_dir = series_location(series.path, series.storage)
+    volume, spacing = load_volume(sha256, series_dir, series.codec, index)
+    tmp_path = f"{dest}.{uuid.uuid4().hex}.tmp"
+    os.makedirs(tmp_path)
+    try:
+        meta = reconstruct(volume, spacing, params, tmp_path)
+    except Exception:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    try:
+        os.rename(tmp_path, dest)
+    except OSError:
+        # Ту же реконструкцию уже сохранил параллельный запрос
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return key, meta, False
+
+
+def reconstruction_file(series, key, name):
+    # Путь к готовому изображению или None, если имя не из реконструкции
+    if not (KEY_RE.match(key) and FILE_NAME_RE.match(name)):
+        return None
+    path = os.path.join(output_dir(series.blob.sha256, key), name)
+    return path if os.path.exists(path) else None
+
+
+def drop_reconstructions(sha256):
+    shutil.rmtree(os.path.join(cache_root(), sha256[:2], sha256), ignore_errors=True)
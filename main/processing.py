@@ -0,0 +1,274 @@
+# processing.py
+# Конвейер обработки архива приема: сохранение блоба, распаковка серии,
+# расчет импланта и запись результата. Тяжелая часть (распаковка и расчет)
+# не обращается к базе, поэтому пакетная обработка раскладывает ее по пулу
+# процессов, а запись в базу остается в родительском процессе.
+import multiprocessing
+import os
+import time
+import zipfile
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import django
+from django.conf import settings
+from django.db import connections
+
+from .calculation import (
+    cached_result, library_rows, library_version, run_calculation, save_result
+)
+from .extraction import UnsafeArchive
+from .dicom_index import read_index, series_index, store_index
+from .dicom_storage import materialize_series, register_series, store_blob
+from .memprofile import memory_section
+from .models import DICOMUpload, DicomSeries, IndividualImplant, MedicalCase, ProcessingJob
+from .slices import read_manifest
+from .storage import get_storage, series_location
+
+# Результат быстрой части обработки архива (см. prepare_case_archive)
+PreparedArchive = namedtuple('PreparedArchive', 'blob series cached rows version params')
+
+
+def _heavy_work(sha256, archive_path, rows, params, need_calculation, index=None, progress=None, storage=None):
+    # Выполняется в дочернем процессе: только диск и вычисления
+    # (progress передается только при обработке в текущем процессе).
+    # Без готового index заголовки серии индексируются здесь, а записываются
+    # в базу уже в _finalize; такой индекс возвращается четвертым элементом.
+    # storage - бэкенд уже существующей серии (иначе бэкенд по умолчанию).
+    on_member = None
+    if progress is not None:
+        progress(ProcessingJob.Stage.EXTRACTING)
+
+        def on_member(done, total):
+            progress(members_done=done, members_total=total)
+
+    with memory_section('extract'):
+        relpath = materialize_series(sha256, archive_path, on_member=on_member, storage=storage)
+    abspath = series_location(relpath, storage)
+    codec = (read_manifest(abspath) or {}).get("codec", "")
+    new_index = None
+    if index is None:
+        if progress is not None:
+            progress(ProcessingJob.Stage.INDEXING)
+        with memory_section('index'):
+            index = new_index = read_index(abspath, codec)
+    if not need_calculation:
+        return relpath, None, None, new_index
+    if progress is not None:
+        progress(ProcessingJob.Stage.ANALYZING)
+    with memory_section('calculate'):
+        variant_id, outputs = run_calculation(sha256, abspath, codec, rows, params, index)
+    return relpath, variant_id, outputs, new_index
+
+
+def _prepare(file_obj, params, version):
+    blob, _ = store_blob(file_obj)
+    series = DicomSeries.objects.filter(blob=blob).first()
+    cached = cached_result(blob.sha256, params, version)
+    return blob, series, cached
+
+
+def _known_index(series):
+    # Индекс из базы для уже проиндексированной серии, иначе None
+    if series is None or series.indexed_at is None:
+        return None
+    return series_index(series)
+
+
+def _series_storage(series):
+    # Бэкенд серии выбирается один раз в родительском процессе и передается
+    # явно и в распаковку, и в register_series: запись в базе указывает туда,
+    # куда серия действительно распакована
+    return series.storage if series is not None else get_storage().name
+
+
+def _finalize(case, blob, relpath, storage, params, version, cached, variant_id, outputs, index=None):
+    series = register_series(blob, relpath, storage)
+    if index is not None:
+        store_index(series, index)
+    result = cached or save_result(blob.sha256, params, version, variant_id, outputs)
+
+    DICOMUpload.objects.create(case=case, blob=blob, sha256=blob.sha256, size=blob.size)
+    case.dicom_series = series
+    case.save(update_fields=['dicom_series', 'updated_at'])
+    variant_key = str(result.implant_variant_id)
+    density = result.outputs.get("density", {}).get(variant_key, {})
+    mechanics = result.outputs.get("biomechanics", {}).get(variant_key, {})
+    IndividualImplant.objects.update_or_create(
+        case=case,
+        defaults={
+            "implant_variant": result.implant_variant,
+            "is_calculated": True,
+            "measured_hu": density.get("mean"),
+            "density_profile": density or None,
+            "case_load": mechanics.get("load"),
+            "bone_hu": mechanics.get("bone_hu"),
+            "interface_stress": mechanics.get("stress"),
+            "safety_factor": mechanics.get("safety_factor"),
+        }
+    )
+    return result
+
+
+def prepare_case_archive(file_obj, params=None):
+    """
+    Быстрая часть обработки: сохранение блоба, поиск готовой серии и
+    расчета в кэше. Выполняется, пока жив временный файл загрузки.
+    """
+    params = params or {}
+    rows = library_rows()
+    version = library_version(rows)
+    with memory_section('store'):
+        blob, series, cached = _prepare(file_obj, params, version)
+    return PreparedArchive(blob, series, cached, rows, version, params)
+
+
+def process_prepared(case, prepared, progress=None):
+    """
+    Распаковка, расчет и запись результата для подготовленного архива.
+    progress(stage, **поля) получает этапы и ход распаковки.
+    Возвращает (CalculationResult, из кэша ли результат).
+    """
+    blob, series, cached, rows, version, params = prepared
+    storage = _series_storage(series)
+    if series is not None and cached is not None:
+        relpath, variant_id, outputs, index = series.path, None, None, None
+    else:
+        relpath, variant_id, outputs, index = _heavy_work(
+            blob.sha256, blob.file.path, rows, params, cached is None, _known_index(series), progress, storage
+        )
+    result = _finalize(case, blob, relpath, storage, params, version, cached, variant_id, outputs, index)
+    return result, cached is not None
+
+
+def process_case_archive(case, file_obj, params=None, progress=None):
+    """
+    Полная обработка одного архива в текущем процессе.
+    Возвращает (CalculationResult, из кэша ли результат).
+    """
+    return process_prepared(case, prepare_case_archive(file_obj, params), progress)
+
+
+def default_workers():
+    return getattr(settings, 'DICOM_BATCH_WORKERS', None) or os.cpu_count() or 1
+
+
+def default_start_method():
+    # fork из многопоточного веб-воркера (поток записи журнала, фоновые задачи,
+    # потоки gthread) может унаследовать захваченные блокировки, поэтому по
+    # умолчанию процессы пула запускаются с чистого интерпретатора
+    return 'forkserver' if os.name == 'posix' else 'spawn'
+
+
+def process_batch(items, params=None, workers=None, max_in_flight=None, on_result=None, start_method=None):
+    """
+    Обрабатывает пары (case_id, файл архива) на пуле процессов.
+    В работе одновременно не больше max_in_flight архивов (по умолчанию
+    2 * workers), следующий архив ставится в очередь только после
+    завершения одного из текущих. Одинаковые архивы (по sha256) в пакете
+    обрабатываются в пуле один раз, остальные приемы ждут ту же задачу.
+    Возвращает результаты в порядке items.
+    start_method - способ запуска процессов пула; fork допустим только из
+    однопоточного процесса (команда process_dicom_batch).
+    """
+    params = params or {}
+    workers = workers or default_workers()
+    max_in_flight = max_in_flight or 2 * workers
+    rows = library_rows()
+    version = library_version(rows)
+    results = [None] * len(items)
+
+    def report(index, item):
+        results[index] = item
+        if on_result is not None:
+            on_result(item)
+
+    start_method = start_method or default_start_method()
+    if start_method == 'fork':
+        # Соединения с базой не должны наследоваться дочерними процессами
+        connections.close_all()
+    context = multiprocessing.get_context(start_method)
+    # задача пула -> приемы, ожидающие ее результата
+    pending = {}
+    # django.setup как инициализатор: модуль django импортируется в новом
+    # процессе без моделей, а настройки берутся из DJANGO_SETTINGS_MODULE
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=django.setup) as pool:
+        for index, (case_id, file_obj) in enumerate(items):
+            started = time.monotonic()
+            try:
+                case = MedicalCase.objects.get(id=case_id)
+                blob, series, cached = _prepare(file_obj, params, version)
+            except MedicalCase.DoesNotExist:
+                report(index, {"case_id": case_id, "status": "error", "error": "Прием не найден"})
+                continue
+            except (OSError, ValueError, zipfile.BadZipFile, UnsafeArchive) as e:
+                report(index, {"case_id": case_id, "status": "error", "error": str(e)})
+                continue
+
+            storage = _series_storage(series)
+            pending_item = (index, case, blob, storage, cached, started)
+            if series is not None and cached is not None:
+                # Архив и расчет уже есть, пул не нужен
+                work = (series.path, None, None, None)
+                _complete(pending_item, work, params, version, report)
+                continue
+
+            future = _in_flight(pending, blob.sha256)
+            if future is None:
+                # Обратное давление: ждем, пока освободится место в окне
+                while len(pending) >= max_in_flight:
+                    _drain(pending, params, version, report)
+                future = pool.submit(
+                    _heavy_work, blob.sha256, blob.file.path, rows, params, cached is None, _known_index(series),
+                    storage=storage
+                )
+                pending[future] = []
+            pending[future].append(pending_item)
+
+        while pending:
+            _drain(pending, params, version, report)
+    return results
+
+
+def _in_flight(pending, sha256):
+    # Задача пула, уже распаковывающая этот архив (окно небольшое, хватает перебора)
+    for future, pending_items in pending.items():
+        if pending_items[0][2].sha256 == sha256:
+            return future
+    return None
+
+
+def _drain(pending, params, version, report):
+    done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+    for future in done:
+        pending_items = pending.pop(future)
+        try:
+            work = future.result()
+        except Exception as e:
+            for pending_item in pending_items:
+                _report_error(pending_item, e, report)
+            continue
+        for pending_item in pending_items:
+            _complete(pending_item, work, params, version, report)
+
+
+def _report_error(pending_item, error, report):
+    index, case = pending_item[0], pending_item[1]
+    report(index, {"case_id": case.id, "status": "error", "error": str(error) or error.__class__.__name__})
+
+
+def _complete(pending_item, work, params, version, report):
+    index, case, blob, storage, cached, started = pending_item
+    relpath, variant_id, outputs, index_rows = work
+    try:
+        result = _finalize(case, blob, relpath, storage, params, version, cached, variant_id, outputs, index_rows)
+    except Exception as e:
+        _report_error(pending_item, e, report)
+        return
+    report(index, {
+        "case_id": case.id,
+        "status": "ok",
+        "implant_variant": result.implant_variant_id,
+        "cached": cached is not None,
+        "seconds": round(time.monotonic() - started, 3),
+    })
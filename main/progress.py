@@ -0,0 +1,215 @@
+# progress.py
+# Фоновая обработка загруженных архивов с отчетом о ходе работы.
+# Клиент передает заголовок X-Upload-Id, получает 202 сразу после загрузки
+# и следит за ProcessingJob через поток событий /api/uploads/<id>/events/
+# (main/events.py). Состояние хранится в базе, поэтому поток событий может
+# обслуживать любой процесс, а не только тот, что обрабатывает архив.
+# Задачи выполняются в пуле потоков процесса и пропадают вместе с ним, поэтому
+# процесс раз в четверть PROCESSING_JOB_STALE_AFTER обновляет updated_at своих
+# задач, а задачи, не обновлявшиеся дольше этого срока, считаются брошенными
+# и помечаются ошибкой (mark_stale_jobs).
+import re
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+from .admission import release_slots
+from .extraction import UnsafeArchive
+from .models import IndividualImplant, MedicalCase, ProcessingJob
+from .processing import process_prepared
+
+UPLOAD_ID_HEADER = 'HTTP_X_UPLOAD_ID'
+UPLOAD_ID_RE = re.compile(r'^[A-Za-z0-9_-]{8,64}$')
+
+ACTIVE_STAGES = (
+    ProcessingJob.Stage.RECEIVING, ProcessingJob.Stage.QUEUED, ProcessingJob.Stage.EXTRACTING,
+    ProcessingJob.Stage.INDEXING, ProcessingJob.Stage.ANALYZING,
+)
+
+_executor = None
+_executor_lock = threading.Lock()
+# Задачи процесса, которые ждут в очереди или выполняются
+_pending = set()
+
+
+def valid_upload_id(value):
+    return bool(value and UPLOAD_ID_RE.match(value))
+
+
+def report_interval():
+    return getattr(settings, 'PROGRESS_REPORT_INTERVAL', 0.5)
+
+
+def stale_after():
+    return getattr(settings, 'PROCESSING_JOB_STALE_AFTER', 600)
+
+
+class ProgressReporter:
+    """
+    Записывает ход обработки в ProcessingJob. Смена этапа пишется сразу,
+    счетчики - не чаще раза в PROGRESS_REPORT_INTERVAL секунд.
+    """
+
+    def __init__(self, upload_id, interval=None):
+        self.upload_id = upload_id
+        self.interval = report_interval() if interval is None else interval
+        self.pending = {}
+        self.last = 0.0
+
+    def __call__(self, stage=None, **fields):
+        if stage:
+            fields['stage'] = stage
+        self.pending.update(fields)
+        if stage or time.monotonic() - self.last >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        ProcessingJob.objects.filter(upload_id=self.upload_id).update(updated_at=timezone.now(), **self.pending)
+        self.pending = {}
+        self.last = time.monotonic()
+
+
+class UploadIdTaken(Exception):
+    # X-Upload-Id уже занят задачей другого пользователя
+    pass
+
+
+def claim_job(upload_id, user_id, **fields):
+    """
+    Создает задачу upload_id пользователя user_id или обновляет полями fields
+    его прежнюю задачу с тем же id. Задачу другого пользователя не трогает -
+    UploadIdTaken.
+    """
+    job, created = ProcessingJob.objects.get_or_create(upload_id=upload_id, defaults=dict(fields, user_id=user_id))
+    if created:
+        return job
+    if job.user_id != user_id:
+        raise UploadIdTaken(upload_id)
+    for name, value in fields.items():
+        setattr(job, name, value)
+    job.save()
+    return job
+
+
+def job_owned_by_other(upload_id, user_id):
+    return ProcessingJob.objects.filter(upload_id=upload_id).exclude(user_id=user_id).exists()
+
+
+def start_job(upload_id, user, case, bytes_total=0):
+    # Задача могла быть создана раньше - при приеме тела запроса (asgi.py)
+    return claim_job(
+        upload_id, user.pk, case=case, bytes_total=bytes_total, bytes_received=bytes_total, error="", result=None,
+    )
+
+
+def job_result(case, cached):
+    # Итог для последнего события: основные поля IndividualImplant
+    implant = IndividualImplant.objects.filter(case=case).first()
+    if implant is None:
+        return {"case": case.id, "implant": None, "cached": cached}
+    return {
+        "case": case.id,
+        "implant": implant.id,
+        "implant_variant": implant.implant_variant_id,
+        "is_calculated": implant.is_calculated,
+        "measured_hu": implant.measured_hu,
+        "interface_stress": implant.interface_stress,
+        "safety_factor": implant.safety_factor,
+        "cached": cached,
+    }
+
+
+def is_stale(job):
+    return job.stage in ACTIVE_STAGES and job.updated_at < timezone.now() - timedelta(seconds=stale_after())
+
+
+def mark_stale_jobs(**filters):
+    """
+    Помечает ошибкой задачи, которые не обновлялись дольше
+    PROCESSING_JOB_STALE_AFTER секунд: процесс, обрабатывавший их, завершился.
+    Возвращает число помеченных задач.
+    """
+    now = timezone.now()
+    return ProcessingJob.objects.filter(
+        stage__in=ACTIVE_STAGES, updated_at__lt=now - timedelta(seconds=stale_after()), **filters
+    ).update(stage=ProcessingJob.Stage.FAILED, error="Обработка прервана: процесс сервера остановлен", updated_at=now)
+
+
+def pending_jobs():
+    with _executor_lock:
+        return len(_pending)
+
+
+def _heartbeat():
+    # Задачи процесса, в том числе ждущие в очереди, не должны выглядеть брошенными
+    while True:
+        time.sleep(stale_after() / 4)
+        with _executor_lock:
+            upload_ids = list(_pending)
+        if not upload_ids:
+            continue
+        try:
+            ProcessingJob.objects.filter(upload_id__in=upload_ids, stage__in=ACTIVE_STAGES).update(
+                updated_at=timezone.now()
+            )
+        except Exception:
+            # База недоступна - повторим на следующем шаге
+            pass
+        finally:
+            connections.close_all()
+
+
+def job_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = getattr(settings, 'DICOM_JOB_WORKERS', None) or 2
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dicom-job')
+            threading.Thread(target=_heartbeat, name='dicom-job-heartbeat', daemon=True).start()
+    return _executor
+
+
+def run_job(upload_id, case_id, prepared, slots=()):
+    reporter = ProgressReporter(upload_id)
+    try:
+        case = MedicalCase.objects.get(pk=case_id)
+        _, cached = process_prepared(case, prepared, reporter)
+        reporter(ProcessingJob.Stage.DONE, result=job_result(case, cached))
+    except (ValueError, zipfile.BadZipFile, UnsafeArchive, MedicalCase.DoesNotExist) as e:
+        reporter(ProcessingJob.Stage.FAILED, error=str(e) or e.__class__.__name__)
+    except Exception as e:
+        reporter(ProcessingJob.Stage.FAILED, error=f"Ошибка обработки: {e.__class__.__name__}")
+        raise
+    finally:
+        # Места ограничения нагрузки, переданные запросом загрузки
+        release_slots(slots)
+        with _executor_lock:
+            _pending.discard(upload_id)
+        # Соединения потока пула не закрываются сигналами запроса
+        connections.close_all()
+
+
+def submit_job(upload_id, case, prepared, slots=()):
+    """
+    Ставит обработку в очередь пула. slots - места admission.py, которые
+    задача держит до конца обработки и освобождает сама.
+    """
+    try:
+        ProgressReporter(upload_id)(ProcessingJob.Stage.QUEUED)
+        executor = job_executor()
+        with _executor_lock:
+            _pending.add(upload_id)
+        return executor.submit(run_job, upload_id, case.id, prepared, slots)
+    except Exception:
+        with _executor_lock:
+            _pending.discard(upload_id)
+        release_slots(slots)
+        raise
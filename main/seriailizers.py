@@ -1,10 +1,10 @@
-import os
-
-from django.conf import settings
 from rest_framework import serializers, generics
 from django.contrib.auth import get_user_model
+from .dicom_storage import case_slices, compact_descriptor, slice_url
+from .fragments import CachedFragmentListSerializer, CachedFragmentMixin
+from .images import IMAGE_FIELDS, image_url
 from .models import (
-    WorkerProfile, Patient, MedicalCase, IndividualImplant, ImplantLibrary
+    WorkerProfile, Patient, MedicalCase, IndividualImplant, ImplantLibrary, ProcessingJob
 )
 
 # АУТЕНТИФИКАЦИЯ И ПОЛЬЗОВАТЕЛИ
@@ -118,7 +118,48 @@ class UserProfileSerializer(serializers.ModelSerializer):
         fields = ("name", "surname", "patronymic")
 
 
-class PatientSerializer(serializers.ModelSerializer):
+class QueryFieldsMixin:
+    # ?fields=id,patient_fio оставляет в ответе только перечисленные поля,
+    # так списки могут вовсе не перечислять срезы DICOM.
+    # ?expand=patient вместо id связанного объекта отдает его представление
+    # (поля из Meta.expandable: имя -> класс сериализатора)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        if request is None or request.method != 'GET':
+            return
+        expand = request.query_params.get('expand')
+        if expand:
+            expandable = getattr(self.Meta, 'expandable', {})
+            for name in {name.strip() for name in expand.split(',')} & set(expandable):
+                self.fields[name] = expandable[name](read_only=True)
+        requested = request.query_params.get('fields')
+        if requested:
+            allowed = {name.strip() for name in requested.split(',')}
+            for name in set(self.fields) - allowed:
+                self.fields.pop(name)
+
+
+def requested_image_url(request, item, field):
+    # ?size=thumb|card|large выбирает уменьшенную копию, ?image_format=jpeg - формат (по умолчанию webp)
+    return image_url(request, item, field, request.query_params.get('size'), request.query_params.get('image_format'))
+
+
+class DicomFilesMixin:
+    # ?dicom=compact заменяет список ссылок на срезы компактным описанием серии
+    def get_dicom_files(self, obj):
+        # Проверка наличия request в контексте, чтобы не было 500 ошибки
+        request = self.context.get('request')
+        if not request:
+            return []
+
+        if request.query_params.get('dicom') == 'compact':
+            return compact_descriptor(request, obj)
+        # Порядок срезов берется из манифеста серии, чтобы слайдер шел по порядку
+        return [slice_url(request, obj, rel_path) for rel_path, _ in case_slices(obj)]
+
+
+class PatientSerializer(QueryFieldsMixin, serializers.ModelSerializer):
     fio = serializers.SerializerMethodField(read_only=True)
     birth_date = serializers.DateField(
         format="%d.%m.%Y",
@@ -138,7 +179,7 @@ class PatientSerializer(serializers.ModelSerializer):
         return f"{obj.surname} {obj.name} {obj.patronymic}".strip()
 
 
-class MedicalCaseSerializer(serializers.ModelSerializer):
+class MedicalCaseSerializer(CachedFragmentMixin, QueryFieldsMixin, DicomFilesMixin, serializers.ModelSerializer):
     patient_fio = serializers.CharField(source='patient.__str__', read_only=True)
     created_at = serializers.DateTimeField(format="%d.%m.%Y %H:%M", read_only=True)
 
@@ -152,6 +193,9 @@ class MedicalCaseSerializer(serializers.ModelSerializer):
             'id', 'patient', 'patient_fio', 'user',
             'diagnosis', 'created_at', 'implant_data', 'dicom_files'
         ]
+        # Пациент входит в фрагмент приема: его правка обновляет updated_at приема
+        expandable = {'patient': PatientSerializer}
+        list_serializer_class = CachedFragmentListSerializer
 
     def get_implant_data(self, obj):
         try:
@@ -164,27 +208,6 @@ class MedicalCaseSerializer(serializers.ModelSerializer):
             pass
         return None
 
-    def get_dicom_files(self, obj):
-        request = self.context.get('request')
-        if not request:
-            return []
-
-        folder_path = os.path.join(settings.MEDIA_ROOT, 'dicoms', f'case_{obj.id}')
-        file_urls = []
-
-        if os.path.exists(folder_path):
-            # Рекурсивно обходим все папки внутри (os.walk)
-            for root, dirs, files in os.walk(folder_path):
-                # Сортируем файлы, чтобы слайдер шел по порядку
-                for f in sorted(files):
-                    if not f.startswith('.'):
-                        rel_path = os.path.relpath(os.path.join(root, f), settings.MEDIA_ROOT)
-                        # Формируем полный URL через request
-                        path = os.path.join(settings.MEDIA_URL, rel_path).replace('\\', '/')
-                        file_urls.append(request.build_absolute_uri(path))
-        return file_urls
-
-
 
 class ImplantSerializer(serializers.ModelSerializer):
     visualization_image = serializers.SerializerMethodField()
@@ -199,28 +222,43 @@ class ImplantSerializer(serializers.ModelSerializer):
     chewing_load = serializers.ReadOnlyField(source='implant_variant.chewing_load', default=None)
     limit_stress = serializers.ReadOnlyField(source='implant_variant.limit_stress', default=None)
     surface_area = serializers.ReadOnlyField(source='implant_variant.surface_area', default=None)
+    safety_margin = serializers.SerializerMethodField()
 
     class Meta:
         model = IndividualImplant
         fields = '__all__'
 
+    def get_safety_margin(self, obj):
+        # Запас сверх предельного напряжения: 0.5 = на 50% ниже предела
+        if obj.safety_factor is None:
+            return None
+        return round(obj.safety_factor - 1, 4)
+
     def get_visualization_image(self, obj):
-        if obj.implant_variant and obj.implant_variant.visualization_image:
-            return self.context['request'].build_absolute_uri(obj.implant_variant.visualization_image.url)
+        if obj.implant_variant:
+            return requested_image_url(self.context['request'], obj.implant_variant, 'visualization_image')
         return None
 
     def get_density_graph(self, obj):
-        if obj.implant_variant and obj.implant_variant.density_graph:
-            return self.context['request'].build_absolute_uri(obj.implant_variant.density_graph.url)
+        if obj.implant_variant:
+            return requested_image_url(self.context['request'], obj.implant_variant, 'density_graph')
         return None
 
 
 class ImplantLibrarySerializer(serializers.ModelSerializer):
     class Meta:
         model = ImplantLibrary
-        fields = '__all__'
+        exclude = ('image_variants',)
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        request = self.context.get('request')
+        if request is not None:
+            for field in IMAGE_FIELDS:
+                data[field] = requested_image_url(request, instance, field)
+        return data
 
-class CaseDetailSerializer(serializers.ModelSerializer):
+class CaseDetailSerializer(CachedFragmentMixin, QueryFieldsMixin, DicomFilesMixin, serializers.ModelSerializer):
     implant_data = serializers.SerializerMethodField()
     dicom_files = serializers.SerializerMethodField()
     patient_fio = serializers.CharField(source='patient.__str__', read_only=True)
@@ -229,6 +267,8 @@ class CaseDetailSerializer(serializers.ModelSerializer):
     class Meta:
         model = MedicalCase
         fields = ['id', 'patient_fio', 'user', 'diagnosis', 'created_at', 'implant_data', 'dicom_files']
+        expandable = {'patient': PatientSerializer}
+        list_serializer_class = CachedFragmentListSerializer
 
     def get_implant_data(self, obj):
         # Безопасно проверяем наличие OneToOne связи
@@ -240,20 +280,8 @@ class CaseDetailSerializer(serializers.ModelSerializer):
             pass
         return None
 
-    def get_dicom_files(self, obj):
-        # Проверка наличия request в контексте, чтобы не было 500 ошибки
-        request = self.context.get('request')
-        if not request:
-            return []
 
-        folder_path = os.path.join(settings.MEDIA_ROOT, 'dicoms', f'case_{obj.id}')
-        file_urls = []
-        if os.path.exists(folder_path):
-            for root, dirs, files in os.walk(folder_path):
-                for f in sorted(files):
-                    if not f.startswith('.'):
-                        rel_path = os.path.relpath(os.path.join(root, f), settings.MEDIA_ROOT)
-                        # Используем request для построения ссылки
-                        path = os.path.join(settings.MEDIA_URL, rel_path).replace('\\', '/')
-                        file_urls.append(request.build_absolute_uri(path))
-        return file_urls
+class ProcessingJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ProcessingJob
+        exclude = ('id', 'user')
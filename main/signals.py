@@ -0,0 +1,142 @@
+# signals.py
+from django.db.models.signals import post_delete, post_init, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .fragments import invalidate_all
+from .images import delete_variant_files, variant_names
+from .models import (
+    DeletedRecord, DICOMUpload, DicomSeries, ImplantLibrary, IndividualImplant, MedicalCase, Patient
+)
+from .stats import (
+    UNKNOWN, apply_case_change, apply_implant_change, case_bucket, implant_bucket, loaded_bucket, stored_bucket
+)
+
+# Поля, от которых зависят корзины статистики
+CASE_FIELDS = {'created_at', 'user_id'}
+IMPLANT_FIELDS = {'is_calculated', 'implant_variant_id'}
+
+
+@receiver(post_delete, sender=ImplantLibrary)
+def delete_image_variants(sender, instance, **kwargs):
+    # Оригиналы удаляет django_cleanup, уменьшенные копии - здесь
+    delete_variant_files(instance, set(variant_names(instance)))
+
+
+# Счетчики панели администратора (main/stats.py)
+
+@receiver(post_init, sender=MedicalCase)
+def remember_case_bucket(sender, instance, **kwargs):
+    instance._stats_bucket = loaded_bucket(instance, CASE_FIELDS, case_bucket)
+
+
+@receiver(pre_save, sender=MedicalCase)
+def load_case_bucket(sender, instance, **kwargs):
+    if getattr(instance, '_stats_bucket', None) is UNKNOWN:
+        instance._stats_bucket = stored_bucket(instance, CASE_FIELDS, case_bucket)
+
+
+@receiver(post_save, sender=MedicalCase)
+def count_case(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    new = case_bucket(instance)
+    apply_case_change(getattr(instance, '_stats_bucket', None), new)
+    instance._stats_bucket = new
+
+
+@receiver(post_delete, sender=MedicalCase)
+def uncount_case(sender, instance, **kwargs):
+    apply_case_change(case_bucket(instance), None)
+
+
+@receiver(post_init, sender=IndividualImplant)
+def remember_implant_bucket(sender, instance, **kwargs):
+    instance._stats_bucket = loaded_bucket(instance, IMPLANT_FIELDS, implant_bucket)
+
+
+@receiver(pre_save, sender=IndividualImplant)
+def load_implant_bucket(sender, instance, **kwargs):
+    if getattr(instance, '_stats_bucket', None) is UNKNOWN:
+        instance._stats_bucket = stored_bucket(instance, IMPLANT_FIELDS, implant_bucket)
+
+
+@receiver(post_save, sender=IndividualImplant)
+def count_implant(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    new = implant_bucket(instance)
+    apply_implant_change(getattr(instance, '_stats_bucket', None), new)
+    instance._stats_bucket = new
+
+
+@receiver(post_delete, sender=IndividualImplant)
+def uncount_implant(sender, instance, **kwargs):
+    apply_implant_change(implant_bucket(instance), None)
+
+
+# Синхронизация клиентов (main/sync.py): отметки об удалении и обновление
+# updated_at приема, когда меняются данные, которые отдаются вместе с ним
+
+@receiver(post_delete, sender=Patient)
+def patient_tombstone(sender, instance, **kwargs):
+    DeletedRecord.objects.create(kind=DeletedRecord.Kind.PATIENT, object_id=instance.pk)
+
+
+@receiver(post_delete, sender=MedicalCase)
+def case_tombstone(sender, instance, **kwargs):
+    DeletedRecord.objects.create(kind=DeletedRecord.Kind.CASE, object_id=instance.pk)
+
+
+@receiver(post_save, sender=Patient)
+def touch_patient_cases(sender, instance, created=False, raw=False, **kwargs):
+    # В приеме отдается ФИО пациента
+    if not created and not raw:
+        MedicalCase.objects.filter(patient_id=instance.pk).update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=IndividualImplant)
+@receiver(post_delete, sender=IndividualImplant)
+def touch_implant_case(sender, instance, raw=False, **kwargs):
+    if not raw:
+        MedicalCase.objects.filter(pk=instance.case_id).update(updated_at=timezone.now())
+
+
+# Кэш представлений приемов (main/fragments.py): ключ фрагмента включает
+# updated_at приема, остальные зависимости обновляют его здесь и выше
+
+@receiver(post_save, sender=DICOMUpload)
+@receiver(post_delete, sender=DICOMUpload)
+def touch_upload_case(sender, instance, raw=False, **kwargs):
+    if not raw:
+        MedicalCase.objects.filter(pk=instance.case_id).update(updated_at=timezone.now())
+
+
+@receiver(pre_delete, sender=DicomSeries)
+def touch_series_cases(sender, instance, **kwargs):
+    # Ссылка на серию обнуляется без сигналов (SET_NULL)
+    MedicalCase.objects.filter(dicom_series_id=instance.pk).update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=DicomSeries)
+def touch_indexed_series_cases(sender, instance, update_fields=None, raw=False, **kwargs):
+    # Порядок срезов в приеме берется из индекса заголовков, а ссылки на срезы
+    # зависят от хранилища серии
+    if not raw and update_fields and {'indexed_at', 'storage'} & set(update_fields):
+        MedicalCase.objects.filter(dicom_series_id=instance.pk).update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=ImplantLibrary)
+@receiver(post_delete, sender=ImplantLibrary)
+def invalidate_library_fragments(sender, instance, raw=False, **kwargs):
+    # Параметры и изображения варианта входят в данные расчета приемов и в
+    # данные синхронизации клиентов
+    invalidate_all()
+    if not raw and kwargs.get('signal') is post_save:
+        MedicalCase.objects.filter(implant__implant_variant=instance).update(updated_at=timezone.now())
+
+
+@receiver(pre_delete, sender=ImplantLibrary)
+def touch_variant_cases(sender, instance, **kwargs):
+    # Ссылка импланта на вариант обнуляется без сигналов (SET_NULL)
+    MedicalCase.objects.filter(implant__implant_variant=instance).update(updated_at=timezone.now())
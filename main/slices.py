@@ -0,0 +1,195 @@
+# slices.py
+# Запись и чтение срезов серии DICOM с прозрачным сжатием без потерь.
+# Каждый срез хранится отдельным файлом (<имя>.zz для zlib, <имя>.zst для zstd),
+# рядом лежит манифест с исходными размерами, чтобы не обходить папку.
+import json
+import os
+import zlib
+
+from django.conf import settings
+
+MANIFEST_NAME = '.manifest.json'
+CHUNK_SIZE = 1024 * 1024
+# Префикс адреса серии во внешнем хранилище вместо пути на диске (main/storage.py)
+STORAGE_SCHEME = 'storage://'
+
+CODEC_NONE = ''
+CODEC_ZLIB = 'zlib'
+CODEC_ZSTD = 'zstd'
+# Срезы не распакованы и читаются из архива-блоба (main/archive_store.py)
+CODEC_ARCHIVE = 'zip'
+
+SUFFIXES = {
+    CODEC_NONE: '',
+    CODEC_ZLIB: '.zz',
+    CODEC_ZSTD: '.zst',
+}
+
+
+def configured_codec():
+    codec = getattr(settings, 'DICOM_SLICE_COMPRESSION', CODEC_NONE) or CODEC_NONE
+    if codec == 'none':
+        codec = CODEC_NONE
+    if codec not in SUFFIXES:
+        raise ValueError(f"Неизвестный кодек сжатия срезов: {codec}")
+    return codec
+
+
+def check_codec():
+    # Проверка настройки при запуске: без zstandard кодек zstd ломал бы
+    # каждую загрузку и отдачу среза, а не запуск приложения
+    from django.core.exceptions import ImproperlyConfigured
+    try:
+        if configured_codec() == CODEC_ZSTD:
+            _zstd()
+    except (ValueError, RuntimeError) as e:
+        raise ImproperlyConfigured(f"DICOM_SLICE_COMPRESSION: {e}")
+
+
+def configured_level():
+    return int(getattr(settings, 'DICOM_SLICE_COMPRESSION_LEVEL', 6))
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("Для кодека zstd установите пакет zstandard")
+    return zstandard
+
+
+def stored_name(relpath, codec):
+    return relpath + SUFFIXES[codec]
+
+
+def write_slice(src, dest_path, codec=CODEC_NONE, level=6):
+    """
+    Потоково копирует срез из src в dest_path, сжимая выбранным кодеком.
+    Возвращает (исходный размер, размер на диске).
+    """
+    size = 0
+    with open(dest_path, 'wb', buffering=CHUNK_SIZE) as dst:
+        if codec == CODEC_ZSTD:
+            compressor = _zstd().ZstdCompressor(level=level).compressobj()
+        elif codec == CODEC_ZLIB:
+            compressor = zlib.compressobj(level)
+        else:
+            compressor = None
+
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+            size += len(chunk)
+            dst.write(compressor.compress(chunk) if compressor else chunk)
+        if compressor:
+            dst.write(compressor.flush())
+        stored = dst.tell()
+    return size, stored
+
+
+class _DecompressingReader:
+    # Файлоподобная обертка: разжимает срез порциями по мере чтения
+    def __init__(self, raw, decompressor):
+        self.raw = raw
+        self.decompressor = decompressor
+        self.buffer = b''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size):
+        pending = [self.buffer[self.pos:]]
+        available = len(pending[0])
+        while not self.eof and (size < 0 or available < size):
+            chunk = self.raw.read(CHUNK_SIZE)
+            if chunk:
+                data = self.decompressor.decompress(chunk)
+            else:
+                flush = getattr(self.decompressor, 'flush', None)
+                data = flush() if flush is not None else b''
+                self.eof = True
+            pending.append(data)
+            available += len(data)
+        self.buffer = b''.join(pending)
+        self.pos = 0
+
+    def read(self, size=-1):
+        if size < 0 or len(self.buffer) - self.pos < size:
+            self._fill(size)
+        if size < 0:
+            data = self.buffer[self.pos:]
+        else:
+            data = self.buffer[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_stored(series_dir, relpath, codec):
+    # Открывает срез как есть, без распаковки (для отдачи с Content-Encoding).
+    # series_dir - папка на диске или адрес серии во внешнем хранилище (main/storage.py)
+    if series_dir.startswith(STORAGE_SCHEME):
+        from .storage import open_location
+        return open_location(series_dir, stored_name(relpath, codec))
+    return open(os.path.join(series_dir, stored_name(relpath, codec)), 'rb')
+
+
+def open_slice(series_dir, relpath, codec=CODEC_NONE):
+    # Открывает срез на чтение с прозрачной распаковкой
+    if codec == CODEC_ARCHIVE:
+        from .archive_store import open_archive_slice
+        return open_archive_slice(series_dir, relpath)
+    raw = open_stored(series_dir, relpath, codec)
+    if codec == CODEC_ZLIB:
+        return _DecompressingReader(raw, zlib.decompressobj())
+    if codec == CODEC_ZSTD:
+        return _DecompressingReader(raw, _zstd().ZstdDecompressor().decompressobj())
+    return raw
+
+
+def read_slice(series_dir, relpath, codec=CODEC_NONE):
+    # Срез целиком в памяти (для разбора заголовков и пикселей)
+    with open_slice(series_dir, relpath, codec) as f:
+        return f.read()
+
+
+def write_manifest(series_dir, codec, entries):
+    # entries: {относительный путь: (исходный размер, размер на диске)}
+    manifest = {"codec": codec, "files": {k: list(v) for k, v in entries.items()}}
+    with open(os.path.join(series_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f)
+
+
+def read_manifest(series_dir):
+    if series_dir.startswith(STORAGE_SCHEME):
+        from .storage import read_location_manifest
+        return read_location_manifest(series_dir)
+    try:
+        with open(os.path.join(series_dir, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def list_series(series_dir):
+    """
+    Возвращает отсортированный список (относительный путь, исходный размер)
+    срезов серии. Для серий без манифеста (старые папки case_<id>) обходит диск.
+    """
+    manifest = read_manifest(series_dir)
+    if manifest is not None:
+        return sorted((name, sizes[0]) for name, sizes in manifest["files"].items())
+
+    result = []
+    if os.path.exists(series_dir):
+        for root, dirs, files in os.walk(series_dir):
+            for f in sorted(files):
+                if not f.startswith('.'):
+                    path = os.path.join(root, f)
+                    result.append((os.path.relpath(path, series_dir).replace('\\', '/'), os.path.getsize(path)))
+    return result
@@ -0,0 +1,159 @@
+# stats.py
+# Счетчики для панели администратора. Вместо подсчета по всем приемам
+# храним готовые корзины (врач x месяц, рассчитанные импланты, варианты
+# библиотеки) и меняем их на +-1 при записи приемов и расчетов.
+# Изменения в обход сигналов (queryset.update, правки в базе) исправляет
+# команда rollup_dashboard_stats, пересчитывающая таблицу целиком.
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from .models import DashboardCounter, IndividualImplant, MedicalCase
+
+CASES = DashboardCounter.Kind.CASES
+CALCULATED = DashboardCounter.Kind.CALCULATED
+VARIANT = DashboardCounter.Kind.VARIANT
+
+# Корзина объекта неизвестна: нужные поля не загружены
+UNKNOWN = object()
+
+
+def month_of(value):
+    return timezone.localtime(value).date().replace(day=1)
+
+
+def counter_key(kind, month=None, user_id=None, variant_id=None):
+    return f"{kind}:{month.isoformat() if month else '-'}:{user_id or '-'}:{variant_id or '-'}"
+
+
+def bump(kind, delta, month=None, user_id=None, variant_id=None):
+    # Атомарное изменение счетчика; корзина создается при первом обращении
+    if not delta:
+        return
+    key = counter_key(kind, month, user_id, variant_id)
+    if DashboardCounter.objects.filter(key=key).update(value=F('value') + delta):
+        return
+    try:
+        with transaction.atomic():
+            DashboardCounter.objects.create(
+                key=key, kind=kind, month=month, user_id=user_id, implant_variant_id=variant_id, value=delta,
+            )
+    except IntegrityError:
+        # Корзину успел создать параллельный запрос
+        DashboardCounter.objects.filter(key=key).update(value=F('value') + delta)
+
+
+def case_bucket(case):
+    # (месяц, врач) приема; None - прием еще не сохранен
+    return (month_of(case.created_at), case.user_id) if case.created_at else None
+
+
+def implant_bucket(implant):
+    # (рассчитан, вариант); None - расчет еще не сохранен
+    return (bool(implant.is_calculated), implant.implant_variant_id) if implant.pk else None
+
+
+def loaded_bucket(instance, fields, bucket):
+    """
+    Корзина объекта в том виде, в каком он загружен из базы.
+    Если нужные поля отложены (only/defer), возвращает UNKNOWN - корзину
+    тогда читает pre_save, чтобы не делать запрос на каждую загрузку.
+    """
+    if instance.pk and fields & instance.get_deferred_fields():
+        return UNKNOWN
+    return bucket(instance)
+
+
+def stored_bucket(instance, fields, bucket):
+    # Корзина по сохраненной в базе версии объекта
+    stored = type(instance)._base_manager.filter(pk=instance.pk).only(*fields).first()
+    return bucket(stored) if stored else None
+
+
+def apply_case_change(old, new):
+    # old/new - корзины (месяц, врач) до и после записи или None
+    if old == new:
+        return
+    if old:
+        bump(CASES, -1, month=old[0], user_id=old[1])
+    if new:
+        bump(CASES, 1, month=new[0], user_id=new[1])
+
+
+def apply_implant_change(old, new):
+    # old/new - (рассчитан, вариант) до и после записи или None
+    old_calculated, old_variant = old or (False, None)
+    new_calculated, new_variant = new or (False, None)
+    bump(CALCULATED, int(new_calculated) - int(old_calculated))
+    if old_variant != new_variant:
+        if old_variant:
+            bump(VARIANT, -1, variant_id=old_variant)
+        if new_variant:
+            bump(VARIANT, 1, variant_id=new_variant)
+
+
+def rollup():
+    """
+    Полный пересчет счетчиков по таблицам приемов и расчетов.
+    Возвращает количество корзин.
+    """
+    counters = []
+    per_doctor = (MedicalCase.objects.annotate(month=TruncMonth('created_at'))
+                  .values('month', 'user_id').annotate(value=Count('id')).order_by())
+    for row in per_doctor:
+        month = row['month'].date() if hasattr(row['month'], 'date') else row['month']
+        counters.append(DashboardCounter(
+            key=counter_key(CASES, month, row['user_id']), kind=CASES,
+            month=month, user_id=row['user_id'], value=row['value'],
+        ))
+    calculated = IndividualImplant.objects.filter(is_calculated=True).count()
+    counters.append(DashboardCounter(key=counter_key(CALCULATED), kind=CALCULATED, value=calculated))
+    per_variant = (IndividualImplant.objects.exclude(implant_variant=None)
+                   .values('implant_variant_id').annotate(value=Count('id')).order_by())
+    for row in per_variant:
+        counters.append(DashboardCounter(
+            key=counter_key(VARIANT, variant_id=row['implant_variant_id']), kind=VARIANT,
+            implant_variant_id=row['implant_variant_id'], value=row['value'],
+        ))
+    with transaction.atomic():
+        DashboardCounter.objects.all().delete()
+        DashboardCounter.objects.bulk_create(counters)
+    return len(counters)
+
+
+def dashboard(since=None, top=10):
+    """
+    Данные панели: приемы по врачам и месяцам, рассчитанные и ожидающие
+    расчета импланты, самые используемые варианты. Читает только корзины.
+    """
+    counters = DashboardCounter.objects.filter(value__gt=0)
+    per_doctor = counters.filter(kind=CASES)
+    if since:
+        per_doctor = per_doctor.filter(month__gte=since)
+    per_doctor = per_doctor.select_related('user').order_by('month', 'user_id')
+
+    cases_total = counters.filter(kind=CASES).aggregate(total=Sum('value'))['total'] or 0
+    calculated = counters.filter(kind=CALCULATED).aggregate(total=Sum('value'))['total'] or 0
+    variants = counters.filter(kind=VARIANT).select_related('implant_variant').order_by('-value', 'implant_variant_id')
+
+    return {
+        "cases_per_doctor": [
+            {
+                "month": c.month.strftime('%Y-%m'),
+                "user": c.user_id,
+                "doctor": f"{c.user.surname} {c.user.name} {c.user.patronymic}".strip() if c.user else None,
+                "count": c.value,
+            }
+            for c in per_doctor
+        ],
+        "implants": {
+            "cases": cases_total,
+            "calculated": calculated,
+            "pending": max(cases_total - calculated, 0),
+        },
+        "top_variants": [
+            {"implant_variant": c.implant_variant_id, "name": c.implant_variant.name, "count": c.value}
+            for c in variants[:top]
+        ],
+    }
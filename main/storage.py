@@ -0,0 +1,319 @@
+# storage.py
+# Хранилище папок серий DICOM (манифест и срезы) с заменяемым бэкендом:
+# local - папки под MEDIA_ROOT, как раньше; objects - объектное хранилище
+# на диске в DICOM_OBJECT_STORE_ROOT (для разработки и проверки без облака);
+# s3 - бакет S3-совместимого хранилища (нужен пакет boto3).
+# Бэкенд новых серий задает DICOM_SERIES_STORAGE, бэкенд каждой серии
+# записан в DicomSeries.storage, поэтому после смены настройки старые серии
+# читаются, пока их не перенесет команда migrate_dicom_storage.
+# Серия собирается в локальной временной папке и публикуется целиком;
+# в объектное хранилище манифест пишется последним, без него серии нет.
+# Архивы-блобы по-прежнему лежат в MEDIA_ROOT.
+import json
+import os
+import shutil
+import uuid
+
+from django.conf import settings
+
+from .slices import CODEC_ARCHIVE, MANIFEST_NAME, STORAGE_SCHEME, stored_name
+
+STORAGE_LOCAL = 'local'
+STORAGE_OBJECTS = 'objects'
+STORAGE_S3 = 's3'
+COPY_CHUNK_SIZE = 1024 * 1024
+S3_DELETE_BATCH = 1000
+
+
+def _key(*parts):
+    return '/'.join(part.replace('\\', '/').strip('/') for part in parts)
+
+
+class LocalSeriesStorage:
+    # Папка серии на диске; несжатые срезы отдаются как обычная медиа
+    name = STORAGE_LOCAL
+
+    def location(self, relpath):
+        return os.path.join(settings.MEDIA_ROOT, relpath)
+
+    def staging_dir(self, relpath):
+        # Рядом с итоговой папкой, чтобы публикация была одним переименованием
+        path = f"{self.location(relpath)}.{uuid.uuid4().hex}.tmp"
+        os.makedirs(path)
+        return path
+
+    def exists(self, relpath):
+        return os.path.isdir(self.location(relpath))
+
+    def publish(self, tmp_dir, relpath, replace=False):
+        dest = self.location(relpath)
+        old_path = None
+        if replace and os.path.isdir(dest):
+            old_path = f"{dest}.{uuid.uuid4().hex}.old"
+            os.rename(dest, old_path)
+        try:
+            os.rename(tmp_dir, dest)
+        except OSError:
+            # Папку уже создал параллельный запрос
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        if old_path is not None:
+            shutil.rmtree(old_path, ignore_errors=True)
+
+    def open(self, relpath, name):
+        return open(os.path.join(self.location(relpath), name), 'rb')
+
+    def url(self, relpath):
+        return os.path.join(settings.MEDIA_URL, relpath, '').replace('\\', '/')
+
+    def delete(self, relpath):
+        shutil.rmtree(self.location(relpath), ignore_errors=True)
+
+
+class ObjectSeriesStorage:
+    # Серия - набор объектов с ключами "<путь серии>/<файл>"
+
+    def __init__(self, name, client):
+        self.name = name
+        self.client = client
+
+    def location(self, relpath):
+        # storage://<бэкенд>/<путь серии>
+        return f"{STORAGE_SCHEME}{self.name}/{_key(relpath)}"
+
+    def staging_dir(self, relpath):
+        path = os.path.join(settings.DICOM_CACHE_ROOT, 'staging', uuid.uuid4().hex)
+        os.makedirs(path)
+        return path
+
+    def exists(self, relpath):
+        return self.client.exists(_key(relpath, MANIFEST_NAME))
+
+    def publish(self, tmp_dir, relpath, replace=False):
+        try:
+            if not replace and self.exists(relpath):
+                return
+            keys = set()
+            for root, dirs, files in os.walk(tmp_dir):
+                for f in files:
+                    if root == tmp_dir and f == MANIFEST_NAME:
+                        continue
+                    path = os.path.join(root, f)
+                    key = _key(relpath, os.path.relpath(path, tmp_dir))
+                    with open(path, 'rb') as src:
+                        self.client.put(key, src)
+                    keys.add(key)
+            manifest_key = _key(relpath, MANIFEST_NAME)
+            with open(os.path.join(tmp_dir, MANIFEST_NAME), 'rb') as src:
+                self.client.put(manifest_key, src)
+            keys.add(manifest_key)
+            if replace:
+                # Срезы прежней версии серии, которых нет в новом манифесте
+                self.client.delete([key for key in self.client.list(_key(relpath) + '/') if key not in keys])
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def open(self, relpath, name):
+        return self.client.open(_key(relpath, name))
+
+    def url(self, relpath):
+        # None - прямых ссылок нет, срезы отдает DicomSliceView
+        base = self.client.url(_key(relpath))
+        return base + '/' if base else None
+
+    def delete(self, relpath):
+        keys = self.client.list(_key(relpath) + '/')
+        # Манифест первым: читатели сразу перестают видеть серию
+        keys.sort(key=lambda key: not key.endswith('/' + MANIFEST_NAME))
+        self.client.delete(keys)
+
+
+class FileObjectClient:
+    """
+    Объектное хранилище на локальном диске: ключ - путь файла под root.
+    Объект записывается во временный файл и подменяется целиком, как PUT.
+    """
+
+    def __init__(self, root, base_url=None):
+        self.root = root
+        self.base_url = base_url
+
+    def _path(self, key):
+        path = os.path.normpath(os.path.join(self.root, key))
+        if not path.startswith(os.path.normpath(self.root) + os.sep):
+            raise ValueError(f"Недопустимый ключ объекта: {key}")
+        return path
+
+    def put(self, key, src):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def open(self, key):
+        return open(self._path(key), 'rb')
+
+    def exists(self, key):
+        return os.path.isfile(self._path(key))
+
+    def list(self, prefix):
+        keys = []
+        base = self._path(prefix)
+        for root, dirs, files in os.walk(base):
+            for f in files:
+                if not f.endswith('.tmp'):
+                    keys.append(_key(prefix, os.path.relpath(os.path.join(root, f), base)))
+        return sorted(keys)
+
+    def delete(self, keys):
+        for key in keys:
+            path = self._path(key)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            # Пустые каталоги не нужны: в объектном хранилище их нет
+            directory = os.path.dirname(path)
+            while directory != os.path.normpath(self.root):
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    break
+                directory = os.path.dirname(directory)
+
+    def url(self, key):
+        return f"{self.base_url.rstrip('/')}/{key}" if self.base_url else None
+
+
+class S3ObjectClient:
+    # Бакет S3-совместимого хранилища (AWS, MinIO, Yandex Object Storage)
+
+    def __init__(self, bucket, endpoint_url=None, base_url=None):
+        try:
+            import boto3
+            from botocore.exceptions import ClientError
+        except ImportError:
+            raise RuntimeError("Для хранилища s3 установите пакет boto3")
+        self.s3 = boto3.client('s3', endpoint_url=endpoint_url or None)
+        self.bucket = bucket
+        self.base_url = base_url
+        self.client_error = ClientError
+
+    def _missing(self, error):
+        return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+    def put(self, key, src):
+        self.s3.upload_fileobj(src, self.bucket, key)
+
+    def open(self, key):
+        try:
+            return self.s3.get_object(Bucket=self.bucket, Key=key)['Body']
+        except self.client_error as e:
+            if self._missing(e):
+                raise FileNotFoundError(key)
+            raise
+
+    def exists(self, key):
+        try:
+            self.s3.head_object(Bucket=self.bucket, Key=key)
+        except self.client_error as e:
+            if self._missing(e):
+                return False
+            raise
+        return True
+
+    def list(self, prefix):
+        keys = []
+        for page in self.s3.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=prefix):
+            keys.extend(item['Key'] for item in page.get('Contents', ()))
+        return keys
+
+    def delete(self, keys):
+        for start in range(0, len(keys), S3_DELETE_BATCH):
+            batch = keys[start:start + S3_DELETE_BATCH]
+            self.s3.delete_objects(Bucket=self.bucket, Delete={'Objects': [{'Key': key} for key in batch]})
+
+    def url(self, key):
+        return f"{self.base_url.rstrip('/')}/{key}" if self.base_url else None
+
+
+_backends = {}
+
+
+def _create(name):
+    if name == STORAGE_LOCAL:
+        return LocalSeriesStorage()
+    if name == STORAGE_OBJECTS:
+        root = getattr(settings, 'DICOM_OBJECT_STORE_ROOT', None) or os.path.join(settings.DICOM_CACHE_ROOT, 'objects')
+        return ObjectSeriesStorage(name, FileObjectClient(root, getattr(settings, 'DICOM_OBJECT_STORE_URL', None)))
+    if name == STORAGE_S3:
+        client = S3ObjectClient(
+            settings.DICOM_S3_BUCKET,
+            getattr(settings, 'DICOM_S3_ENDPOINT_URL', None),
+            getattr(settings, 'DICOM_OBJECT_STORE_URL', None),
+        )
+        return ObjectSeriesStorage(name, client)
+    raise ValueError(f"Неизвестное хранилище серий DICOM: {name}")
+
+
+def get_storage(name=None):
+    # Бэкенд по имени, по умолчанию - для новых серий (DICOM_SERIES_STORAGE)
+    name = name or getattr(settings, 'DICOM_SERIES_STORAGE', STORAGE_LOCAL) or STORAGE_LOCAL
+    backend = _backends.get(name)
+    if backend is None:
+        backend = _backends.setdefault(name, _create(name))
+    return backend
+
+
+def series_location(relpath, name=None):
+    # Путь на диске для local, адрес storage:// для объектных хранилищ
+    return get_storage(name).location(relpath)
+
+
+def is_remote(location):
+    return location.startswith(STORAGE_SCHEME)
+
+
+def open_location(location, name):
+    backend, _, relpath = location[len(STORAGE_SCHEME):].partition('/')
+    return get_storage(backend).open(relpath, name)
+
+
+def read_location_manifest(location):
+    try:
+        with open_location(location, MANIFEST_NAME) as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def copy_series(relpath, source, target):
+    """
+    Копирует серию из бэкенда source в target (по манифесту, срезы как
+    хранятся, без пересжатия). Возвращает число скопированных байт.
+    """
+    with source.open(relpath, MANIFEST_NAME) as f:
+        manifest = json.loads(f.read())
+    codec = manifest["codec"]
+    tmp_path = target.staging_dir(relpath)
+    copied = 0
+    try:
+        # В режиме archive в серии только манифест
+        names = [] if codec == CODEC_ARCHIVE else [stored_name(name, codec) for name in manifest["files"]]
+        for name in names + [MANIFEST_NAME]:
+            path = os.path.join(tmp_path, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with source.open(relpath, name) as src, open(path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+                copied += dst.tell()
+    except Exception:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    target.publish(tmp_path, relpath, replace=True)
+    return copied
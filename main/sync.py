@@ -0,0 +1,71 @@
+# sync.py
+# Инкрементальная синхронизация пациентов и приемов.
+# Клиент передает водяной знак (время предыдущей синхронизации) и получает
+# только измененные с тех пор записи и id удаленных. Запись, транзакция
+# которой началась до водяного знака, а закоммичена после, получит более
+# раннее updated_at - поэтому выборка захватывает SYNC_OVERLAP секунд до
+# водяного знака. Повторы клиент просто перезаписывает по id.
+from datetime import timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import DeletedRecord, MedicalCase, Patient
+
+
+def sync_overlap():
+    return timedelta(seconds=getattr(settings, 'SYNC_OVERLAP', 5))
+
+
+def tombstone_retention():
+    return timedelta(days=getattr(settings, 'SYNC_TOMBSTONE_DAYS', 90))
+
+
+def parse_watermark(value):
+    # None - полная выгрузка; ValueError - мусор вместо даты
+    if not value:
+        return None
+    # "+" смещения в неэкранированной строке запроса превращается в пробел
+    parsed = parse_datetime(value.strip().replace(' ', '+'))
+    if parsed is None:
+        raise ValueError("Некорректный водяной знак")
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, dt_timezone.utc)
+    return parsed
+
+
+def changes_since(since):
+    """
+    Изменения после водяного знака since (None - все данные).
+    Возвращает словарь: watermark, reset, querysets patients/cases и id удаленных.
+    Если отметки об удалении за период уже очищены, отдаем полную выгрузку
+    с reset=True - клиент должен заменить свои данные целиком.
+    """
+    watermark = timezone.now()
+    reset = since is None or since < watermark - tombstone_retention()
+
+    patients = Patient.objects.order_by('id')
+    cases = MedicalCase.objects.select_related('patient', 'user', 'dicom_series').prefetch_related(
+        'implant__implant_variant').order_by('id')
+    deleted = {DeletedRecord.Kind.PATIENT: [], DeletedRecord.Kind.CASE: []}
+    if not reset:
+        start = since - sync_overlap()
+        patients = patients.filter(updated_at__gte=start)
+        cases = cases.filter(updated_at__gte=start)
+        tombstones = DeletedRecord.objects.filter(deleted_at__gte=start).values_list('kind', 'object_id')
+        for kind, object_id in tombstones:
+            deleted[kind].append(object_id)
+    return {
+        "watermark": watermark,
+        "reset": reset,
+        "patients": patients,
+        "cases": cases,
+        "deleted": deleted,
+    }
+
+
+def purge_tombstones():
+    # Отметки старше срока хранения больше не нужны: такие клиенты получат reset
+    deleted, _ = DeletedRecord.objects.filter(deleted_at__lt=timezone.now() - tombstone_retention()).delete()
+    return deleted
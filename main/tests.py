@@ -1,3 +1,1592 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import io
+import json
+import os
+import shutil
+import struct
+import tarfile
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from asgiref.sync import async_to_sync
+from django.core.cache import caches
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, router
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from PIL import Image
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework_simplejwt.tokens import AccessToken
+from uvicorn.config import Config as UvicornConfig
+
+from smartdentist_backend import server
+from smartdentist_backend.workers import JobAwareServer
+
+from . import admission, audit, db_router, events, processing, progress, stats, storage, sync
+from .biomechanics import MIN_CONTACT, evaluate, library_arrays, rank
+from .bundle import FORMAT_TAR, FORMAT_ZIP, ZIP64_LIMIT, Bundle
+from .calculation import analysis_params, invalidate_stale, run_calculation
+from .density import sample_cylinders, trilinear
+from .dicom_index import index_series, read_index, store_index
+from .dicom_storage import (
+    case_dicom_dir, case_slices, collect_garbage, extract_series, materialize_series, series_dir, store_blob
+)
+from .extraction import DEFAULT_LIMITS, UnsafeArchive, extract_archive, plan_extraction
+from .images import build_image_variants, variant_names
+from .mesh import extract_surface, load_mesh, mesh_params
+from .models import (
+    Account, AuditEvent, CalculationResult, DashboardCounter, DeletedRecord, DicomBlob, DicomSeries, DICOMUpload,
+    ImplantLibrary, IndividualImplant, MedicalCase, Patient, ProcessingJob,
+)
+from .panoramic import default_params as default_panoramic_params
+from .panoramic import detect_arch, load_reconstruction, reconstruct, reconstruction_file
+from .processing import process_case_archive
+from .seriailizers import MedicalCaseSerializer
+from .slices import CODEC_NONE, MANIFEST_NAME, read_slice
+from .sync import parse_watermark
+from .volume import load_volume
+
+REPLICAS = ['replica_0', 'replica_1']
+
+
+@override_settings(DATABASE_REPLICAS=REPLICAS, DATABASE_REPLICA_LAG=2.0)
+class ReplicaRoutingTests(SimpleTestCase):
+    # Маршрутизация проверяется без обращения к базам: отставание реплик подменено
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.lags = {alias: 0.0 for alias in REPLICAS}
+        patcher = mock.patch.object(db_router, 'replica_lag', side_effect=lambda alias: self.lags[alias])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _request(self, request, view):
+        # Прогоняет запрос через middleware; view возвращает базу, выбранную для чтения
+        seen = []
+
+        def get_response(req):
+            seen.append(view())
+            return HttpResponse()
+
+        response = db_router.ReplicaRoutingMiddleware(get_response)(request)
+        return seen[0], response
+
+    def test_safe_read_goes_to_replica(self):
+        db, response = self._request(self.factory.get('/api/patients/'), lambda: Patient.objects.all().db)
+        self.assertIn(db, REPLICAS)
+        self.assertNotIn(db_router.PIN_COOKIE, response.cookies)
+
+    def test_read_outside_request_goes_to_primary(self):
+        self.assertEqual(Patient.objects.all().db, DEFAULT_DB_ALIAS)
+
+    def test_unsafe_method_reads_primary_and_pins(self):
+        db, response = self._request(self.factory.post('/api/patients/create/'), lambda: Patient.objects.all().db)
+        self.assertEqual(db, DEFAULT_DB_ALIAS)
+        self.assertIn(db_router.PIN_COOKIE, response.cookies)
+
+    def test_read_after_write_in_request_goes_to_primary(self):
+        def view():
+            router.db_for_write(Patient)
+            return Patient.objects.all().db
+
+        db, response = self._request(self.factory.get('/api/patients/'), view)
+        self.assertEqual(db, DEFAULT_DB_ALIAS)
+        self.assertIn(db_router.PIN_COOKIE, response.cookies)
+
+    def test_pinned_client_reads_primary(self):
+        _, response = self._request(self.factory.post('/api/patients/create/'), lambda: None)
+        request = self.factory.get('/api/patients/')
+        request.COOKIES[db_router.PIN_COOKIE] = response.cookies[db_router.PIN_COOKIE].value
+        db, _ = self._request(request, lambda: Patient.objects.all().db)
+        self.assertEqual(db, DEFAULT_DB_ALIAS)
+
+    def test_expired_pin_reads_replica(self):
+        request = self.factory.get('/api/patients/')
+        request.COOKIES[db_router.PIN_COOKIE] = '1.0'
+        db, _ = self._request(request, lambda: Patient.objects.all().db)
+        self.assertIn(db, REPLICAS)
+
+    def test_lagging_replica_is_skipped(self):
+        self.lags['replica_0'] = 10.0
+        for _ in range(20):
+            db, _ = self._request(self.factory.get('/api/patients/'), lambda: Patient.objects.all().db)
+            self.assertEqual(db, 'replica_1')
+
+    def test_all_replicas_lagging_fall_back_to_primary(self):
+        self.lags.update({alias: float('inf') for alias in REPLICAS})
+        db, _ = self._request(self.factory.get('/api/patients/'), lambda: Patient.objects.all().db)
+        self.assertEqual(db, DEFAULT_DB_ALIAS)
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_no_replicas_no_pin_cookie(self):
+        db, response = self._request(self.factory.post('/api/patients/create/'), lambda: Patient.objects.all().db)
+        self.assertEqual(db, DEFAULT_DB_ALIAS)
+        self.assertNotIn(db_router.PIN_COOKIE, response.cookies)
+
+
+class TempMediaMixin:
+    # Медиа, кэш и объектное хранилище во временной папке теста
+
+    def setUp(self):
+        super().setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        overrides = override_settings(
+            MEDIA_ROOT=os.path.join(self.root, 'media'),
+            DICOM_CACHE_ROOT=os.path.join(self.root, 'cache'),
+            DICOM_OBJECT_STORE_ROOT=os.path.join(self.root, 'objects'),
+            DICOM_OBJECT_STORE_URL=None,
+            DICOM_SERIES_STORAGE=storage.STORAGE_LOCAL,
+            DICOM_SLICE_COMPRESSION='none',
+            DICOM_STORAGE_MODE='extracted',
+            FRAGMENT_CACHE_ALIAS='default',
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        caches['default'].clear()
+        # Бэкенды кэшируются вместе с корнем хранилища
+        storage._backends.clear()
+        self.addCleanup(storage._backends.clear)
+
+
+SERIES_FILES = {'series/IMG0001.dcm': b'a' * 100, 'series/IMG0002.dcm': b'b' * 200}
+
+
+def stage_series(backend, relpath, files=SERIES_FILES):
+    tmp_dir = backend.staging_dir(relpath)
+    for name, data in files.items():
+        path = os.path.join(tmp_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+    with open(os.path.join(tmp_dir, MANIFEST_NAME), 'w') as f:
+        json.dump({"codec": "", "files": {name: [len(data), len(data)] for name, data in files.items()}}, f)
+    return tmp_dir
+
+
+class SeriesStorageTests(TempMediaMixin, SimpleTestCase):
+    relpath = 'series/ab/cd/abcdef'
+
+    def check_round_trip(self, backend):
+        self.assertFalse(backend.exists(self.relpath))
+        backend.publish(stage_series(backend, self.relpath), self.relpath)
+        self.assertTrue(backend.exists(self.relpath))
+        for name, data in SERIES_FILES.items():
+            with backend.open(self.relpath, name) as f:
+                self.assertEqual(f.read(), data)
+
+        # Новая версия серии заменяет прежнюю целиком
+        backend.publish(stage_series(backend, self.relpath, {'series/IMG0003.dcm': b'c'}), self.relpath, replace=True)
+        with backend.open(self.relpath, 'series/IMG0003.dcm') as f:
+            self.assertEqual(f.read(), b'c')
+        with self.assertRaises(OSError):
+            backend.open(self.relpath, 'series/IMG0001.dcm')
+
+        backend.delete(self.relpath)
+        self.assertFalse(backend.exists(self.relpath))
+
+    def test_local_round_trip(self):
+        backend = storage.get_storage(storage.STORAGE_LOCAL)
+        self.check_round_trip(backend)
+        self.assertEqual(backend.url(self.relpath), f"/media/{self.relpath}/")
+        self.assertEqual(os.listdir(os.path.join(self.root, 'media', 'series', 'ab', 'cd')), [])
+
+    def test_objects_round_trip(self):
+        backend = storage.get_storage(storage.STORAGE_OBJECTS)
+        self.check_round_trip(backend)
+        # Без DICOM_OBJECT_STORE_URL срезы отдаются через API
+        self.assertIsNone(backend.url(self.relpath))
+        self.assertEqual(backend.location(self.relpath), f"storage://objects/{self.relpath}")
+        # Пустые каталоги удалены вместе с объектами, временные папки - после публикации
+        self.assertEqual(os.listdir(os.path.join(self.root, 'objects')), [])
+        self.assertEqual(os.listdir(os.path.join(self.root, 'cache', 'staging')), [])
+
+    def test_objects_location_read(self):
+        backend = storage.get_storage(storage.STORAGE_OBJECTS)
+        backend.publish(stage_series(backend, self.relpath), self.relpath)
+        location = storage.series_location(self.relpath, storage.STORAGE_OBJECTS)
+        self.assertTrue(storage.is_remote(location))
+        self.assertEqual(storage.read_location_manifest(location)["files"]['series/IMG0002.dcm'], [200, 200])
+        self.assertEqual(read_slice(location, 'series/IMG0001.dcm'), SERIES_FILES['series/IMG0001.dcm'])
+
+    def test_copy_series_between_backends(self):
+        local = storage.get_storage(storage.STORAGE_LOCAL)
+        objects = storage.get_storage(storage.STORAGE_OBJECTS)
+        local.publish(stage_series(local, self.relpath), self.relpath)
+        copied = storage.copy_series(self.relpath, local, objects)
+        self.assertEqual(copied, sum(len(data) for data in SERIES_FILES.values()) + os.path.getsize(
+            os.path.join(local.location(self.relpath), MANIFEST_NAME)
+        ))
+        for name, data in SERIES_FILES.items():
+            with objects.open(self.relpath, name) as f:
+                self.assertEqual(f.read(), data)
+
+
+class FileObjectClientTests(TempMediaMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = storage.FileObjectClient(os.path.join(self.root, 'objects'), 'https://cdn.example.com/dicom/')
+
+    def test_put_open_list_delete(self):
+        self.client.put('a/b/one', io.BytesIO(b'1'))
+        self.client.put('a/two', io.BytesIO(b'2'))
+        self.client.put('a/two', io.BytesIO(b'22'))
+        self.assertTrue(self.client.exists('a/b/one'))
+        with self.client.open('a/two') as f:
+            self.assertEqual(f.read(), b'22')
+        self.assertEqual(self.client.list('a/'), ['a/b/one', 'a/two'])
+        self.assertEqual(self.client.url('a/two'), 'https://cdn.example.com/dicom/a/two')
+
+        self.client.delete(['a/b/one', 'a/missing'])
+        self.assertFalse(self.client.exists('a/b/one'))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'objects', 'a', 'b')))
+        self.assertEqual(self.client.list('a/'), ['a/two'])
+
+    def test_key_outside_root_rejected(self):
+        with self.assertRaises(ValueError):
+            self.client.put('../outside', io.BytesIO(b'x'))
+
+
+def make_archive(files):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+        for name, data in files.items():
+            zip_ref.writestr(name, data)
+    buf.seek(0)
+    return buf
+
+
+def make_user(email='doctor@example.com'):
+    return Account.objects.create_admin(email=email, name='Имя', surname='Фамилия', password='x')
+
+
+def make_case(user=None, patient=None):
+    user = user or Account.objects.first() or make_user()
+    patient = patient or Patient.objects.create(name='Имя', surname='Фамилия', birth_date='1980-01-01', gender=0)
+    return MedicalCase.objects.create(patient=patient, user=user, diagnosis='')
+
+
+class DicomBlobStoreTests(TempMediaMixin, TestCase):
+    def test_same_archive_stored_once(self):
+        archive = make_archive(SERIES_FILES)
+        blob, created = store_blob(archive)
+        self.assertTrue(created)
+        DicomBlob.objects.filter(pk=blob.pk).update(last_used_at=timezone.now() - timedelta(days=2))
+
+        again, created = store_blob(make_archive(SERIES_FILES))
+        self.assertFalse(created)
+        self.assertEqual(again.pk, blob.pk)
+        self.assertEqual(blob.sha256, hashlib.sha256(archive.getvalue()).hexdigest())
+        self.assertEqual(blob.size, len(archive.getvalue()))
+        # Повторная загрузка продлевает жизнь блоба, а файл остается один
+        blob.refresh_from_db()
+        self.assertGreater(blob.last_used_at, timezone.now() - timedelta(minutes=1))
+        blobs_dir = os.path.join(self.root, 'media', 'dicom_blobs')
+        self.assertEqual(sum(len(files) for _, _, files in os.walk(blobs_dir)), 1)
+
+    def test_series_extracted_once(self):
+        blob, _ = store_blob(make_archive(SERIES_FILES))
+        with mock.patch('main.dicom_storage.materialize_series', wraps=materialize_series) as materialize:
+            series = extract_series(blob)
+            self.assertEqual(extract_series(blob).pk, series.pk)
+        materialize.assert_called_once()
+        self.assertEqual(series.file_count, len(SERIES_FILES))
+        self.assertEqual(series.total_size, sum(len(data) for data in SERIES_FILES.values()))
+
+    def _blob_with_series(self, files, age):
+        blob, _ = store_blob(make_archive(files))
+        series = extract_series(blob)
+        DicomBlob.objects.filter(pk=blob.pk).update(last_used_at=timezone.now() - age)
+        return blob, series
+
+    def test_garbage_collection_keeps_referenced_and_recent_blobs(self):
+        used, used_series = self._blob_with_series(SERIES_FILES, timedelta(days=3))
+        MedicalCase.objects.filter(pk=make_case().pk).update(dicom_series=used_series)
+        recent, _ = self._blob_with_series({'a.dcm': b'recent'}, timedelta(hours=1))
+        orphan, orphan_series = self._blob_with_series({'b.dcm': b'orphan'}, timedelta(hours=25))
+        orphan_dir = series_dir(orphan_series)
+        orphan_file = orphan.file.path
+
+        self.assertEqual([sha for sha, _ in collect_garbage(dry_run=True)], [orphan.sha256])
+        self.assertTrue(DicomBlob.objects.filter(pk=orphan.pk).exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            removed = collect_garbage()
+        self.assertEqual(removed, [(orphan.sha256, orphan.size + orphan_series.total_size)])
+        self.assertEqual(
+            set(DicomBlob.objects.values_list('pk', flat=True)), {used.pk, recent.pk}
+        )
+        self.assertFalse(DicomSeries.objects.filter(pk=orphan_series.pk).exists())
+        self.assertFalse(os.path.exists(orphan_dir))
+        self.assertFalse(os.path.exists(orphan_file))
+        self.assertTrue(os.path.isdir(series_dir(used_series)))
+
+    def test_blob_released_when_last_case_is_deleted(self):
+        blob, series = self._blob_with_series(SERIES_FILES, timedelta(days=3))
+        first, second = make_case(), make_case()
+        MedicalCase.objects.filter(pk__in=[first.pk, second.pk]).update(dicom_series=series)
+
+        first.delete()
+        self.assertEqual(collect_garbage(), [])
+        second.delete()
+        self.assertEqual([sha for sha, _ in collect_garbage()], [blob.sha256])
+
+
+class CaseListPayloadTests(TempMediaMixin, TestCase):
+    slice_count = 300
+
+    def setUp(self):
+        super().setUp()
+        files = {f'series/IMG{i:04d}.dcm': b'x' * 10 for i in range(1, self.slice_count + 1)}
+        blob, _ = store_blob(make_archive(files))
+        series = extract_series(blob)
+        self.user = make_user()
+        for _ in range(3):
+            case = make_case(self.user)
+            case.dicom_series = series
+            case.save(update_fields=['dicom_series'])
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get(self, query=''):
+        response = self.client.get(f'/api/cases/{query}')
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_full_list_enumerates_slices(self):
+        cases = self.get().json()
+        self.assertEqual(len(cases), 3)
+        files = cases[0]['dicom_files']
+        self.assertEqual(len(files), self.slice_count)
+        self.assertTrue(files[0].startswith('http://testserver/'))
+        self.assertTrue(files[0].endswith('series/IMG0001.dcm'))
+
+    def test_compact_descriptor_shrinks_payload(self):
+        full = self.get().content
+        compact = self.get('?dicom=compact')
+        descriptor = compact.json()[0]['dicom_files']
+        self.assertEqual(descriptor['count'], self.slice_count)
+        self.assertEqual(descriptor['total_size'], self.slice_count * 10)
+        self.assertEqual((descriptor['pattern'], descriptor['start']), ('series/IMG%04d.dcm', 1))
+        self.assertNotIn('files', descriptor)
+        self.assertLess(len(compact.content) * 20, len(full))
+
+    def test_fields_skip_slice_enumeration(self):
+        with mock.patch('main.seriailizers.case_slices') as slices, \
+                mock.patch('main.seriailizers.compact_descriptor') as compact:
+            cases = self.get('?fields=id,patient_fio').json()
+        slices.assert_not_called()
+        compact.assert_not_called()
+        self.assertEqual([set(case) for case in cases], [{'id', 'patient_fio'}] * 3)
+        self.assertLess(len(self.get('?fields=id,patient_fio').content) * 100, len(self.get().content))
+
+    def test_expand_patient(self):
+        case = self.get('?expand=patient&fields=id,patient').json()[0]
+        self.assertEqual(set(case), {'id', 'patient'})
+        self.assertEqual(case['patient']['fio'], 'Фамилия Имя')
+        self.assertEqual(case['patient']['birth_date'], '01.01.1980')
+        # Без expand - только id пациента, и кэш фрагментов их не смешивает
+        self.assertIsInstance(self.get('?fields=id,patient').json()[0]['patient'], int)
+
+
+def make_library(**fields):
+    values = dict(
+        name='Вариант', diameter=4.0, length=10.0, thread_shape='V', thread_pitch=0.8, thread_depth='0.4',
+        bone_type='D2', hu_density=800, chewing_load=20.0, limit_stress=5.0, surface_area=300.0,
+    )
+    values.update(fields)
+    return ImplantLibrary.objects.create(**values)
+
+
+class CalculationCacheTests(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        make_library(name='A', hu_density=600)
+        make_library(name='B', hu_density=1200)
+
+    def process(self, params=None):
+        # Параметры приводятся к каноническому виду, как во view загрузки
+        return process_case_archive(make_case(), make_archive(SERIES_FILES), analysis_params(params or {}))
+
+    def test_repeat_calculation_served_from_cache(self):
+        first, cached = self.process({'bone_hu': 1150})
+        self.assertFalse(cached)
+        self.assertEqual(first.implant_variant.name, 'B')
+        with mock.patch('main.processing.run_calculation') as calculate:
+            second, cached = self.process({'bone_hu': '1150,0'})
+        calculate.assert_not_called()
+        self.assertTrue(cached)
+        self.assertEqual(second.pk, first.pk)
+        self.assertEqual(CalculationResult.objects.count(), 1)
+        self.assertEqual(IndividualImplant.objects.filter(implant_variant__name='B').count(), 2)
+
+    def test_params_are_part_of_key(self):
+        self.process({'bone_hu': 1150})
+        result, cached = self.process({'bone_hu': 650})
+        self.assertFalse(cached)
+        self.assertEqual(result.implant_variant.name, 'A')
+        self.assertEqual(CalculationResult.objects.count(), 2)
+
+    def test_library_change_invalidates_results(self):
+        old, _ = self.process()
+        variant = ImplantLibrary.objects.get(name='A')
+        variant.limit_stress = 6.0
+        variant.save()
+        result, cached = self.process()
+        self.assertFalse(cached)
+        self.assertNotEqual(result.library_version, old.library_version)
+        self.assertEqual(invalidate_stale(), 1)
+        self.assertEqual(list(CalculationResult.objects.all()), [result])
+
+    def test_safety_threshold_is_part_of_key(self):
+        self.process()
+        with override_settings(IMPLANT_MIN_SAFETY_FACTOR=3.0):
+            _, cached = self.process()
+        self.assertFalse(cached)
+
+
+class ThreadPool(ThreadPoolExecutor):
+    # Пул потоков вместо процессов: в тесте видны подмены и временные настройки
+    def __init__(self, max_workers, mp_context=None, initializer=None):
+        super().__init__(max_workers)
+
+
+class BatchProcessingTests(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        make_library()
+        self.cases = [make_case() for _ in range(3)]
+
+    def test_duplicate_archives_extracted_once(self):
+        heavy_work = mock.Mock(wraps=processing._heavy_work)
+        items = [
+            (self.cases[0].id, make_archive(SERIES_FILES)),
+            (self.cases[1].id, make_archive(SERIES_FILES)),
+            (self.cases[2].id, make_archive({'other/IMG0001.dcm': b'c' * 50})),
+        ]
+        with mock.patch.object(processing, 'ProcessPoolExecutor', ThreadPool), \
+                mock.patch.object(processing, '_heavy_work', heavy_work):
+            results = processing.process_batch(items, workers=2)
+        self.assertEqual([r['status'] for r in results], ['ok'] * 3)
+        self.assertEqual(heavy_work.call_count, 2)
+        self.assertEqual(DicomSeries.objects.count(), 2)
+        self.assertEqual(CalculationResult.objects.count(), 2)
+        self.assertEqual(MedicalCase.objects.filter(dicom_series__isnull=False).count(), 3)
+
+    def test_series_registered_in_backend_it_was_extracted_to(self):
+        with override_settings(DICOM_SERIES_STORAGE=storage.STORAGE_OBJECTS):
+            prepared = processing.prepare_case_archive(make_archive(SERIES_FILES))
+            # Бэкенд выбирается один раз и дальше передается явно
+            with mock.patch.object(processing, 'get_storage', wraps=processing.get_storage) as get_storage:
+                processing.process_prepared(self.cases[0], prepared)
+                get_storage.assert_called_once_with()
+        series = DicomSeries.objects.get()
+        self.assertEqual(series.storage, storage.STORAGE_OBJECTS)
+        self.assertTrue(storage.get_storage(storage.STORAGE_OBJECTS).exists(series.path))
+
+
+def zip_info(name, size=100, compressed=None):
+    info = zipfile.ZipInfo(name)
+    info.file_size = size
+    info.compress_size = size if compressed is None else compressed
+    return info
+
+
+class ExtractionLimitsTests(SimpleTestCase):
+    limits = dict(DEFAULT_LIMITS, max_members=3, max_total_size=1000, max_member_size=600,
+                  max_ratio=10, min_ratio_size=50)
+
+    def plan(self, *infos):
+        return [name for _, name in plan_extraction(infos, self.limits)]
+
+    def assert_unsafe(self, *infos):
+        with self.assertRaises(UnsafeArchive):
+            self.plan(*infos)
+
+    def test_paths_normalized(self):
+        self.assertEqual(self.plan(zip_info('./a//b.dcm'), zip_info('a\\c.dcm'), zip_info('a/.DS_Store')),
+                         ['a/b.dcm', 'a/c.dcm'])
+
+    def test_traversal_rejected(self):
+        for name in ('../x.dcm', 'a/../../x.dcm', '/etc/x.dcm', '\\x.dcm', 'C:/x.dcm'):
+            with self.subTest(name=name):
+                self.assert_unsafe(zip_info(name))
+
+    def test_symlink_rejected(self):
+        info = zip_info('a/link')
+        info.external_attr = (0o120777 << 16)
+        self.assert_unsafe(info)
+
+    def test_duplicate_names_rejected(self):
+        self.assert_unsafe(zip_info('a/b.dcm'), zip_info('./a//b.dcm'))
+        self.assert_unsafe(zip_info('a/b.dcm'), zip_info('a\\b.dcm'))
+
+    def test_compression_ratio(self):
+        # Малые файлы не проверяются, крупные - только с умеренным сжатием
+        self.plan(zip_info('small.dcm', 40, 1), zip_info('ok.dcm', 500, 50))
+        self.assert_unsafe(zip_info('bomb.dcm', 500, 49))
+
+    def test_size_limits(self):
+        self.assert_unsafe(zip_info('big.dcm', 601))
+        self.assert_unsafe(zip_info('a.dcm', 500), zip_info('b.dcm', 501))
+        self.assert_unsafe(*(zip_info(f'{i}.dcm', 10) for i in range(4)))
+
+    def test_unsafe_archive_not_extracted(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        archive = os.path.join(root, 'a.zip')
+        with open(archive, 'wb') as f:
+            f.write(make_archive({'series/a.dcm': b'a', '../escape.dcm': b'b'}).getvalue())
+        dest = os.path.join(root, 'out', 'series')
+        with self.assertRaises(UnsafeArchive):
+            extract_archive(archive, dest, CODEC_NONE, 0)
+        self.assertFalse(os.path.exists(dest))
+        self.assertFalse(os.path.exists(os.path.join(root, 'out', 'escape.dcm')))
+
+
+class DensitySamplingTests(SimpleTestCase):
+    def test_trilinear_matches_linear_volume(self):
+        volume = np.arange(24.0).reshape(2, 3, 4)
+        points = np.array([[0.5, 1.5, 2.5], [1, 2, 3], [0, 0, 0]])
+        np.testing.assert_allclose(trilinear(volume, points), [0.5 * 12 + 1.5 * 4 + 2.5, 23, 0])
+
+    def test_trilinear_outside_is_nan(self):
+        values = trilinear(np.ones((2, 2, 2)), np.array([[-0.1, 0, 0], [0, 1.1, 0], [1, 1, 1]]))
+        self.assertTrue(np.isnan(values[:2]).all())
+        self.assertEqual(values[2], 1)
+
+    def test_trilinear_single_voxel_axes(self):
+        np.testing.assert_allclose(trilinear(np.ones((1, 4, 4)), np.array([[0.0, 1.0, 1.0]])), [1])
+        row = np.arange(4.0).reshape(1, 1, 4)
+        np.testing.assert_allclose(trilinear(row, np.array([[0, 0, 1.5], [0, 0, 3]])), [1.5, 3])
+        self.assertTrue(np.isnan(trilinear(row, np.array([[0.5, 0, 0]]))).all())
+
+    def test_sample_cylinders_profile_and_coverage(self):
+        # HU растет на 10 с каждым срезом по z, срезы через 0.5 мм
+        volume = np.broadcast_to(10.0 * np.arange(40)[:, None, None], (40, 20, 20))
+        sampled = sample_cylinders(volume, (0.5, 1, 1), (10, 10, 4), (0, 0, 1), [2, 4], [5, 30], depth_steps=20)
+        self.assertEqual(sampled['depths'].shape, (2, 20))
+        self.assertEqual(sampled['profile'].shape, (2, 20))
+        # Глубина d мм - срез 4 + 2d
+        np.testing.assert_allclose(sampled['profile'][0], 10 * (4 + 2 * sampled['depths'][0]))
+        summary = sampled['summary']
+        self.assertEqual(summary['coverage'][0], 1)
+        self.assertAlmostEqual(summary['coverage'][1], 0.6)
+        self.assertEqual(summary['mean'][0], 90)
+        self.assertEqual(summary['min'][0], 42.5)
+
+    def test_zero_axis_rejected(self):
+        with self.assertRaises(ValueError):
+            sample_cylinders(np.zeros((2, 2, 2)), (1, 1, 1), (0, 0, 0), (0, 0, 0), [1], [1])
+
+
+def library_row(id, **fields):
+    row = dict(id=id, diameter=4.0, length=10.0, thread_pitch=0.8, thread_depth='0,4', hu_density=800,
+               chewing_load=20.0, limit_stress=5.0, surface_area=300.0)
+    row.update(fields)
+    return row
+
+
+class BiomechanicsTests(SimpleTestCase):
+    def test_stress_and_safety_factor(self):
+        arrays = library_arrays([library_row(1), library_row(2, thread_depth='', surface_area=150.0)])
+        result = evaluate(arrays, 20.0, np.array([1250.0, 125.0]))
+        # Резьба 0.4/0.8 дает коэффициент 1.25; без глубины резьбы - 1
+        np.testing.assert_allclose(result['contact'], [1.0, MIN_CONTACT])
+        np.testing.assert_allclose(result['stress'], [20 / 375, 20 / 30])
+        np.testing.assert_allclose(result['safety_factor'], [5 / (20 / 375), 5 / (20 / 30)])
+
+    def test_rank_prefers_passing_then_density(self):
+        safety = np.array([10.0, 1.0, 4.0, np.nan, 3.0])
+        error = np.array([50.0, 0.0, 10.0, 0.0, 10.0])
+        self.assertEqual(list(rank(safety, 1.5, density_error=error)), [2, 4, 0, 1, 3])
+        valid = np.array([True, True, False, True, True])
+        self.assertEqual(list(rank(safety, 1.5, density_error=error, valid=valid))[:2], [4, 0])
+
+    def test_zero_load_not_stored_as_nan(self):
+        _, outputs = run_calculation('', '', '', [library_row(1, surface_area=0.0)], {'bone_hu': 800.0})
+        mechanics = outputs['biomechanics']['1']
+        self.assertIsNone(mechanics['stress'])
+        json.dumps(outputs, allow_nan=False)
+
+
+class ImplantMechanicsTests(TempMediaMixin, TestCase):
+    def test_selected_variant_mechanics_saved(self):
+        make_library(name='A', hu_density=600)
+        variant = make_library(name='B', hu_density=1200)
+        case = make_case()
+        process_case_archive(case, make_archive(SERIES_FILES), analysis_params({'bone_hu': '1250', 'chewing_load': 20}))
+        implant = IndividualImplant.objects.get(case=case)
+        self.assertEqual(implant.implant_variant, variant)
+        self.assertEqual((implant.case_load, implant.bone_hu), (20.0, 1250.0))
+        self.assertAlmostEqual(implant.interface_stress, round(20 / 375, 4))
+        self.assertAlmostEqual(implant.safety_factor, 93.75)
+        self.assertIsNone(implant.measured_hu)
+
+    def test_bad_params_rejected(self):
+        for data in ({'chewing_load': '0'}, {'bone_hu': 'nan'}, {'implant_axis': '0,0,1'},
+                     {'implant_position': '1,2'}):
+            with self.subTest(data=data), self.assertRaises(ValueError):
+                analysis_params(data)
+
+
+def make_png(color, size=(40, 20), mode='RGBA'):
+    buf = io.BytesIO()
+    Image.new(mode, size, color).save(buf, 'PNG')
+    return buf.getvalue()
+
+
+@override_settings(IMAGE_VARIANT_SIZES={'thumb': 8, 'card': 16})
+class ImageVariantsTests(TempMediaMixin, TestCase):
+    def make_variant(self, color=(255, 0, 0, 128)):
+        variant = make_library(
+            visualization_image=SimpleUploadedFile('v.png', make_png(color)),
+            density_graph=SimpleUploadedFile('d.png', make_png((0, 0, 255, 255))),
+        )
+        build_image_variants(variant)
+        return variant
+
+    def test_variants_built_for_each_size_and_format(self):
+        variant = self.make_variant()
+        sizes = variant.image_variants['visualization_image']
+        self.assertEqual(set(sizes), {'thumb', 'card'})
+        for size, max_side in (('thumb', 8), ('card', 16)):
+            self.assertEqual(set(sizes[size]), {'webp', 'jpeg'})
+            for fmt, name in sizes[size].items():
+                with default_storage.open(name) as f, Image.open(f) as image:
+                    self.assertEqual(image.format, fmt.upper())
+                    self.assertEqual(max(image.size), max_side)
+        # JPEG без прозрачности
+        with default_storage.open(sizes['thumb']['jpeg']) as f, Image.open(f) as image:
+            self.assertEqual(image.mode, 'RGB')
+
+    def test_shared_files_kept_until_last_user(self):
+        first, second = self.make_variant(), self.make_variant()
+        names = set(variant_names(first))
+        self.assertEqual(names, set(variant_names(second)))
+        first.delete()
+        self.assertTrue(all(default_storage.exists(name) for name in names))
+        second.visualization_image = SimpleUploadedFile('v.png', make_png((0, 255, 0, 255)))
+        second.save()
+        build_image_variants(second)
+        gone = names - set(variant_names(second))
+        self.assertEqual(len(gone), 4)
+        self.assertFalse(any(default_storage.exists(name) for name in gone))
+
+    def test_library_urls_follow_size_and_format(self):
+        variant = self.make_variant()
+        client = APIClient()
+        client.force_authenticate(make_user())
+        item = client.get('/api/library/', {'size': 'thumb', 'image_format': 'jpeg'}).json()[0]
+        self.assertNotIn('image_variants', item)
+        self.assertTrue(item['visualization_image'].endswith(
+            variant.image_variants['visualization_image']['thumb']['jpeg']))
+        item = client.get('/api/library/').json()[0]
+        self.assertTrue(item['density_graph'].endswith(variant.density_graph.name))
+
+
+class DashboardCounterTests(TestCase):
+    def counters(self):
+        return dict(DashboardCounter.objects.filter(value__gt=0).values_list('key', 'value'))
+
+    def assert_matches_rollup(self):
+        incremental = self.counters()
+        stats.rollup()
+        self.assertEqual(incremental, self.counters())
+        return incremental
+
+    def test_signals_match_rollup(self):
+        first, second = make_user(), make_user('second@example.com')
+        variant_a, variant_b = make_library(name='A'), make_library(name='B')
+        cases = [make_case(first) for _ in range(3)] + [make_case(second)]
+        IndividualImplant.objects.create(case=cases[0], implant_variant=variant_a, is_calculated=True)
+        implant = IndividualImplant.objects.create(case=cases[1], implant_variant=variant_a)
+        implant.implant_variant, implant.is_calculated = variant_b, True
+        implant.save()
+        # Поля корзины отложены - сигнал дочитывает их из базы
+        moved = MedicalCase.objects.only('id').get(pk=cases[2].pk)
+        moved.user = second
+        moved.save()
+        old = MedicalCase.objects.get(pk=cases[3].pk)
+        old.created_at -= timedelta(days=62)
+        old.save()
+        cases[0].delete()
+
+        counters = self.assert_matches_rollup()
+        month = stats.month_of(timezone.now())
+        self.assertEqual(counters[stats.counter_key(stats.CASES, month, first.id)], 1)
+        self.assertEqual(counters[stats.counter_key(stats.CASES, month, second.id)], 1)
+        self.assertEqual(counters[stats.counter_key(stats.CALCULATED)], 1)
+        self.assertEqual(counters[stats.counter_key(stats.VARIANT, variant_id=variant_b.id)], 1)
+        self.assertNotIn(stats.counter_key(stats.VARIANT, variant_id=variant_a.id), counters)
+
+    def test_rollup_repairs_bulk_updates(self):
+        variant = make_library()
+        case = make_case()
+        IndividualImplant.objects.create(case=case, implant_variant=variant)
+        # queryset.update идет в обход сигналов
+        IndividualImplant.objects.update(is_calculated=True)
+        self.assertEqual(stats.dashboard()['implants'], {"cases": 1, "calculated": 0, "pending": 1})
+        stats.rollup()
+        dashboard = stats.dashboard()
+        self.assertEqual(dashboard['implants'], {"cases": 1, "calculated": 1, "pending": 0})
+        self.assertEqual(dashboard['top_variants'], [{"implant_variant": variant.id, "name": 'Вариант', "count": 1}])
+        self.assertEqual(dashboard['cases_per_doctor'][0]['count'], 1)
+
+
+@override_settings(SYNC_OVERLAP=5, SYNC_TOMBSTONE_DAYS=90)
+class SyncTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(make_user())
+
+    def sync(self, since=None):
+        response = self.client.get('/api/sync/', {'since': since} if since else {})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_full_then_incremental(self):
+        kept, changed = make_case(), make_case()
+        first = self.sync()
+        self.assertTrue(first['reset'])
+        self.assertEqual({c['id'] for c in first['cases']}, {kept.id, changed.id})
+
+        since = parse_watermark(first['watermark'])
+        MedicalCase.objects.filter(pk=kept.pk).update(updated_at=since - timedelta(seconds=10))
+        IndividualImplant.objects.create(case=changed, implant_variant=make_library())
+        second = self.sync(first['watermark'])
+        self.assertFalse(second['reset'])
+        self.assertEqual([c['id'] for c in second['cases']], [changed.id])
+
+    def test_overlap_catches_late_commits(self):
+        case = make_case()
+        since = timezone.now()
+        # Транзакция началась до водяного знака, а закоммичена после
+        MedicalCase.objects.filter(pk=case.pk).update(updated_at=since - timedelta(seconds=3))
+        changes = sync.changes_since(since)
+        self.assertEqual(list(changes['cases']), [case])
+        MedicalCase.objects.filter(pk=case.pk).update(updated_at=since - timedelta(seconds=6))
+        self.assertEqual(list(sync.changes_since(since)['cases']), [])
+
+    def test_tombstones(self):
+        case = make_case()
+        patient_id, case_id = case.patient_id, case.id
+        watermark = self.sync()['watermark']
+        Patient.objects.get(pk=patient_id).delete()
+        changes = self.sync(watermark)
+        self.assertEqual(changes['deleted'], {'patients': [patient_id], 'cases': [case_id]})
+        self.assertEqual((changes['patients'], changes['cases']), ([], []))
+
+    def test_purged_tombstones_force_reset(self):
+        make_case().delete()
+        DeletedRecord.objects.update(deleted_at=timezone.now() - timedelta(days=91))
+        self.assertEqual(sync.purge_tombstones(), 1)
+        changes = sync.changes_since(timezone.now() - timedelta(days=91))
+        self.assertTrue(changes['reset'])
+        self.assertEqual(changes['deleted'], {DeletedRecord.Kind.PATIENT: [], DeletedRecord.Kind.CASE: []})
+
+    def test_watermark_parsing(self):
+        self.assertEqual(parse_watermark('2024-01-02T03:04:05 03:00').utcoffset(), timedelta(hours=3))
+        self.assertEqual(parse_watermark('2024-01-02T03:04:05').utcoffset(), timedelta(0))
+        self.assertEqual(self.client.get('/api/sync/', {'since': 'вчера'}).status_code, 400)
+
+
+def receive_nothing():
+    # receive клиента, который не отключается
+    async def receive():
+        await asyncio.sleep(3600)
+    return receive
+
+
+def collect_events(scope, upload_id, receive=None):
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    async_to_sync(events.upload_events)(scope, receive or receive_nothing(), send, upload_id)
+    return messages
+
+
+def auth_scope(user, path='/api/uploads/x/events/', method='GET'):
+    token = str(AccessToken.for_user(user))
+    return {'type': 'http', 'path': path, 'method': method, 'headers': [(b'authorization', f'Bearer {token}'.encode())]}
+
+
+@override_settings(SSE_POLL_INTERVAL=0.01, SSE_WAIT_FOR_JOB=0)
+class ProcessingJobOwnershipTests(TempMediaMixin, TestCase):
+    upload_id = 'upload-0001'
+
+    def setUp(self):
+        super().setUp()
+        self.owner, self.other = make_user(), make_user('other@example.com')
+        self.case = make_case(self.owner)
+        self.job = progress.claim_job(self.upload_id, self.owner.pk, case=self.case, stage=ProcessingJob.Stage.DONE)
+        self.client = APIClient()
+
+    def test_claim_keeps_other_users_job(self):
+        with self.assertRaises(progress.UploadIdTaken):
+            progress.claim_job(self.upload_id, self.other.pk, stage=ProcessingJob.Stage.RECEIVING)
+        job = progress.claim_job(self.upload_id, self.owner.pk, stage=ProcessingJob.Stage.RECEIVING)
+        self.assertEqual((job.pk, job.stage), (self.job.pk, ProcessingJob.Stage.RECEIVING))
+
+    def test_status_only_for_owner(self):
+        self.client.force_authenticate(self.other)
+        self.assertEqual(self.client.get(f'/api/uploads/{self.upload_id}/').status_code, 404)
+        self.client.force_authenticate(self.owner)
+        response = self.client.get(f'/api/uploads/{self.upload_id}/')
+        self.assertEqual(response.json()['stage'], ProcessingJob.Stage.DONE)
+        self.assertNotIn('user', response.json())
+
+    def test_upload_with_other_users_id_rejected(self):
+        make_library()
+        self.client.force_authenticate(self.other)
+        archive = SimpleUploadedFile('a.zip', make_archive(SERIES_FILES).getvalue())
+        with mock.patch('main.views.submit_job') as submit:
+            response = self.client.post(f'/api/cases/{self.case.id}/upload-dicom/', {'file': archive},
+                                        HTTP_X_UPLOAD_ID=self.upload_id)
+        self.assertEqual(response.status_code, 409)
+        submit.assert_not_called()
+        self.job.refresh_from_db()
+        self.assertEqual((self.job.user, self.job.stage), (self.owner, ProcessingJob.Stage.DONE))
+
+    def test_upload_reuses_own_id(self):
+        make_library()
+        self.client.force_authenticate(self.owner)
+        archive = SimpleUploadedFile('a.zip', make_archive(SERIES_FILES).getvalue())
+        with mock.patch('main.views.submit_job') as submit:
+            response = self.client.post(f'/api/cases/{self.case.id}/upload-dicom/', {'file': archive},
+                                        HTTP_X_UPLOAD_ID=self.upload_id)
+        self.assertEqual(response.status_code, 202)
+        submit.assert_called_once()
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.bytes_total, archive.size)
+
+    def test_events_only_for_owner(self):
+        messages = collect_events(auth_scope(self.other), self.upload_id)
+        self.assertIn(b'event: failed', messages[1]['body'])
+        messages = collect_events(auth_scope(self.owner), self.upload_id)
+        self.assertIn(b'event: done', messages[1]['body'])
+        self.assertEqual(collect_events({'type': 'http', 'headers': []}, self.upload_id)[0]['status'], 401)
+
+    def test_receiving_does_not_touch_other_users_job(self):
+        async def receive():
+            return {'type': 'http.request', 'body': b'x' * 10, 'more_body': False}
+
+        tracked = events._tracking_receive(receive, self.upload_id, self.other.pk, self.case.id, 10)
+        async_to_sync(tracked)()
+        self.job.refresh_from_db()
+        self.assertEqual((self.job.stage, self.job.bytes_received), (ProcessingJob.Stage.DONE, 0))
+        tracked = events._tracking_receive(receive, self.upload_id, self.owner.pk, self.case.id, 10)
+        async_to_sync(tracked)()
+        self.job.refresh_from_db()
+        self.assertEqual((self.job.stage, self.job.bytes_received), (ProcessingJob.Stage.RECEIVING, 10))
+
+
+class JobAwareServerTests(SimpleTestCase):
+    def tick(self, server, pending=0):
+        with mock.patch('main.progress.pending_jobs', return_value=pending):
+            # Нечетный такт: без обновления заголовков Date
+            return async_to_sync(server.on_tick)(1)
+
+    def test_max_requests_waits_for_jobs(self):
+        config = UvicornConfig(app=None, limit_max_requests=None)
+        server = JobAwareServer(config, max_requests=3)
+        server.server_state.total_requests = 2
+        self.assertFalse(self.tick(server))
+        server.server_state.total_requests = 3
+        with self.assertLogs('uvicorn.error', 'INFO') as logs:
+            self.assertFalse(self.tick(server, pending=1))
+            self.assertFalse(self.tick(server, pending=1))
+            self.assertTrue(self.tick(server))
+        self.assertEqual(len(logs.records), 2)
+
+    def test_no_limit_and_shutdown(self):
+        server = JobAwareServer(UvicornConfig(app=None, limit_max_requests=None))
+        server.server_state.total_requests = 10 ** 6
+        self.assertFalse(self.tick(server))
+        server.should_exit = True
+        self.assertTrue(self.tick(server, pending=1))
+
+
+class GunicornSettingsTests(SimpleTestCase):
+    def test_role_profiles(self):
+        api = server.gunicorn_settings(cpus=4, environ={'SERVER_ROLE': 'api'})
+        self.assertEqual((api['wsgi_app'], api['worker_class']), (server.WSGI_APP, 'gthread'))
+        self.assertEqual((api['workers'], api['threads'], api['timeout'], api['max_requests']), (5, 4, 60, 5000))
+
+        upload = server.gunicorn_settings(cpus=4, environ={'SERVER_ROLE': 'upload'})
+        self.assertEqual((upload['wsgi_app'], upload['worker_class']), (server.ASGI_APP, server.UVICORN_WORKER))
+        self.assertEqual((upload['workers'], upload['threads'], upload['timeout']), (4, 1, 900))
+        self.assertEqual((upload['max_requests'], upload['max_requests_jitter']), (200, 50))
+
+        # Роль по умолчанию - all
+        everything = server.gunicorn_settings(cpus=4, environ={})
+        self.assertEqual((everything['wsgi_app'], everything['worker_class']), (server.ASGI_APP, server.UVICORN_WORKER))
+        self.assertEqual((everything['workers'], everything['max_requests']), (5, 1000))
+        self.assertTrue(everything['preload_app'])
+
+    def test_worker_count_bounds_and_overrides(self):
+        self.assertEqual(server.gunicorn_settings('upload', cpus=1, environ={})['workers'], server.MIN_WORKERS)
+        self.assertEqual(server.gunicorn_settings('api', cpus=64, environ={})['workers'], server.MAX_WORKERS)
+        settings = server.gunicorn_settings('api', cpus=4, environ={
+            'GUNICORN_WORKERS': '3', 'GUNICORN_THREADS': '8', 'GUNICORN_MAX_REQUESTS': '10',
+            'GUNICORN_BIND': 'unix:/run/app.sock', 'GUNICORN_PRELOAD': '0',
+        })
+        self.assertEqual((settings['workers'], settings['threads'], settings['max_requests']), (3, 8, 10))
+        self.assertEqual(settings['bind'], 'unix:/run/app.sock')
+        self.assertFalse(settings['preload_app'])
+
+    def test_unknown_role(self):
+        with self.assertRaises(ValueError):
+            server.gunicorn_settings(environ={'SERVER_ROLE': 'worker'})
+
+
+class FragmentCacheTests(TempMediaMixin, TestCase):
+    # Без select_related/prefetch: каждый построенный фрагмент читает пациента,
+    # расчет и вариант библиотеки (3 запроса), фрагмент из кэша - ни одного
+    queries_per_case = 3
+
+    def setUp(self):
+        super().setUp()
+        self.variant = make_library()
+        self.cases = [make_case() for _ in range(3)]
+        for case in self.cases:
+            IndividualImplant.objects.create(case=case, implant_variant=self.variant, is_calculated=True)
+        self.request = Request(APIRequestFactory().get('/api/cases/'))
+        self.render(rebuilt=3)
+
+    def render(self, rebuilt=0, queries=None):
+        cases = list(MedicalCase.objects.order_by('id'))
+        with self.assertNumQueries(rebuilt * self.queries_per_case if queries is None else queries):
+            return MedicalCaseSerializer(cases, many=True, context={'request': self.request}).data
+
+    def test_cached_list_makes_no_queries(self):
+        self.render()
+
+    def test_patient_change_rebuilds_its_cases(self):
+        patient = self.cases[0].patient
+        patient.surname = 'Новая'
+        patient.save()
+        data = self.render(rebuilt=1)
+        self.assertEqual(data[0]['patient_fio'], 'Новая Имя')
+        self.render()
+
+    def test_implant_change_rebuilds_its_case(self):
+        implant = self.cases[1].implant
+        implant.safety_factor = 2.5
+        implant.save()
+        self.assertEqual(self.render(rebuilt=1)[1]['implant_data']['safety_factor'], 2.5)
+        implant.delete()
+        # Без расчета implant_data не читает вариант библиотеки
+        self.assertIsNone(self.render(queries=2)[1]['implant_data'])
+
+    def test_dicom_changes_rebuild_case(self):
+        blob, _ = store_blob(make_archive(SERIES_FILES))
+        DICOMUpload.objects.create(case=self.cases[2], blob=blob, sha256=blob.sha256, size=blob.size)
+        self.render(rebuilt=1)
+        series = extract_series(blob)
+        MedicalCase.objects.filter(pk=self.cases[2].pk).update(dicom_series=series, updated_at=timezone.now())
+        # Прием с серией читает еще и ее
+        self.assertEqual(len(self.render(queries=4)[2]['dicom_files']), len(SERIES_FILES))
+        series.indexed_at = timezone.now()
+        series.save(update_fields=['indexed_at'])
+        # Порядок срезов теперь из индекса
+        self.render(queries=5)
+        self.render()
+        series.delete()
+        self.render(rebuilt=1)
+
+    def test_library_change_rebuilds_all(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.variant.name = 'Другой'
+            self.variant.save()
+        self.render(rebuilt=3)
+
+    def test_query_params_are_separate_variants(self):
+        self.request = Request(APIRequestFactory().get('/api/cases/', {'fields': 'id,patient_fio'}))
+        # Только ФИО: расчет не читается
+        self.assertEqual(set(self.render(queries=3)[0]), {'id', 'patient_fio'})
+        self.render()
+
+
+def make_dicom(pixels, z, instance, spacing=(1.0, 1.0, 1.0), series_uid='1.2.3.4', intercept=-1024):
+    # Срез CT без сжатия: int16 со смещением HU в RescaleIntercept
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = CTImageStorage
+    meta.MediaStorageSOPInstanceUID = f'{series_uid}.{instance}'
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = CTImageStorage
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID, ds.SeriesInstanceUID = '1.2.3', series_uid
+    ds.Modality = 'CT'
+    ds.InstanceNumber = instance
+    ds.ImagePositionPatient = [0.0, 0.0, z * spacing[0]]
+    ds.ImageOrientationPatient = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+    ds.PixelSpacing = [spacing[1], spacing[2]]
+    ds.SliceThickness = spacing[0]
+    ds.RescaleSlope, ds.RescaleIntercept = 1, intercept
+    ds.Rows, ds.Columns = pixels.shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 1
+    ds.PixelData = (np.asarray(pixels) - intercept).astype('<i2').tobytes()
+    buf = io.BytesIO()
+    ds.save_as(buf, enforce_file_format=True)
+    return buf.getvalue()
+
+
+def dicom_series_files(volume, spacing=(1.0, 1.0, 1.0)):
+    # Файлы названы в обратном порядке срезов: порядок задает только индекс
+    count = len(volume)
+    return {
+        f'series/IMG{count - z:04d}.dcm': make_dicom(volume[z], z, z + 1, spacing)
+        for z in range(count)
+    }
+
+
+class DicomIndexTests(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.volume = (np.arange(4 * 3 * 5, dtype=np.int16).reshape(4, 3, 5) * 10 - 200)
+        files = dict(dicom_series_files(self.volume, spacing=(2.5, 0.5, 0.5)), **{'series/notes.txt': b'x'})
+        blob, _ = store_blob(make_archive(files))
+        self.series = extract_series(blob)
+        self.series_dir = series_dir(self.series)
+
+    def test_index_orders_by_position(self):
+        rows = read_index(self.series_dir, self.series.codec)
+        self.assertEqual([row['relpath'] for row in rows], [f'series/IMG{i:04d}.dcm' for i in (4, 3, 2, 1)])
+        self.assertEqual([row['slice_position'] for row in rows], [0.0, 2.5, 5.0, 7.5])
+        self.assertEqual({row['pixel_dtype'] for row in rows}, {'<i2'})
+        self.assertEqual((rows[0]['rows'], rows[0]['columns'], rows[0]['rescale_intercept']), (3, 5, -1024))
+
+    def test_store_index_once(self):
+        rows = read_index(self.series_dir, self.series.codec)
+        self.assertEqual(store_index(self.series, rows), 4)
+        self.assertEqual(store_index(self.series, rows), 0)
+        self.assertEqual(store_index(self.series, rows[:2], force=True), 2)
+        self.assertEqual(self.series.instances.count(), 2)
+
+    def test_case_slices_follow_index(self):
+        case = make_case()
+        case.dicom_series = self.series
+        case.save()
+        self.assertEqual([name for name, _ in case_slices(case)][0], 'series/IMG0001.dcm')
+        index_series(self.series, self.series_dir)
+        case.refresh_from_db()
+        self.assertEqual([name for name, _ in case_slices(case)],
+                         ['series/IMG0004.dcm', 'series/IMG0003.dcm', 'series/IMG0002.dcm', 'series/IMG0001.dcm',
+                          'series/notes.txt'])
+
+        client = APIClient()
+        client.force_authenticate(case.user)
+        data = client.get(f'/api/cases/{case.id}/dicom-index/', {'instances': 1}).json()
+        summary, = data['series']
+        self.assertEqual((summary['count'], summary['slice_spacing'], summary['pixel_spacing']), (4, 2.5, [0.5, 0.5]))
+        self.assertEqual(len(data['instances']), 4)
+
+    def test_volume_built_from_index(self):
+        rows = read_index(self.series_dir, self.series.codec)
+        volume, spacing = load_volume(self.series.blob.sha256, self.series_dir, self.series.codec, rows)
+        np.testing.assert_array_equal(volume, self.volume)
+        self.assertEqual(spacing, (2.5, 0.5, 0.5))
+
+
+def arch_phantom(depth=20, height=64, width=80):
+    # Зубная дуга y = 10 + (x - 40)^2 / 40 толщиной 5 вокселей в срезах 4..15
+    z, y, x = np.mgrid[:depth, :height, :width]
+    volume = np.full((depth, height, width), -1000, dtype=np.int16)
+    volume[(np.abs(y - arch_y(x)) <= 2) & (z >= 4) & (z < 16) & (x >= 10) & (x <= 70)] = 2000
+    return volume
+
+
+def arch_y(x):
+    return 10 + (x - 40) ** 2 / 40.0
+
+
+def series_case(volume, spacing):
+    # Прием с проиндексированной серией из синтетического объема
+    blob, _ = store_blob(make_archive(dicom_series_files(volume, spacing)))
+    series = extract_series(blob)
+    index_series(series, series_dir(series))
+    case = make_case()
+    case.dicom_series = series
+    case.save()
+    return case
+
+
+class PanoramicTests(TempMediaMixin, TestCase):
+    spacing = (0.5, 0.25, 0.25)
+
+    def setUp(self):
+        super().setUp()
+        self.volume = arch_phantom()
+
+    def params(self, **changes):
+        params = dict(default_panoramic_params(), curve=None, sections=3, thickness=2.0)
+        params.update(changes)
+        return params
+
+    def test_detect_arch(self):
+        curve = detect_arch(self.volume, self.spacing)
+        self.assertEqual((curve[0, 0], curve[-1, 0]), (10, 70))
+        self.assertLess(np.abs(curve[:, 1] - arch_y(curve[:, 0])).max(), 0.5)
+
+    def test_output_shapes(self):
+        dest = tempfile.mkdtemp(dir=self.root)
+        meta = reconstruct(self.volume, self.spacing, self.params(), dest)
+        step = 0.25
+        with Image.open(os.path.join(dest, 'panoramic.png')) as image:
+            # Ширина - точки дуги через шаг пикселя, высота - срезы в том же масштабе
+            self.assertEqual(image.size, (int(round(meta['length'] / step)) + 1, 20 * 2))
+            pixels = np.asarray(image)
+        # Кость - в срезах 4..15, верх изображения - последний срез;
+        # на границе кости строки интерполируются
+        column = pixels[:, pixels.shape[1] // 2]
+        self.assertTrue((column[9:31] > 0).all())
+        self.assertFalse(column[:6].any() or column[34:].any())
+        self.assertEqual(len(meta['sections']), 3)
+        for section in meta['sections']:
+            with Image.open(os.path.join(dest, section['name'])) as image:
+                self.assertEqual(image.size, (int(30 / step) + 1, 40))
+
+    def test_explicit_curve(self):
+        meta = reconstruct(self.volume, self.spacing, self.params(curve=[[10, 30], [70, 30]], sections=0),
+                           tempfile.mkdtemp(dir=self.root))
+        self.assertFalse(meta['auto_curve'])
+        self.assertEqual((meta['length'], meta['sections']), (15.0, []))
+
+    def test_cached_by_params(self):
+        case = series_case(self.volume, self.spacing)
+        key, meta, cached = load_reconstruction(case.dicom_series, self.params())
+        self.assertFalse(cached)
+        with mock.patch('main.panoramic.reconstruct') as rebuild:
+            self.assertEqual(load_reconstruction(case.dicom_series, self.params()), (key, meta, True))
+        rebuild.assert_not_called()
+        other, _, cached = load_reconstruction(case.dicom_series, self.params(thickness=4.0))
+        self.assertNotEqual(other, key)
+        self.assertFalse(cached)
+        self.assertIsNotNone(reconstruction_file(case.dicom_series, key, 'section_02.png'))
+        self.assertIsNone(reconstruction_file(case.dicom_series, key, '../meta.json'))
+
+        client = APIClient()
+        client.force_authenticate(case.user)
+        data = client.get(f'/api/cases/{case.id}/panoramic/', {'sections': 3, 'thickness': 2}).json()
+        self.assertEqual((data['key'], data['cached']), (key, True))
+        response = client.get(data['sections'][0]['url'])
+        self.assertEqual(response['Content-Type'], 'image/png')
+        response.close()
+        self.assertEqual(client.get(f'/api/cases/{case.id}/panoramic/', {'thickness': 100}).status_code, 400)
+
+
+def sphere_phantom(size=48, radius=15):
+    # Шар радиусом radius вокселей с плавным краем: 0 HU - на поверхности
+    z, y, x = np.mgrid[:size, :size, :size] - (size - 1) / 2
+    return np.clip(1000 * (radius - np.sqrt(x ** 2 + y ** 2 + z ** 2)) / 2, -1000, 1000).astype(np.int16)
+
+
+def directed_edges(faces):
+    edges = faces[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2).astype(np.int64)
+    return edges[:, 0] * (faces.max() + 1) + edges[:, 1], edges[:, 1] * (faces.max() + 1) + edges[:, 0]
+
+
+class MeshTests(TempMediaMixin, TestCase):
+    spacing = (0.5, 0.5, 0.5)
+
+    def setUp(self):
+        super().setUp()
+        self.volume = sphere_phantom()
+
+    def assertClosed(self, faces):
+        # Каждое ребро обходится в обе стороны одинаковое число раз
+        forward, backward = directed_edges(faces)
+        self.assertEqual(sorted(forward.tolist()), sorted(backward.tolist()))
+
+    def assertOutward(self, vertices, faces):
+        triangles = vertices[faces]
+        volume = np.einsum('ij,ij->i', triangles[:, 0], np.cross(triangles[:, 1], triangles[:, 2])).sum() / 6
+        self.assertAlmostEqual(volume / (4 / 3 * np.pi * 7.5 ** 3), 1, delta=0.1)
+
+    def test_full_resolution(self):
+        vertices, faces = extract_surface(self.volume, self.spacing, 0, 1000000)
+        self.assertClosed(faces)
+        # Без прореживания каждое ребро ровно у двух треугольников
+        forward, _ = directed_edges(np.sort(faces, axis=1))
+        self.assertEqual(set(np.unique(forward, return_counts=True)[1]), {2})
+        self.assertOutward(vertices, faces)
+
+    def test_triangle_budget(self):
+        # Размер ячейки оценивается по прореженной сетке, поэтому число
+        # треугольников - около заданного, а не строго не больше
+        for triangles in (5000, 2000, 1000):
+            with self.subTest(triangles=triangles):
+                vertices, faces = extract_surface(self.volume, self.spacing, 0, triangles)
+                self.assertLessEqual(len(faces), triangles * 1.1)
+                self.assertClosed(faces)
+                self.assertOutward(vertices, faces)
+
+    def test_params(self):
+        self.assertEqual(mesh_params({'threshold': '300,5', 'triangles': '2000'}),
+                         {'threshold': 300.5, 'triangles': 2000})
+        for data in ({'threshold': 'abc'}, {'triangles': '10'}, {'triangles': '1.5'}):
+            with self.subTest(data=data), self.assertRaises(ValueError):
+                mesh_params(data)
+
+    def test_cached_by_params(self):
+        case = series_case(self.volume, self.spacing)
+        params = mesh_params({'threshold': '0', 'triangles': '5000'})
+        stl, cached = load_mesh(case.dicom_series, params, 'stl')
+        self.assertFalse(cached)
+        with open(stl, 'rb') as f:
+            f.seek(80)
+            count = int(np.frombuffer(f.read(4), '<u4')[0])
+        self.assertEqual(os.path.getsize(stl), 84 + 50 * count)
+        self.assertLessEqual(count, 5000)
+        # Все форматы пишутся сразу
+        with mock.patch('main.mesh.extract_surface') as rebuild:
+            ply, cached = load_mesh(case.dicom_series, params, 'ply')
+        rebuild.assert_not_called()
+        self.assertTrue(cached)
+        with open(ply, 'rb') as f:
+            self.assertIn(f"element face {count}\n".encode(), f.read(256))
+        other, cached = load_mesh(case.dicom_series, dict(params, triangles=2000), 'stl')
+        self.assertNotEqual(other, stl)
+        self.assertFalse(cached)
+
+        client = APIClient()
+        client.force_authenticate(case.user)
+        response = client.get(f'/api/cases/{case.id}/mesh/', {'threshold': 0, 'triangles': 5000})
+        self.assertEqual(response['Content-Type'], 'model/stl')
+        self.assertEqual(b''.join(response.streaming_content), open(stl, 'rb').read())
+        for query in ({'mesh_format': 'obj'}, {'triangles': 10}):
+            self.assertEqual(client.get(f'/api/cases/{case.id}/mesh/', query).status_code, 400)
+
+
+class AdmissionTests(SimpleTestCase):
+    upload = '/api/cases/1/upload-dicom/'
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        self.limits(concurrency=1, per_user=1, queue=0)
+        overrides = override_settings(ADMISSION_LOCK_DIR=root)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.root = root
+
+    def limits(self, **limits):
+        overrides = override_settings(ADMISSION_BUDGETS={'processing': dict(limits, retry_after=7, timeout=0.05)})
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def call(self, handler, path=upload, address='10.0.0.1'):
+        request = RequestFactory().post(path, REMOTE_ADDR=address)
+        return admission.AdmissionControlMiddleware(handler)(request)
+
+    def test_per_user_limit(self):
+        def handler(request):
+            # Второй запрос того же клиента, пока первый выполняется
+            self.assertEqual(len(request._admission_slots), 2)
+            nested = self.call(lambda r: HttpResponse())
+            self.assertEqual((nested.status_code, nested['Retry-After']), (429, '7'))
+            return HttpResponse()
+
+        self.assertEqual(self.call(handler).status_code, 200)
+        # Файлы мест пользователя удаляются при освобождении
+        self.assertEqual(sorted(os.listdir(self.root)), ['processing.0'])
+
+    def test_overloaded(self):
+        responses = []
+
+        def handler(request):
+            responses.append(self.call(lambda r: HttpResponse(), address='10.0.0.2'))
+            return HttpResponse()
+
+        # Очереди нет - отказ сразу, с очередью - по истечении timeout
+        self.call(handler)
+        self.limits(concurrency=1, per_user=1, queue=1)
+        self.call(handler)
+        self.assertEqual([(r.status_code, r['Retry-After']) for r in responses], [(503, '7')] * 2)
+
+    def test_queue_waits_for_slot(self):
+        self.limits(concurrency=1, per_user=1, queue=1)
+        slot = admission.acquire_slot(os.path.join(self.root, 'processing'), 1)
+        timer = mock.patch('main.admission.time.sleep', side_effect=lambda pause: admission.release_slot(slot))
+        with timer as sleep:
+            self.assertEqual(self.call(lambda r: HttpResponse()).status_code, 200)
+        sleep.assert_called_once_with(admission.POLL_MIN)
+
+    def test_light_requests_pass(self):
+        def handler(request):
+            self.assertFalse(hasattr(request, '_admission_slots'))
+            return HttpResponse()
+
+        self.call(lambda r: self.call(handler, path='/api/cases/1/'))
+
+    def test_detached_slots(self):
+        detached = []
+
+        def handler(request):
+            detached.extend(admission.detach_slots(Request(request)))
+            return HttpResponse()
+
+        self.call(handler)
+        # Места у фоновой задачи, пока она их не освободит
+        self.assertEqual(len(detached), 2)
+        self.assertEqual(self.call(lambda r: HttpResponse()).status_code, 429)
+        admission.release_slots(detached)
+        self.assertEqual(self.call(lambda r: HttpResponse()).status_code, 200)
+
+    def test_released_on_exception(self):
+        def handler(request):
+            raise RuntimeError
+
+        with self.assertRaises(RuntimeError):
+            self.call(handler)
+        self.assertEqual(self.call(lambda r: HttpResponse()).status_code, 200)
+
+    def test_user_key(self):
+        token = AccessToken()
+        token['user_id'] = 5
+        factory = RequestFactory()
+        self.assertEqual(admission.user_key(factory.get('/', HTTP_AUTHORIZATION=f'Bearer {token}')), 'user-5')
+        request = factory.get('/', HTTP_AUTHORIZATION='Bearer broken', REMOTE_ADDR='10.0.0.3')
+        self.assertEqual(admission.user_key(request), 'ip-10.0.0.3')
+
+
+class BundleTests(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+
+    def make_series(self, compression='none', offset=0):
+        # Разные offset - разные архивы: одинаковые хранятся одной серией
+        volume = np.arange(4 * 8 * 8, dtype=np.int16).reshape(4, 8, 8) + offset
+        with override_settings(DICOM_SLICE_COMPRESSION=compression):
+            case = series_case(volume, (1, 1, 1))
+        case = MedicalCase.objects.select_related('dicom_series').get(id=case.id)
+        self.client.force_authenticate(case.user)
+        self.url = f'/api/cases/{case.id}/bundle/'
+        series = case.dicom_series
+        self.slices = [(name, read_slice(series_dir(series), name, series.codec)) for name, _ in case_slices(case)]
+        return case
+
+    def get(self, query=None, **headers):
+        response = self.client.get(self.url, query or {}, **headers)
+        response.body = b''.join(response.streaming_content) if response.streaming else response.content
+        return response
+
+    def test_tar(self):
+        self.make_series()
+        response = self.get()
+        self.assertEqual((response.status_code, response['Content-Type']), (200, 'application/x-tar'))
+        self.assertEqual(int(response['Content-Length']), len(response.body))
+        with tarfile.open(fileobj=io.BytesIO(response.body)) as tar:
+            self.assertEqual([(m.name, tar.extractfile(m).read()) for m in tar], self.slices)
+        # Диапазон срезов в порядке просмотра
+        with tarfile.open(fileobj=io.BytesIO(self.get({'start': 1, 'stop': 3}).body)) as tar:
+            self.assertEqual(tar.getnames(), [name for name, _ in self.slices[1:3]])
+
+    def test_zip(self):
+        for offset, (codec, compression, method) in enumerate((
+            ('none', None, zipfile.ZIP_STORED), ('zlib', None, zipfile.ZIP_DEFLATED),
+            ('zlib', 'none', zipfile.ZIP_STORED), ('none', 'deflate', zipfile.ZIP_DEFLATED),
+        )):
+            with self.subTest(codec=codec, compression=compression):
+                self.make_series(codec, offset)
+                response = self.get({'bundle_format': 'zip', 'compression': compression or ''})
+                self.assertEqual(response.status_code, 200)
+                # Длина известна заранее, кроме deflate на лету
+                self.assertEqual(response.has_header('Content-Length'), compression != 'deflate')
+                with zipfile.ZipFile(io.BytesIO(response.body)) as archive:
+                    self.assertIsNone(archive.testzip())
+                    self.assertEqual({info.compress_type for info in archive.infolist()}, {method})
+                    self.assertEqual([(name, archive.read(name)) for name in archive.namelist()], self.slices)
+
+    def test_ranges(self):
+        self.make_series()
+        for query in ({}, {'bundle_format': 'zip'}):
+            with self.subTest(**query):
+                caches['default'].clear()
+                full = self.get(query)
+                etag, length = full['ETag'], len(full.body)
+                # Хвост zip до чтения срезов: CRC для каталога считаются отдельно
+                for header, (start, end) in (('bytes=-100', (length - 100, length)), ('bytes=100-199', (100, 200)),
+                                             (f'bytes={length - 10}-', (length - 10, length))):
+                    response = self.get(query, HTTP_RANGE=header)
+                    self.assertEqual(response.status_code, 206)
+                    self.assertEqual(response['Content-Range'], f'bytes {start}-{end - 1}/{length}')
+                    self.assertEqual(response.body, full.body[start:end])
+                response = self.get(query, HTTP_RANGE=f'bytes={length}-')
+                self.assertEqual((response.status_code, response['Content-Range']), (416, f'bytes */{length}'))
+                # If-Range со старым ETag - архив изменился, отдается целиком
+                self.assertEqual(self.get(query, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag).status_code, 206)
+                response = self.get(query, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"old"')
+                self.assertEqual((response.status_code, response.body), (200, full.body))
+                self.assertEqual(self.get(query, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_params(self):
+        self.make_series()
+        for query in ({'bundle_format': 'rar'}, {'compression': 'deflate'}, {'start': 2, 'stop': 1},
+                      {'start': 10}):
+            with self.subTest(**query):
+                self.assertEqual(self.get(query).status_code, 400)
+        self.assertEqual(self.get({'bundle_format': 'zip', 'compression': 'deflate'})['Accept-Ranges'], 'none')
+
+    def test_zip64(self):
+        # Раскладка без чтения срезов: три среза по 2 ГБ
+        big = Bundle(FORMAT_ZIP, 'none', self.root, 'none', [(f'{i}.dcm', 2 ** 31) for i in range(3)], 0)
+        self.assertGreater(big.length, ZIP64_LIMIT)
+        tail = big._directory([(m, 0, m.data_size) for m in big.members], big.length - big.parts[-1][0])
+        self.assertEqual(len(tail), big.parts[-1][0])
+        self.assertIn(struct.pack('<I', 0x06064b50), tail)
+        # Размеры членов zip 32-битные: такой архив отклоняется до отдачи
+        # (deflate на лету может оказаться больше исходного среза)
+        for compression, size in (('none', ZIP64_LIMIT), ('deflate', ZIP64_LIMIT - 1000)):
+            with self.subTest(compression=compression), self.assertRaises(ValueError):
+                Bundle(FORMAT_ZIP, compression, self.root, 'none', [('big.dcm', size)], 0)
+        Bundle(FORMAT_ZIP, 'none', self.root, 'none', [('big.dcm', ZIP64_LIMIT - 1000)], 0)
+        self.assertEqual(Bundle(FORMAT_TAR, 'none', self.root, 'none', [('big.dcm', 2 ** 33)], 0).length,
+                         2 ** 33 + 5 * tarfile.BLOCKSIZE)
+
+
+class AuditTests(TestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        overrides = override_settings(AUDIT_SPILL_DIR=root)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.root = root
+        # Буфер процесса без потока записи: сбрасывается в тесте вручную
+        for name, value in (('_pid', os.getpid()), ('_config', (True, 500, 0))):
+            patcher = mock.patch.object(audit, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(audit._take)
+        self.addCleanup(audit._recent.clear)
+
+    def test_dedup_is_opt_in(self):
+        self.assertEqual(audit.dedup_seconds(), 0)
+        for _ in range(3):
+            audit.record(audit.VIEW, user_id=1, case_id=2)
+        self.assertEqual(len(audit._take()), 3)
+
+        with mock.patch.object(audit, '_config', (True, 500, 60)):
+            for user_id, case_id, action in ((1, 2, audit.VIEW), (1, 2, audit.VIEW), (1, 3, audit.VIEW),
+                                             (4, 2, audit.VIEW), (1, 2, audit.UPDATE), (1, 2, audit.UPDATE)):
+                audit.record(action, user_id=user_id, case_id=case_id)
+        # Отбрасываются только повторные просмотры того же объекта тем же пользователем
+        self.assertEqual([(e[1], e[5], e[3]) for e in audit._take()], [
+            (1, 2, 'view'), (1, 3, 'view'), (4, 2, 'view'), (1, 2, 'update'), (1, 2, 'update'),
+        ])
+
+    def test_match_rule(self):
+        factory = RequestFactory()
+        self.assertEqual(audit.match_rule(factory.get('/api/cases/5/slices/1/')), ('view', 'case', 5))
+        self.assertEqual(audit.match_rule(factory.patch('/api/patients/update/7/')), ('update', 'patient', 7))
+        self.assertEqual(audit.match_rule(factory.post('/api/cases/create/')), ('create', 'case', None))
+        self.assertEqual(audit.match_rule(factory.get('/api/sync/')), ('list', None, None))
+        self.assertIsNone(audit.match_rule(factory.post('/api/cases/5/slices/1/')))
+        self.assertIsNone(audit.match_rule(factory.get('/api/implants/')))
+
+    def test_middleware_and_flush(self):
+        case = make_case()
+        client = APIClient()
+        client.force_authenticate(case.user)
+        self.assertEqual(client.get(f'/api/patients/{case.patient_id}/cases/').status_code, 200)
+        client.get(f'/api/cases/{case.id}/mesh/')
+        APIClient().get('/api/cases/')
+        # Пишется только на сбросе, одним запросом и с пациентом приема
+        self.assertFalse(AuditEvent.objects.exists())
+        with self.assertNumQueries(2):
+            self.assertEqual(audit.flush(), 2)
+        events = AuditEvent.objects.order_by('id').values_list('user_id', 'action', 'patient_id', 'case_id')
+        self.assertEqual(list(events), [
+            (case.user_id, 'view', case.patient_id, None), (case.user_id, 'view', case.patient_id, case.id),
+        ])
+
+    def test_spill_and_replay(self):
+        case = make_case()
+        audit.record(audit.VIEW, user_id=1, case_id=case.id)
+        with mock.patch.object(audit, '_write', side_effect=DatabaseError):
+            self.assertEqual(audit.flush(), 0)
+        audit.record(audit.UPDATE, user_id=1, patient_id=case.patient_id)
+        audit.shutdown()
+        self.assertEqual(len(os.listdir(self.root)), 2)
+        self.assertEqual(audit.replay_spilled(), 2)
+        self.assertEqual(os.listdir(self.root), [])
+        self.assertEqual(sorted(AuditEvent.objects.values_list('action', 'patient_id')),
+                         [('update', case.patient_id), ('view', case.patient_id)])
+
+
+class MigrateDicomStorageTests(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.case = make_case()
+        blob, _ = store_blob(make_archive(SERIES_FILES))
+        self.series = extract_series(blob)
+        self.case.dicom_series = self.series
+        self.case.save(update_fields=['dicom_series'])
+
+    def migrate(self, backend, *args):
+        with override_settings(DICOM_SERIES_STORAGE=backend):
+            call_command('migrate_dicom_storage', *args, stdout=io.StringIO())
+        self.series.refresh_from_db()
+        self.case.refresh_from_db()
+
+    def assert_case_readable(self):
+        directory = case_dicom_dir(self.case)
+        self.assertEqual([name for name, size in case_slices(self.case)], sorted(SERIES_FILES))
+        for name, data in SERIES_FILES.items():
+            self.assertEqual(read_slice(directory, name, self.series.codec), data)
+
+    def test_series_moved_to_objects_and_back(self):
+        local_dir = storage.series_location(self.series.path, storage.STORAGE_LOCAL)
+        self.assertTrue(os.path.isdir(local_dir))
+
+        self.migrate(storage.STORAGE_OBJECTS)
+        self.assertEqual(self.series.storage, storage.STORAGE_OBJECTS)
+        self.assertFalse(os.path.exists(local_dir))
+        self.assert_case_readable()
+
+        self.migrate(storage.STORAGE_LOCAL, '--keep-source')
+        self.assertEqual(self.series.storage, storage.STORAGE_LOCAL)
+        self.assertTrue(os.path.isdir(local_dir))
+        self.assertTrue(storage.get_storage(storage.STORAGE_OBJECTS).exists(self.series.path))
+        self.assert_case_readable()
+
+    def test_dry_run_changes_nothing(self):
+        self.migrate(storage.STORAGE_OBJECTS, '--dry-run')
+        self.assertEqual(self.series.storage, storage.STORAGE_LOCAL)
+        self.assertFalse(storage.get_storage(storage.STORAGE_OBJECTS).exists(self.series.path))
+
+    def test_legacy_upload_moved_to_blob(self):
+        archive = make_archive({'series/IMG0009.dcm': b'z' * 50}).getvalue()
+        upload = DICOMUpload.objects.create(case=self.case, file=SimpleUploadedFile('old.zip', archive))
+        old_path = upload.file.path
+
+        self.migrate(storage.STORAGE_LOCAL)
+        upload.refresh_from_db()
+        self.assertFalse(upload.file)
+        self.assertFalse(os.path.exists(old_path))
+        self.assertEqual(upload.size, len(archive))
+        with upload.blob.file.open('rb') as f:
+            self.assertEqual(f.read(), archive)
+        self.assertEqual(DicomSeries.objects.count(), 1)
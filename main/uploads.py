@@ -0,0 +1,21 @@
+# uploads.py
+import hashlib
+
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+
+
+class HashingFileUploadHandler(TemporaryFileUploadHandler):
+    # Пишет загрузку во временный файл и считает SHA-256 по мере поступления
+    # чанков, чтобы не перечитывать многогигабайтный архив после загрузки
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.hasher = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.hasher.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file_obj = super().file_complete(file_size)
+        file_obj.sha256 = self.hasher.hexdigest()
+        return file_obj
@@ -1,9 +1,9 @@
 # views.py
 import os
-import random
-import time
 import zipfile
+from datetime import datetime
 
+from django.http import FileResponse, Http404, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework import viewsets, generics, permissions, response, decorators, status
 from rest_framework.generics import ListAPIView, CreateAPIView, UpdateAPIView
@@ -19,13 +19,34 @@ from rest_framework import exceptions as rest_exceptions
 from django.contrib.auth import get_user_model
 
 from .models import (
-    WorkerProfile, Patient, MedicalCase, ImplantLibrary, IndividualImplant, DICOMUpload
+    WorkerProfile, Patient, MedicalCase, ImplantLibrary, IndividualImplant, DICOMUpload, DeletedRecord,
+    ProcessingJob
 )
-
+from .uploads import HashingFileUploadHandler
+
+from .audit import UPLOAD, record_request
+from .admission import detach_slots
+from .bundle import bundle_params, bundle_response, case_bundle
+from .calculation import analysis_params, invalidate_stale
+from .dicom_index import series_index, series_summary
+from .dicom_storage import case_dicom_dir, case_codec
+from .extraction import UnsafeArchive
+from .images import build_image_variants
+from .memprofile import collect_profiles, memory_profiled, memory_section, summarize
+from .mesh import CONTENT_TYPES, load_mesh, mesh_params
+from .panoramic import load_reconstruction, panoramic_params, reconstruction_file
+from .processing import prepare_case_archive, process_batch, process_case_archive
+from .progress import (
+    UPLOAD_ID_HEADER, UploadIdTaken, claim_job, job_owned_by_other, start_job, submit_job, valid_upload_id
+)
+from .stats import dashboard
+from .sync import changes_since, parse_watermark
+from .slices import CODEC_ZLIB, CHUNK_SIZE, read_manifest, open_slice, open_stored
 from .permissions import IsSuperAdmin, IsAdminOrSuperAdmin
 from .seriailizers import AccountSerializer, WorkerRegistrationSerializer, AdminRegistrationSerializer, \
     SuperAdminRegistrationSerializer, WorkerProfileSerializer, UserProfileSerializer, PatientSerializer, \
-    MedicalCaseSerializer, ImplantSerializer, ImplantLibrarySerializer, CaseDetailSerializer
+    MedicalCaseSerializer, ImplantSerializer, ImplantLibrarySerializer, CaseDetailSerializer, \
+    ProcessingJobSerializer
 
 Account = get_user_model()
 
@@ -244,12 +265,25 @@ class PatientUpdateAPIView(UpdateAPIView):
 
 # Приемы
 class MedicalCaseListAPIView(generics.ListAPIView):
-    queryset = MedicalCase.objects.select_related('patient', 'user').prefetch_related(
+    queryset = MedicalCase.objects.select_related('patient', 'user', 'dicom_series').prefetch_related(
         'implant__implant_variant').all().order_by('-created_at')
 
     serializer_class = MedicalCaseSerializer
     permission_classes = [permissions.IsAuthenticated]
 
+    @memory_profiled('cases.list')
+    def list(self, request, *args, **kwargs):
+        # То же, что ListModelMixin.list, с отдельным замером памяти запроса и сериализации
+        with memory_section('query'):
+            queryset = self.filter_queryset(self.get_queryset())
+            page = self.paginate_queryset(queryset)
+            cases = [*(queryset if page is None else page)]
+        with memory_section('serialize'):
+            data = self.get_serializer(cases, many=True).data
+        if page is not None:
+            return self.get_paginated_response(data)
+        return Response(data)
+
 class MedicalCaseCreateAPIView(CreateAPIView):
     serializer_class = MedicalCaseSerializer
 
@@ -261,7 +295,7 @@ class MedicalCaseUpdateAPIView(UpdateAPIView):
 class PatientHistoryAPIView(ListAPIView):
     serializer_class = MedicalCaseSerializer
     def get_queryset(self):
-        return MedicalCase.objects.filter(patient_id=self.kwargs['patient_id'])
+        return MedicalCase.objects.select_related('dicom_series').filter(patient_id=self.kwargs['patient_id'])
 
 class ImplantDetailsAPIView(APIView):
 
@@ -293,44 +327,334 @@ class LibraryListAPIView(ListAPIView):
 class DicomUploadAndProcessView(APIView):
     parser_classes = (MultiPartParser, FormParser)
 
+    def dispatch(self, request, *args, **kwargs):
+        # Хеш архива считается прямо во время загрузки
+        request.upload_handlers = [HashingFileUploadHandler(request)]
+        return super().dispatch(request, *args, **kwargs)
+
+    @memory_profiled('cases.upload')
     def post(self, request, case_id):
+        # С заголовком X-Upload-Id архив обрабатывается в фоне: ответ 202 сразу
+        # после загрузки, ход обработки - в /api/uploads/<id>/events/
+        upload_id = request.META.get(UPLOAD_ID_HEADER)
+        if upload_id is not None and not valid_upload_id(upload_id):
+            return Response({"error": "X-Upload-Id: 8-64 символа из букв, цифр, - и _"}, status=400)
+        if upload_id and job_owned_by_other(upload_id, request.user.pk):
+            return Response({"error": "X-Upload-Id уже используется"}, status=409)
+
         file_obj = request.FILES.get('file')
         if not file_obj:
-            return Response({"error": "Файл не получен"}, status=400)
+            return self._failed(request, upload_id, Response({"error": "Файл не получен"}, status=400))
 
         variants = ImplantLibrary.objects.all()
         if not variants.exists():
-            return Response({"error": "Библиотека пуста"}, status=500)
+            return self._failed(request, upload_id, Response({"error": "Библиотека пуста"}, status=500))
 
         try:
             case = MedicalCase.objects.get(id=case_id)
         except MedicalCase.DoesNotExist:
-            return Response({"error": "Прием не найден"}, status=404)
+            return self._failed(request, upload_id, Response({"error": "Прием не найден"}, status=404))
 
-        folder_name = f"case_{case_id}"
-        extract_path = os.path.join(settings.MEDIA_ROOT, 'dicoms', folder_name)
-        os.makedirs(extract_path, exist_ok=True)
+        try:
+            params = analysis_params(request.data)
+            if upload_id:
+                prepared = prepare_case_archive(file_obj, params)
+                start_job(upload_id, request.user, case, file_obj.size)
+                submit_job(upload_id, case, prepared, slots=detach_slots(request))
+                return Response({
+                    "upload_id": upload_id,
+                    "stage": ProcessingJob.Stage.QUEUED,
+                    "status": f"/api/uploads/{upload_id}/",
+                    "events": f"/api/uploads/{upload_id}/events/",
+                }, status=202)
+            process_case_archive(case, file_obj, params)
+        except UploadIdTaken:
+            # Id занял другой пользователь, пока шла загрузка
+            return Response({"error": "X-Upload-Id уже используется"}, status=409)
+        except ValueError as e:
+            return self._failed(request, upload_id, Response({"error": str(e)}, status=400))
+        except zipfile.BadZipFile:
+            return self._failed(request, upload_id, Response({"error": "Файл не является ZIP-архивом"}, status=400))
+        except UnsafeArchive as e:
+            return self._failed(request, upload_id, Response({"error": str(e)}, status=400))
 
-        with zipfile.ZipFile(file_obj, 'r') as zip_ref:
-            zip_ref.extractall(extract_path)
+        case.refresh_from_db()
 
-        time.sleep(2.0)
+        serializer = CaseDetailSerializer(case, context={'request': request})
 
-        chosen_variant = random.choice(variants)
+        return Response(serializer.data)
 
-        IndividualImplant.objects.update_or_create(
-            case=case,
-            defaults={"implant_variant": chosen_variant, "is_calculated": True}
-        )
+    @staticmethod
+    def _failed(request, upload_id, error_response):
+        # Подписчики потока событий тоже должны узнать об ошибке
+        if upload_id:
+            try:
+                claim_job(upload_id, request.user.pk, stage=ProcessingJob.Stage.FAILED,
+                          error=error_response.data["error"])
+            except UploadIdTaken:
+                pass
+        return error_response
 
 
-        case.refresh_from_db()
+class DicomBatchUploadView(APIView):
+    # Пакетная загрузка: поле case_<id> на каждый архив, обработка на пуле процессов
+    parser_classes = (MultiPartParser, FormParser)
+    permission_classes = [IsAdminOrSuperAdmin]
 
-        serializer = CaseDetailSerializer(case, context={'request': request})
+    def dispatch(self, request, *args, **kwargs):
+        request.upload_handlers = [HashingFileUploadHandler(request)]
+        return super().dispatch(request, *args, **kwargs)
 
-        return Response(serializer.data)
+    def post(self, request):
+        items = []
+        for field, file_obj in request.FILES.items():
+            prefix, _, case_id = field.partition('_')
+            if prefix != 'case' or not case_id.isdigit():
+                return Response({"error": f"Неверное имя поля: {field}"}, status=400)
+            items.append((int(case_id), file_obj))
+        if not items:
+            return Response({"error": "Файлы не получены"}, status=400)
+        if not ImplantLibrary.objects.exists():
+            return Response({"error": "Библиотека пуста"}, status=500)
+
+        try:
+            params = analysis_params(request.data)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=400)
+        results = process_batch(items, params)
+        for case_id, _ in items:
+            record_request(request, UPLOAD, case_id=case_id, status_code=200)
+        return Response({"results": results})
 
 
 class LibraryCreateAPIView(CreateAPIView):
     queryset = ImplantLibrary.objects.all()
-    serializer_class = ImplantLibrarySerializer
\ No newline at end of file
+    serializer_class = ImplantLibrarySerializer
+
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        build_image_variants(serializer.instance)
+        # Библиотека изменилась - старые результаты расчетов больше не нужны
+        invalidate_stale()
+
+class DicomSliceView(APIView):
+    # Отдача среза из сжатой серии с распаковкой на лету
+
+    def get(self, request, case_id, relpath):
+        case = MedicalCase.objects.select_related('dicom_series').filter(id=case_id).first()
+        if case is None:
+            raise Http404
+        series_dir = case_dicom_dir(case)
+        manifest = read_manifest(series_dir)
+        # Отдаем только файлы из манифеста, это же защищает от выхода из папки
+        if manifest is None or relpath not in manifest["files"]:
+            raise Http404
+        size, stored = manifest["files"][relpath]
+        codec = case_codec(case)
+
+        # zlib-поток совпадает с HTTP "deflate", его можно отдать без распаковки
+        accept = request.META.get('HTTP_ACCEPT_ENCODING', '')
+        if codec == CODEC_ZLIB and 'deflate' in accept:
+            res = FileResponse(
+                open_stored(series_dir, relpath, codec),
+                content_type='application/dicom',
+                filename=os.path.basename(relpath)
+            )
+            res['Content-Encoding'] = 'deflate'
+            res['Content-Length'] = stored
+        else:
+            f = open_slice(series_dir, relpath, codec)
+            res = StreamingHttpResponse(_iter_file(f), content_type='application/dicom')
+            res['Content-Length'] = size
+        res['Vary'] = 'Accept-Encoding'
+        return res
+
+
+class DicomBundleView(APIView):
+    """
+    Серия приема одним архивом: ?bundle_format=tar|zip, compression=none|deflate
+    (только zip; по умолчанию deflate, если срезы хранятся сжатыми zlib),
+    start и stop - диапазон срезов в порядке просмотра. Range и If-Range -
+    для докачки (кроме zip с deflate на лету).
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, case_id):
+        case = MedicalCase.objects.select_related('dicom_series').filter(id=case_id).first()
+        if case is None:
+            raise Http404
+        try:
+            params = bundle_params(request.query_params)
+            bundle = case_bundle(case, **params)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=400)
+        return bundle_response(request, bundle, f"case_{case.id}.{params['fmt']}")
+
+
+def _iter_file(f):
+    with f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            yield chunk
+
+
+class DicomIndexAPIView(APIView):
+    """
+    Метаданные серии приема из индекса заголовков: сводка по сериям,
+    с ?instances=1 - и строки по каждому снимку в порядке просмотра.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, case_id):
+        case = MedicalCase.objects.select_related('dicom_series').filter(id=case_id).first()
+        if case is None:
+            raise Http404
+        series = case.dicom_series
+        if series is None or series.indexed_at is None:
+            return Response({"error": "Серия приема еще не проиндексирована"}, status=404)
+        rows = series_index(series)
+        data = {"indexed_at": series.indexed_at, "series": series_summary(rows)}
+        if request.query_params.get('instances') in ('1', 'true'):
+            data["instances"] = rows
+        return Response(data)
+
+
+class PanoramicAPIView(APIView):
+    """
+    Панорама и поперечные срезы серии приема. Параметры: curve=x,y;x,y;...
+    (вокселы аксиального среза, без нее дуга ищется автоматически), thickness,
+    sections, section_width (мм), window=центр,ширина (HU).
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, case_id):
+        case = MedicalCase.objects.select_related('dicom_series__blob').filter(id=case_id).first()
+        if case is None:
+            raise Http404
+        if case.dicom_series is None:
+            return Response({"error": "У приема нет серии DICOM"}, status=404)
+        try:
+            params = panoramic_params(request.query_params)
+            key, meta, cached = load_reconstruction(case.dicom_series, params)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=400)
+        base = request.build_absolute_uri(f"/api/cases/{case.id}/panoramic/{key}/")
+        return Response(dict(
+            meta,
+            key=key,
+            cached=cached,
+            panoramic=base + meta["panoramic"],
+            sections=[dict(section, url=base + section["name"]) for section in meta["sections"]],
+        ))
+
+
+class PanoramicImageView(APIView):
+    # Изображения реконструкции; ключ - хеш параметров, поэтому кэшируются бессрочно
+
+    def get(self, request, case_id, key, name):
+        case = MedicalCase.objects.select_related('dicom_series__blob').filter(id=case_id).first()
+        if case is None or case.dicom_series is None:
+            raise Http404
+        path = reconstruction_file(case.dicom_series, key, name)
+        if path is None:
+            raise Http404
+        res = FileResponse(open(path, 'rb'), content_type='image/png')
+        res['Cache-Control'] = 'private, max-age=31536000, immutable'
+        return res
+
+
+class BoneMeshView(APIView):
+    """
+    Поверхность кости приема для скачивания: ?mesh_format=stl|ply, порог HU
+    threshold и целевое число треугольников triangles. Сетка строится при
+    первом запросе и кэшируется до смены серии DICOM.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, case_id):
+        case = MedicalCase.objects.select_related('dicom_series__blob').filter(id=case_id).first()
+        if case is None:
+            raise Http404
+        if case.dicom_series is None:
+            return Response({"error": "У приема нет серии DICOM"}, status=404)
+        fmt = request.query_params.get('mesh_format', 'stl')
+        try:
+            path, _ = load_mesh(case.dicom_series, mesh_params(request.query_params), fmt)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=400)
+        return FileResponse(
+            open(path, 'rb'), as_attachment=True, filename=f"case_{case.id}_bone.{fmt}",
+            content_type=CONTENT_TYPES[fmt],
+        )
+
+
+class DashboardStatsView(APIView):
+    # Статистика для панели администратора из готовых счетчиков (main/stats.py)
+    permission_classes = [IsAdminOrSuperAdmin]
+
+    def get(self, request):
+        since = None
+        if request.query_params.get('since'):
+            try:
+                since = datetime.strptime(request.query_params['since'], '%Y-%m').date()
+            except ValueError:
+                return Response({"error": "since: ожидается месяц в формате ГГГГ-ММ"}, status=400)
+        try:
+            top = max(int(request.query_params.get('top', 10)), 0)
+        except ValueError:
+            return Response({"error": "top: ожидается целое число"}, status=400)
+        return Response(dashboard(since=since, top=top))
+
+
+class MemoryProfilesView(APIView):
+    # Профили памяти горячих путей со всех воркеров узла (main/memprofile.py)
+    permission_classes = [IsAdminOrSuperAdmin]
+
+    def get(self, request):
+        try:
+            limit = max(int(request.query_params.get('limit', 100)), 0)
+        except ValueError:
+            return Response({"error": "limit: ожидается целое число"}, status=400)
+        profiles = collect_profiles(request.query_params.get('name') or None)
+        return Response({
+            "enabled": settings.MEMPROFILE_ENABLED,
+            "sample_rate": settings.MEMPROFILE_SAMPLE_RATE,
+            "summary": summarize(profiles),
+            "profiles": profiles[:limit],
+        })
+
+
+class SyncAPIView(APIView):
+    """
+    Изменения пациентов и приемов с момента ?since=<watermark> из прошлого ответа.
+    Без since (или при reset=true в ответе) - полная выгрузка.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        try:
+            since = parse_watermark(request.query_params.get('since'))
+        except ValueError:
+            return Response({"error": "since: ожидается watermark из предыдущего ответа"}, status=400)
+        changes = changes_since(since)
+        context = {'request': request}
+        return Response({
+            "watermark": changes["watermark"].isoformat(),
+            "reset": changes["reset"],
+            "patients": PatientSerializer(changes["patients"], many=True, context=context).data,
+            "cases": MedicalCaseSerializer(changes["cases"], many=True, context=context).data,
+            "deleted": {
+                "patients": changes["deleted"][DeletedRecord.Kind.PATIENT],
+                "cases": changes["deleted"][DeletedRecord.Kind.CASE],
+            },
+        })
+
+
+class ProcessingJobAPIView(generics.RetrieveAPIView):
+    # Текущее состояние фоновой обработки (для клиентов без EventSource).
+    # Чужие задачи не видны: для них 404
+    serializer_class = ProcessingJobSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    lookup_field = 'upload_id'
+
+    def get_queryset(self):
+        return ProcessingJob.objects.filter(user=self.request.user)
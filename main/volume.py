@@ -0,0 +1,99 @@
+# volume.py
+# Сборка объема HU из срезов серии и его кэширование на диске.
+# Объем хранится как .npy (int16, порядок осей z, y, x) и открывается через
+# memmap, поэтому повторные анализы не перечитывают сотни файлов DICOM и
+# не держат весь объем в памяти процесса. Порядок срезов, шаг и параметры
+# пересчета в HU берутся из индекса заголовков (main/dicom_index.py).
+import io
+import json
+import os
+import uuid
+from collections import Counter
+
+import numpy as np
+import pydicom
+from django.conf import settings
+
+from .dicom_index import read_index, sort_key
+from .slices import read_slice
+
+HU_MIN, HU_MAX = -1024, 3071
+
+
+def cache_root():
+    return os.path.join(settings.DICOM_CACHE_ROOT, 'volumes')
+
+
+def _volume_paths(sha256):
+    base = os.path.join(cache_root(), sha256[:2], sha256)
+    return base + '.npy', base + '.json'
+
+
+def _volume_slices(index):
+    # Срезы основной матрицы (самая частая пара серия/размер), локализаторы и превью отбрасываем
+    slices = [row for row in index if row["pixel_offset"] is not None and row["rows"] and row["columns"]]
+    if not slices:
+        raise ValueError("Серия не содержит срезов DICOM с изображением")
+    main = Counter((row["series_uid"], row["rows"], row["columns"]) for row in slices).most_common(1)[0][0]
+    return sorted(
+        (row for row in slices if (row["series_uid"], row["rows"], row["columns"]) == main), key=sort_key
+    )
+
+
+def _pixels(series_dir, codec, row):
+    data = read_slice(series_dir, row["relpath"], codec)
+    if row["pixel_dtype"]:
+        # Несжатые пиксели - прямо по смещению из индекса
+        count = row["rows"] * row["columns"]
+        pixels = np.frombuffer(data, dtype=row["pixel_dtype"], count=count, offset=row["pixel_offset"])
+        return pixels.reshape(row["rows"], row["columns"])
+    return pydicom.dcmread(io.BytesIO(data)).pixel_array
+
+
+def build_volume(series_dir, codec, npy_path, index=None):
+    """
+    Упорядочивает срезы по индексу заголовков (main/dicom_index.py) и пишет
+    объем HU в npy_path. Без готового индекса заголовки читаются с диска.
+    Возвращает метаданные: форма, шаг вокселя (dz, dy, dx) в мм.
+    """
+    if index is None:
+        index = read_index(series_dir, codec)
+    slices = _volume_slices(index)
+    shape = (slices[0]["rows"], slices[0]["columns"])
+
+    dy, dx = slices[0]["pixel_spacing"] or (1.0, 1.0)
+    positions = [sort_key(row)[1] for row in slices]
+    steps = np.diff(positions)
+    if len(steps) and np.median(np.abs(steps)) > 0:
+        dz = float(np.median(np.abs(steps)))
+    else:
+        dz = float(slices[0]["slice_thickness"] or 1.0)
+
+    os.makedirs(os.path.dirname(npy_path), exist_ok=True)
+    tmp_path = f"{npy_path}.{uuid.uuid4().hex}.tmp"
+    volume = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.int16, shape=(len(slices),) + shape)
+    for z, row in enumerate(slices):
+        hu = _pixels(series_dir, codec, row).astype(np.float32) * row["rescale_slope"] + row["rescale_intercept"]
+        volume[z] = np.clip(hu, HU_MIN, HU_MAX)
+    volume.flush()
+    del volume
+    os.replace(tmp_path, npy_path)
+    return {"shape": [len(slices), shape[0], shape[1]], "spacing": [dz, float(dy), float(dx)]}
+
+
+def load_volume(sha256, series_dir, codec, index=None):
+    """
+    Возвращает (объем int16 через memmap, шаг вокселя (dz, dy, dx) в мм),
+    собирая и кэшируя объем при первом обращении (index - строки индекса
+    заголовков серии, если уже известны).
+    """
+    npy_path, meta_path = _volume_paths(sha256)
+    if not (os.path.exists(npy_path) and os.path.exists(meta_path)):
+        meta = build_volume(series_dir, codec, npy_path, index)
+        tmp_meta = f"{meta_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_meta, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_meta, meta_path)
+    with open(meta_path) as f:
+        meta = json.load(f)
+    return np.load(npy_path, mmap_mode='r'), tuple(meta["spacing"])
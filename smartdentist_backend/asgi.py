@@ -13,4 +13,9 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'smartdentist_backend.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Поток событий о ходе обработки загрузок DICOM (импорт после настройки Django)
+from main.events import with_upload_events  # noqa: E402
+
+application = with_upload_events(django_application)
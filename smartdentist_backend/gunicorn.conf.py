@@ -0,0 +1,78 @@
+# gunicorn.conf.py
+# Запуск: gunicorn -c smartdentist_backend/gunicorn.conf.py
+# Роль процесса, число воркеров и потоков - см. smartdentist_backend/server.py.
+# В лог пишутся время импорта приложения и время до готовности сервера.
+# При старте брошенные фоновые задачи обработки помечаются ошибкой, а воркер
+# с незавершенными задачами (main/progress.py) не перезапускается по
+# max_requests, пока они не закончатся (для uvicorn - см. workers.py).
+import os
+import time
+
+_started = time.monotonic()
+
+from smartdentist_backend.server import gunicorn_settings, warm_up  # noqa: E402
+
+globals().update(gunicorn_settings())
+
+_forked_at = None
+
+
+def on_starting(server):
+    # С preload_app приложение уже импортировано мастером
+    if server.cfg.preload_app:
+        urls = warm_up()
+        server.log.info(
+            "Приложение импортировано за %.2f с (URLconf %.2f с)", time.monotonic() - _started, urls
+        )
+
+
+def when_ready(server):
+    server.log.info(
+        "Сервер готов за %.2f с: %s, воркеров %s, потоков %s",
+        time.monotonic() - _started, server.cfg.worker_class_str, server.cfg.workers, server.cfg.threads,
+    )
+    _fail_stale_jobs(server)
+
+
+def _fail_stale_jobs(server):
+    # Задачи процессов прошлого запуска, которые уже никто не обработает
+    import django
+    from django.apps import apps
+    from django.db import connections
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'smartdentist_backend.settings')
+    try:
+        if not apps.ready:
+            django.setup()
+        from main.progress import mark_stale_jobs
+        count = mark_stale_jobs()
+    except Exception:
+        server.log.exception("Не удалось проверить брошенные задачи обработки")
+        return
+    finally:
+        connections.close_all()
+    if count:
+        server.log.warning("Брошенных задач обработки: %s, помечены ошибкой", count)
+
+
+def post_fork(server, worker):
+    global _forked_at
+    _forked_at = time.monotonic()
+    if server.cfg.preload_app:
+        # Соединения с базой, открытые мастером, не должны делиться воркерами
+        from django.db import connections
+        connections.close_all()
+
+
+def post_worker_init(worker):
+    if not worker.cfg.preload_app:
+        worker.log.info(
+            "Воркер %s импортировал приложение за %.2f с", worker.pid, time.monotonic() - _forked_at
+        )
+
+
+def pre_request(worker, req):
+    # sync и gthread считают запрос и решают о перезапуске сразу после этого хука
+    if worker.nr + 1 >= worker.max_requests:
+        from main.progress import pending_jobs
+        if pending_jobs():
+            worker.nr = max(worker.max_requests - 2, 0)
@@ -0,0 +1,134 @@
+# server.py
+# Профили запуска gunicorn по роли процесса (переменная SERVER_ROLE), см.
+# gunicorn.conf.py в этой же папке:
+#   api    - WSGI и gthread: короткие запросы, потоки воркера ждут базу;
+#   upload - ASGI и uvicorn: загрузки архивов до 2 ГБ, поток событий SSE
+#            (main/events.py), обработка снимков; воркеры перезапускаются
+#            чаще, потому что после обработки остаются большие массивы;
+#   all    - один сервис на все запросы (ASGI и uvicorn).
+# Число воркеров и потоков считается от доступных процессу CPU с учетом
+# квоты контейнера; GUNICORN_WORKERS и GUNICORN_THREADS задают их явно.
+# Модуль не импортирует Django, его использует и bench_server.
+import os
+import time
+
+ROLE_API = 'api'
+ROLE_UPLOAD = 'upload'
+ROLE_ALL = 'all'
+
+WSGI_APP = 'smartdentist_backend.wsgi:application'
+ASGI_APP = 'smartdentist_backend.asgi:application'
+UVICORN_WORKER = 'smartdentist_backend.workers.UvicornWorker'
+
+PROFILES = {
+    ROLE_API: {
+        "wsgi_app": WSGI_APP,
+        "worker_class": 'gthread',
+        "threads_per_worker": 4,
+        "workers_per_cpu": 1,
+        "extra_workers": 1,
+        "timeout": 60,
+        "graceful_timeout": 30,
+        "keepalive": 5,
+        "max_requests": 5000,
+        "max_requests_jitter": 500,
+    },
+    ROLE_UPLOAD: {
+        "wsgi_app": ASGI_APP,
+        "worker_class": UVICORN_WORKER,
+        "threads_per_worker": 1,
+        "workers_per_cpu": 1,
+        "extra_workers": 0,
+        # Загрузка 2 ГБ на медленном канале и обработка серии
+        "timeout": 900,
+        "graceful_timeout": 300,
+        "keepalive": 5,
+        "max_requests": 200,
+        "max_requests_jitter": 50,
+    },
+    ROLE_ALL: {
+        "wsgi_app": ASGI_APP,
+        "worker_class": UVICORN_WORKER,
+        "threads_per_worker": 1,
+        "workers_per_cpu": 1,
+        "extra_workers": 1,
+        "timeout": 900,
+        "graceful_timeout": 300,
+        "keepalive": 5,
+        "max_requests": 1000,
+        "max_requests_jitter": 100,
+    },
+}
+MIN_WORKERS = 2
+MAX_WORKERS = 16
+
+
+def available_cpus():
+    """
+    CPU, доступные процессу: привязка к ядрам и квота cgroup v2
+    (docker --cpus), а не число ядер узла.
+    """
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        count = os.cpu_count() or 1
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            count = min(count, max(1, int(int(quota) / int(period) + 0.5)))
+    except (OSError, ValueError):
+        pass
+    return count
+
+
+def _env_int(name, environ):
+    value = environ.get(name, '')
+    return int(value) if value.strip() else None
+
+
+def gunicorn_settings(role=None, cpus=None, environ=None):
+    """
+    Настройки gunicorn для роли: приложение, класс воркеров, их число и
+    потоки, таймауты и перезапуск воркеров по числу запросов.
+    """
+    environ = os.environ if environ is None else environ
+    role = role or environ.get('SERVER_ROLE', ROLE_ALL) or ROLE_ALL
+    if role not in PROFILES:
+        raise ValueError(f"Неизвестная роль сервера: {role}")
+    profile = PROFILES[role]
+    cpus = cpus or available_cpus()
+    workers = _env_int('GUNICORN_WORKERS', environ) or min(
+        MAX_WORKERS, max(MIN_WORKERS, cpus * profile["workers_per_cpu"] + profile["extra_workers"])
+    )
+    threads = _env_int('GUNICORN_THREADS', environ) or profile["threads_per_worker"]
+    result = {
+        "wsgi_app": profile["wsgi_app"],
+        "worker_class": profile["worker_class"],
+        "workers": workers,
+        "threads": threads,
+        "bind": environ.get('GUNICORN_BIND', '0.0.0.0:8000'),
+        "timeout": profile["timeout"],
+        "graceful_timeout": profile["graceful_timeout"],
+        "keepalive": profile["keepalive"],
+        "max_requests": _env_int('GUNICORN_MAX_REQUESTS', environ) or profile["max_requests"],
+        "max_requests_jitter": profile["max_requests_jitter"],
+        # Приложение импортируется один раз в мастере и делится между воркерами
+        "preload_app": environ.get('GUNICORN_PRELOAD', '1') != '0',
+    }
+    # Файл heartbeat воркеров в памяти, а не на overlay-диске контейнера
+    if os.path.isdir('/dev/shm'):
+        result["worker_tmp_dir"] = '/dev/shm'
+    return result
+
+
+def warm_up():
+    """
+    Импортирует URLconf (а с ним main.views, numpy и pydicom) до fork, чтобы
+    воркеры получили модули готовыми, а не при первом запросе.
+    Возвращает время импорта (сек).
+    """
+    start = time.monotonic()
+    from django.urls import get_resolver
+    get_resolver().url_patterns
+    return time.monotonic() - start
@@ -34,6 +34,40 @@ DATABASES = {
     }
 }
 
+# Локальная проверка без PostgreSQL: DB_SQLITE_PATH - файл основной базы,
+# DB_REPLICA_SQLITE_PATHS=a.sqlite3,b.sqlite3 - файлы "реплик" (их копирует
+# с основной базы тот, кто проверяет; отставание SQLite не измеряется)
+if os.getenv('DB_SQLITE_PATH'):
+    DATABASES['default'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.getenv('DB_SQLITE_PATH'),
+    }
+
+# Реплики только для чтения: DB_REPLICA_HOSTS=host1,host2[:port]
+# (остальные параметры подключения - как у основной базы)
+DATABASE_REPLICAS = []
+for index, replica_host in enumerate(filter(None, os.getenv('DB_REPLICA_HOSTS', '').split(','))):
+    replica_host, _, replica_port = replica_host.strip().partition(':')
+    DATABASES[f'replica_{index}'] = dict(
+        DATABASES['default'], HOST=replica_host, PORT=replica_port or DATABASES['default']['PORT'],
+    )
+    DATABASE_REPLICAS.append(f'replica_{index}')
+for replica_path in filter(None, os.getenv('DB_REPLICA_SQLITE_PATHS', '').split(',')):
+    replica_alias = f'replica_{len(DATABASE_REPLICAS)}'
+    DATABASES[replica_alias] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': replica_path.strip(),
+        # В тестах "реплика" - та же тестовая база, что и основная
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(replica_alias)
+
+DATABASE_ROUTERS = ['main.db_router.PrimaryReplicaRouter']
+# Сколько секунд после записи клиент читает с основной базы и какое
+# отставание реплики допустимо (проверяется не чаще раза в LAG_CHECK секунд)
+DATABASE_REPLICA_LAG = float(os.getenv('DB_REPLICA_LAG', '2'))
+DATABASE_REPLICA_LAG_CHECK = float(os.getenv('DB_REPLICA_LAG_CHECK', '5'))
+
 INSTALLED_APPS = [
     'django.contrib.admin',
     'django.contrib.auth',
@@ -51,10 +85,13 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     "corsheaders.middleware.CorsMiddleware",
     'django.middleware.security.SecurityMiddleware',
+    'main.admission.AdmissionControlMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'main.audit.AuditMiddleware',
+    'main.db_router.ReplicaRoutingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     "django.middleware.common.CommonMiddleware",
@@ -127,6 +164,35 @@ else:
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR/'media'
 
+# Служебный кэш (объемы HU и т.п.), не раздается через /media/
+DICOM_CACHE_ROOT = os.getenv('DICOM_CACHE_ROOT', BASE_DIR/'cache')
+
+# Кэш представлений приемов (main/fragments.py): locmem (только при одном
+# процессе), file (общий для процессов на одной машине), redis или memcached
+# (FRAGMENT_CACHE_LOCATION - адрес сервера)
+FRAGMENT_CACHE = os.getenv('FRAGMENT_CACHE', 'file')
+FRAGMENT_CACHE_BACKENDS = {
+    'locmem': 'django.core.cache.backends.locmem.LocMemCache',
+    'file': 'django.core.cache.backends.filebased.FileBasedCache',
+    'redis': 'django.core.cache.backends.redis.RedisCache',
+    'memcached': 'django.core.cache.backends.memcached.PyMemcacheCache',
+}
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'fragments': {
+        'BACKEND': FRAGMENT_CACHE_BACKENDS[FRAGMENT_CACHE],
+        'LOCATION': os.getenv('FRAGMENT_CACHE_LOCATION') or (
+            os.path.join(DICOM_CACHE_ROOT, 'fragments') if FRAGMENT_CACHE == 'file' else 'fragments'
+        ),
+        'KEY_PREFIX': 'smartdentist',
+        'OPTIONS': {'MAX_ENTRIES': 50000} if FRAGMENT_CACHE in ('file', 'locmem') else {},
+    },
+}
+FRAGMENT_CACHE_ALIAS = 'fragments'
+FRAGMENT_CACHE_TIMEOUT = int(os.getenv('FRAGMENT_CACHE_TIMEOUT', str(24 * 3600)))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
@@ -148,7 +214,137 @@ CSRF_TRUSTED_ORIGINS = [
 MAX_UPLOAD_SIZE = 2147483648
 
 DATA_UPLOAD_MAX_MEMORY_SIZE = MAX_UPLOAD_SIZE
-FILE_UPLOAD_MAX_MEMORY_SIZE = MAX_UPLOAD_SIZE
+# Файлы загрузки больше этого размера (байт) пишутся во временный файл на
+# диске по мере приема, а не собираются в памяти воркера целиком
+FILE_UPLOAD_MAX_MEMORY_SIZE = int(os.getenv('FILE_UPLOAD_MAX_MEMORY_SIZE', str(5 * 1024 ** 2)))
+
+# Сжатие распакованных срезов DICOM: none, zlib или zstd (нужен пакет zstandard)
+DICOM_SLICE_COMPRESSION = os.getenv('DICOM_SLICE_COMPRESSION', 'none')
+DICOM_SLICE_COMPRESSION_LEVEL = int(os.getenv('DICOM_SLICE_COMPRESSION_LEVEL', '6'))
+
+# Хранение снимков: extracted - серия распаковывается в media целиком,
+# archive - срезы читаются прямо из архива, а активно просматриваемые серии
+# распаковываются в кэш DICOM_CACHE_ROOT/extracted с квотой (байт, 0 - без кэша)
+# после DICOM_EXTRACT_CACHE_HITS обращений к срезам
+DICOM_STORAGE_MODE = os.getenv('DICOM_STORAGE_MODE', 'extracted')
+DICOM_EXTRACT_CACHE_QUOTA = int(os.getenv('DICOM_EXTRACT_CACHE_QUOTA', str(20 * 1024 ** 3)))
+DICOM_EXTRACT_CACHE_HITS = int(os.getenv('DICOM_EXTRACT_CACHE_HITS', '20'))
+
+# Хранилище папок серий (main/storage.py): local - MEDIA_ROOT, objects -
+# объектное хранилище на диске в DICOM_OBJECT_STORE_ROOT, s3 - бакет
+# DICOM_S3_BUCKET (нужен boto3, ключи доступа - стандартные переменные AWS_*).
+# DICOM_OBJECT_STORE_URL - публичный адрес объектов для прямых ссылок на
+# несжатые срезы, без него срезы отдаются через API. После смены хранилища
+# существующие серии переносит команда migrate_dicom_storage
+DICOM_SERIES_STORAGE = os.getenv('DICOM_SERIES_STORAGE', 'local')
+DICOM_OBJECT_STORE_ROOT = os.getenv('DICOM_OBJECT_STORE_ROOT', BASE_DIR/'object_store')
+DICOM_OBJECT_STORE_URL = os.getenv('DICOM_OBJECT_STORE_URL') or None
+DICOM_S3_BUCKET = os.getenv('DICOM_S3_BUCKET', '')
+DICOM_S3_ENDPOINT_URL = os.getenv('DICOM_S3_ENDPOINT_URL') or None
+
+# Распаковка архивов: число потоков и лимиты против zip-бомб
+# (см. main.extraction.DEFAULT_LIMITS, здесь можно переопределить отдельные ключи)
+DICOM_EXTRACT_THREADS = int(os.getenv('DICOM_EXTRACT_THREADS', '0')) or None
+DICOM_EXTRACT_LIMITS = {
+    "max_members": int(os.getenv('DICOM_EXTRACT_MAX_MEMBERS', '20000')),
+    "max_total_size": int(os.getenv('DICOM_EXTRACT_MAX_TOTAL_SIZE', str(8 * 1024 ** 3))),
+}
+
+# Индекс заголовков DICOM (main/dicom_index.py): строк на один INSERT
+DICOM_INDEX_BATCH_SIZE = int(os.getenv('DICOM_INDEX_BATCH_SIZE', '500'))
+
+# Панорамная реконструкция (main/panoramic.py): толщина слоя и ширина
+# поперечных срезов (мм), число срезов и порог HU для поиска зубной дуги
+PANORAMIC_THICKNESS = float(os.getenv('PANORAMIC_THICKNESS', '10'))
+PANORAMIC_SECTIONS = int(os.getenv('PANORAMIC_SECTIONS', '10'))
+PANORAMIC_SECTION_WIDTH = float(os.getenv('PANORAMIC_SECTION_WIDTH', '30'))
+PANORAMIC_ARCH_HU = float(os.getenv('PANORAMIC_ARCH_HU', '1200'))
+
+# Поверхность кости (main/mesh.py): порог HU и целевое число треугольников
+MESH_BONE_HU = float(os.getenv('MESH_BONE_HU', '400'))
+MESH_TARGET_TRIANGLES = int(os.getenv('MESH_TARGET_TRIANGLES', '200000'))
+
+# Минимальный запас прочности (предельное напряжение / расчетное) для выбора варианта
+IMPLANT_MIN_SAFETY_FACTOR = float(os.getenv('IMPLANT_MIN_SAFETY_FACTOR', '1.5'))
+
+# Размер пула процессов для пакетной обработки архивов (по умолчанию - число ядер)
+DICOM_BATCH_WORKERS = int(os.getenv('DICOM_BATCH_WORKERS', '0')) or None
+
+# Фоновая обработка загрузок с X-Upload-Id: потоков на процесс и
+# частота записи хода обработки (сек)
+DICOM_JOB_WORKERS = int(os.getenv('DICOM_JOB_WORKERS', '2'))
+PROGRESS_REPORT_INTERVAL = float(os.getenv('PROGRESS_REPORT_INTERVAL', '0.5'))
+# Через сколько секунд без обновлений задача считается брошенной (процесс
+# перезапущен или убит) и помечается ошибкой
+PROCESSING_JOB_STALE_AFTER = int(os.getenv('PROCESSING_JOB_STALE_AFTER', '600'))
+# Поток событий /api/uploads/<id>/events/: опрос состояния, ожидание начала
+# загрузки и максимальная длительность соединения (сек)
+SSE_POLL_INTERVAL = float(os.getenv('SSE_POLL_INTERVAL', '0.5'))
+SSE_WAIT_FOR_JOB = int(os.getenv('SSE_WAIT_FOR_JOB', '60'))
+SSE_MAX_DURATION = int(os.getenv('SSE_MAX_DURATION', '3600'))
+
+# Ограничение тяжелых запросов на узел (main/admission.py): одновременно
+# выполняемых, на пользователя, ожидающих в очереди и время ожидания (сек).
+# Места - файлы под flock в ADMISSION_LOCK_DIR, общем для процессов узла
+ADMISSION_LOCK_DIR = os.getenv('ADMISSION_LOCK_DIR', '') or None
+ADMISSION_BUDGETS = {
+    "processing": {
+        "concurrency": int(os.getenv('ADMISSION_PROCESSING_CONCURRENCY', '4')),
+        "per_user": int(os.getenv('ADMISSION_PROCESSING_PER_USER', '2')),
+        "queue": int(os.getenv('ADMISSION_PROCESSING_QUEUE', '8')),
+        "timeout": float(os.getenv('ADMISSION_PROCESSING_TIMEOUT', '10')),
+    },
+    "rendering": {
+        "concurrency": int(os.getenv('ADMISSION_RENDERING_CONCURRENCY', '4')),
+        "per_user": int(os.getenv('ADMISSION_RENDERING_PER_USER', '2')),
+        "queue": int(os.getenv('ADMISSION_RENDERING_QUEUE', '8')),
+        "timeout": float(os.getenv('ADMISSION_RENDERING_TIMEOUT', '10')),
+    },
+}
+
+# Журнал доступа к данным пациентов (main/audit.py): события копятся в
+# процессе и пишутся в базу пачками по AUDIT_BATCH_SIZE или раз в
+# AUDIT_FLUSH_INTERVAL сек. AUDIT_DEDUP_SECONDS > 0 - повторные просмотры
+# объекта одним пользователем в пределах этого срока не пишутся (по
+# умолчанию 0 - пишется каждый просмотр). При недоступной базе и при
+# остановке процесса события сохраняются в AUDIT_SPILL_DIR (AUDIT_ENABLED=0 - журнал выключен)
+AUDIT_ENABLED = os.getenv('AUDIT_ENABLED', '1') != '0'
+AUDIT_BATCH_SIZE = int(os.getenv('AUDIT_BATCH_SIZE', '500'))
+AUDIT_FLUSH_INTERVAL = float(os.getenv('AUDIT_FLUSH_INTERVAL', '2'))
+AUDIT_DEDUP_SECONDS = float(os.getenv('AUDIT_DEDUP_SECONDS', '0'))
+AUDIT_SPILL_DIR = os.getenv('AUDIT_SPILL_DIR', BASE_DIR/'audit_spill')
+
+# Профилирование памяти (main/memprofile.py): загрузка архива, распаковка и
+# список приемов. RSS до и после снимается для каждого такого запроса, рост
+# больше MEMPROFILE_RSS_WARN_MB пишется всегда; tracemalloc включается для доли
+# MEMPROFILE_SAMPLE_RATE запросов (и по заголовку X-Memory-Profile: 1 от
+# администратора) с MEMPROFILE_FRAMES кадрами стека и MEMPROFILE_TOP местами
+# аллокаций в профиле. Каждый процесс хранит последние MEMPROFILE_KEEP профилей
+# в MEMPROFILE_DIR, их отдает /api/stats/memory/
+MEMPROFILE_ENABLED = os.getenv('MEMPROFILE_ENABLED', '0') == '1'
+MEMPROFILE_SAMPLE_RATE = float(os.getenv('MEMPROFILE_SAMPLE_RATE', '0.01'))
+MEMPROFILE_FRAMES = int(os.getenv('MEMPROFILE_FRAMES', '1'))
+MEMPROFILE_TOP = int(os.getenv('MEMPROFILE_TOP', '10'))
+MEMPROFILE_RSS_WARN_MB = float(os.getenv('MEMPROFILE_RSS_WARN_MB', '64'))
+MEMPROFILE_KEEP = int(os.getenv('MEMPROFILE_KEEP', '200'))
+MEMPROFILE_DIR = os.getenv('MEMPROFILE_DIR', BASE_DIR/'memprofile')
+
+# Логи приложения (main.*) - в консоль процесса, откуда их забирает gunicorn/docker
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'main': {'handlers': ['console'], 'level': os.getenv('APP_LOG_LEVEL', 'INFO'), 'propagate': False},
+    },
+}
+
+# Синхронизация клиентов: запас по времени для долгих транзакций (сек)
+# и срок хранения отметок об удалении (дней)
+SYNC_OVERLAP = int(os.getenv('SYNC_OVERLAP', '5'))
+SYNC_TOMBSTONE_DAYS = int(os.getenv('SYNC_TOMBSTONE_DAYS', '90'))
 
 CORS_EXPOSE_HEADERS = ['Content-Type',"X-CSRF-Token"]
 SESSION_COOKIE_SECURE = True
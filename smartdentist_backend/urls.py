@@ -4,7 +4,6 @@ from django.urls import path, include, re_path
 from django.views.static import serve
 from django.conf import settings
 from main import views
-from main.views import *
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -17,25 +16,42 @@ urlpatterns = [
     path("api/register/worker/", views.WorkerRegisterView.as_view(), name="worker_register"),
     path("api/register/admin/", views.AdminRegisterView.as_view(), name="admin_register"),
     # Профиль
-    path('api/account/profile/', UserProfileView.as_view(), name='current-user-profile'), # GET: Получить данные текущего пользователя
+    path('api/account/profile/', views.UserProfileView.as_view(), name='current-user-profile'), # GET: Получить данные текущего пользователя
 
     # Пациенты
-    path('api/patients/', PatientListAPIView.as_view()),
-    path('api/patients/create/', PatientCreateAPIView.as_view()),
-    path('api/patients/update/<int:pk>/', PatientUpdateAPIView.as_view()),
-    path('api/patients/<int:patient_id>/cases/', PatientHistoryAPIView.as_view()),
+    path('api/patients/', views.PatientListAPIView.as_view()),
+    path('api/patients/create/', views.PatientCreateAPIView.as_view()),
+    path('api/patients/update/<int:pk>/', views.PatientUpdateAPIView.as_view()),
+    path('api/patients/<int:patient_id>/cases/', views.PatientHistoryAPIView.as_view()),
 
     # Приемы
-    path('api/cases/', MedicalCaseListAPIView.as_view()),
-    path('api/cases/create/', MedicalCaseCreateAPIView.as_view()),
-    path('api/cases/update/<int:pk>/', MedicalCaseUpdateAPIView.as_view()),
-    path('api/cases/<int:case_id>/upload-dicom/', DicomUploadAndProcessView.as_view(), name='dicom-upload-process'),
-    # path('api/patients/<int:patient_id>/cases/<int:case_id>/', MedicalCaseDetailAPIView.as_view()),
+    path('api/cases/', views.MedicalCaseListAPIView.as_view()),
+    path('api/cases/create/', views.MedicalCaseCreateAPIView.as_view()),
+    path('api/cases/update/<int:pk>/', views.MedicalCaseUpdateAPIView.as_view()),
+    path('api/cases/<int:case_id>/upload-dicom/', views.DicomUploadAndProcessView.as_view(), name='dicom-upload-process'),
+    path('api/cases/batch-upload-dicom/', views.DicomBatchUploadView.as_view(), name='dicom-batch-upload'),
+    path('api/cases/<int:case_id>/slices/<path:relpath>', views.DicomSliceView.as_view(), name='dicom-slice'),
+    path('api/cases/<int:case_id>/bundle/', views.DicomBundleView.as_view(), name='dicom-bundle'),
+    path('api/cases/<int:case_id>/dicom-index/', views.DicomIndexAPIView.as_view(), name='dicom-index'),
+    path('api/cases/<int:case_id>/panoramic/', views.PanoramicAPIView.as_view(), name='case-panoramic'),
+    path('api/cases/<int:case_id>/panoramic/<str:key>/<str:name>', views.PanoramicImageView.as_view(),
+         name='case-panoramic-image'),
+    path('api/cases/<int:case_id>/mesh/', views.BoneMeshView.as_view(), name='case-bone-mesh'),
+    # Состояние фоновой обработки; поток событий /api/uploads/<id>/events/ обслуживает asgi.py
+    path('api/uploads/<str:upload_id>/', views.ProcessingJobAPIView.as_view(), name='upload-status'),
+    # path('api/patients/<int:patient_id>/cases/<int:case_id>/', views.MedicalCaseDetailAPIView.as_view()),
 
 
     # Шаблоны для генерации
-    path('api/library/', LibraryListAPIView.as_view(), name='library-list'),
-    path('api/library/create/', LibraryCreateAPIView.as_view(), name='library-create'),
+    path('api/library/', views.LibraryListAPIView.as_view(), name='library-list'),
+    path('api/library/create/', views.LibraryCreateAPIView.as_view(), name='library-create'),
+
+    # Синхронизация: изменения пациентов и приемов с прошлого запроса
+    path('api/sync/', views.SyncAPIView.as_view(), name='sync'),
+
+    # Статистика
+    path('api/stats/dashboard/', views.DashboardStatsView.as_view(), name='dashboard-stats'),
+    path('api/stats/memory/', views.MemoryProfilesView.as_view(), name='memory-profiles'),
 
 
     re_path(r'^media/(?P<path>.*)$', serve, {'document_root': settings.MEDIA_ROOT}),
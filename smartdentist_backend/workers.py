@@ -0,0 +1,53 @@
+# workers.py
+# Воркер uvicorn для gunicorn (см. server.py): не перезапускается по
+# max_requests, пока в процессе есть фоновые задачи обработки загрузок
+# (main/progress.py), - они выполняются в потоках процесса и пропали бы
+# вместе с ним. Задачи, прерванные остановкой сервера, помечаются ошибкой
+# по сроку PROCESSING_JOB_STALE_AFTER.
+# Собственный предел запросов uvicorn отключен: предел gunicorn (с уже
+# добавленным jitter) проверяется в on_tick, который одинаков в версиях
+# uvicorn из requirements.txt и новее.
+import logging
+import sys
+
+from gunicorn.arbiter import Arbiter
+from uvicorn.server import Server
+from uvicorn.workers import UvicornWorker as BaseUvicornWorker
+
+logger = logging.getLogger('uvicorn.error')
+
+
+class JobAwareServer(Server):
+    def __init__(self, config, max_requests=None):
+        super().__init__(config=config)
+        self.max_requests = max_requests
+        self.waiting_for_jobs = False
+
+    def max_requests_reached(self):
+        return bool(self.max_requests) and self.server_state.total_requests >= self.max_requests
+
+    async def on_tick(self, counter):
+        # Вызывается основным циклом сервера 10 раз в секунду
+        if await super().on_tick(counter):
+            return True
+        if not self.max_requests_reached():
+            return False
+        from main.progress import pending_jobs
+        if pending_jobs():
+            if not self.waiting_for_jobs:
+                self.waiting_for_jobs = True
+                logger.info("Maximum request limit of %d exceeded, waiting for processing jobs.", self.max_requests)
+            return False
+        logger.info("Maximum request limit of %d exceeded. Terminating process.", self.max_requests)
+        return True
+
+
+class UvicornWorker(BaseUvicornWorker):
+    async def _serve(self):
+        self.config.app = self.wsgi
+        self.config.limit_max_requests = None
+        server = JobAwareServer(config=self.config, max_requests=self.max_requests)
+        self._install_sigquit_handler()
+        await server.serve(sockets=self.sockets)
+        if not server.started:
+            sys.exit(Arbiter.WORKER_BOOT_ERROR)